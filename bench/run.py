@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Optional, Any, Awaitable, Callable
+
+from aiogram import Bot, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from config_data.settings import Config, TgBot, HttpSettings, SearchDeadlines, CacheSettings, WriteBehindSettings, \
+    ProviderLimits, BreakerSettings, SharedCacheSettings, IndexSettings, InlineSettings, BatchSettings, \
+    SchedulerSettings, MetricsSettings, PrewarmSettings, RetentionSettings, LifecycleSettings
+from core.app import App
+from core.scheduling import SchedulingBotApi
+from .upstreams import UpstreamSettings, FakeUpstream, FakeKinopoisk, FakeTmdb, FakeSerpApi, FakeTelegram, \
+    catalog_title
+
+logger = logging.getLogger(__name__)
+
+_bot_token: str = '123456:benchmark'
+
+
+@dataclass
+class BenchSettings:
+    chats: int = 50              # Сколько чатов работают одновременно
+    steps: int = 10              # Сколько команд отправляет каждый чат
+    catalog: int = 200           # Сколько разных фильмов ищут чаты
+    zipf: float = 1.1            # Насколько популярные фильмы ищут чаще остальных
+    miss_rate: float = 0.05      # Доля поисков фильмов, которых нет у провайдеров
+    history_share: float = 0.1   # Доля команд /history
+    stats_share: float = 0.1     # Доля команд /stats
+    think_time: float = 0.0      # Пауза между командами одного чата, секунды
+    client_rate: float = 1000.0  # Квота ProviderScheduler к каждому провайдеру, запросов в секунду
+    seed: int = 1
+
+
+@dataclass
+class Upstreams:
+    kinopoisk: FakeKinopoisk
+    tmdb: FakeTmdb
+    serpapi: FakeSerpApi
+    telegram: FakeTelegram
+
+    def all(self) -> list[FakeUpstream]:
+        return [self.kinopoisk, self.tmdb, self.serpapi, self.telegram]
+
+
+# Тот же App, что собирают bot.py и bot_webhook.py, с настройками по умолчанию; движки, скраппер и Bot
+# направлены на поддельные серверы, квота к провайдерам - client_rate
+def build_app(path: str, upstreams: Upstreams, settings: BenchSettings) -> App:
+    limits = ProviderLimits(rate=settings.client_rate, burst=int(settings.client_rate))
+    config = Config(
+        tg_bot=TgBot(_bot_token, path, 'benchmark', 'benchmark', 'benchmark'),
+        http=HttpSettings(),
+        deadlines=SearchDeadlines(),
+        cache=CacheSettings(),
+        history_writes=WriteBehindSettings(),
+        providers={name: limits for name in ('kinopoisk', 'tmdb', 'serpapi')},
+        breakers=BreakerSettings(),
+        shared_cache=SharedCacheSettings(),
+        index=IndexSettings(),
+        inline=InlineSettings(),
+        batch=BatchSettings(),
+        scheduler=SchedulerSettings(),
+        metrics=MetricsSettings(port=0),  # Страницу /metrics не поднимаем, чтобы прогоны не делили порт
+        prewarm=PrewarmSettings(),
+        retention=RetentionSettings(),
+        lifecycle=LifecycleSettings(),
+        redis_url=None
+    )
+    bot = Bot(token=_bot_token, session=AiohttpSession(api=TelegramAPIServer.from_base(upstreams.telegram.url)))
+    app = App(config, bot)
+    kinopoisk = app.upstream_engines['kinopoisk']
+    kinopoisk.search_movie_endpoint = upstreams.kinopoisk.url + '/api/v2.1/films/search-by-keyword'
+    kinopoisk.get_movie_endpoint = upstreams.kinopoisk.url + '/api/v2.2/films'
+    tmdb = app.upstream_engines['tmdb']
+    tmdb.search_movie_endpoint = upstreams.tmdb.url + '/3/search/movie'
+    tmdb.get_movie_endpoint = upstreams.tmdb.url + '/3/movie'
+    tmdb.images_endpoint = upstreams.tmdb.url + '/t/p/w500'
+    app.google.search_endpoint = upstreams.serpapi.url + '/search.json'
+    return app
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered: list[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+
+class Driver:
+
+    def __init__(self, core: SchedulingBotApi, settings: BenchSettings):
+        self.core = core
+        self.settings = settings
+        self.latencies: dict[str, list[float]] = {'search': [], 'history': [], 'stats': []}
+        self.errors: dict[str, int] = {command: 0 for command in self.latencies}
+        self._random = random.Random(settings.seed)
+        self._weights: list[float] = [1 / (rank + 1) ** settings.zipf for rank in range(settings.catalog)]
+        self._message_id: int = 0
+
+    async def run(self) -> float:
+        started: float = time.monotonic()
+        await asyncio.gather(*(self._chat(10000 + number, random.Random(self._random.random()))
+                               for number in range(self.settings.chats)))
+        return time.monotonic() - started
+
+    async def _chat(self, chat_id: int, rng: random.Random) -> None:
+        for _ in range(self.settings.steps):
+            roll: float = rng.random()
+            if roll < self.settings.history_share:
+                await self._command('history', self.core.process_history_command, self._message(chat_id, '/history'))
+            elif roll < self.settings.history_share + self.settings.stats_share:
+                await self._command('stats', self.core.process_stats_command, self._message(chat_id, '/stats'))
+            else:
+                await self._command('search', self.core.process_search_command,
+                                    self._message(chat_id, f'/search {self._title(rng)}'))
+            if self.settings.think_time:
+                await asyncio.sleep(rng.expovariate(1 / self.settings.think_time))
+
+    async def _command(self, command: str, handler: Callable[[types.Message], Awaitable[None]],
+                       message: types.Message) -> None:
+        started: float = time.monotonic()
+        try:
+            await handler(message)
+        except Exception as error:
+            self.errors[command] += 1
+            logger.debug('%s failed: %r', command, error)
+        self.latencies[command].append(time.monotonic() - started)
+
+    def _title(self, rng: random.Random) -> str:
+        if rng.random() < self.settings.miss_rate:
+            return f'Missing Title {rng.randrange(1000000)}'
+        return catalog_title(rng.choices(range(self.settings.catalog), self._weights)[0])
+
+    def _message(self, chat_id: int, text: str) -> types.Message:
+        self._message_id += 1
+        return types.Message(message_id=self._message_id, date=datetime.now(),
+                             chat=types.Chat(id=chat_id, type='private'), text=text)
+
+    def report(self, wall: float) -> dict[str, Any]:
+        commands: dict[str, dict[str, float]] = {}
+        for command, values in self.latencies.items():
+            commands[command] = {
+                'count': len(values), 'errors': self.errors[command],
+                'p50': _percentile(values, 50), 'p95': _percentile(values, 95), 'p99': _percentile(values, 99),
+                'max': max(values, default=0.0),
+            }
+        total: int = sum(len(values) for values in self.latencies.values())
+        return {'wall': wall, 'throughput': total / wall if wall else 0.0, 'commands': commands}
+
+
+async def run_bench(path: str, settings: BenchSettings, upstream: UpstreamSettings,
+                    telegram: UpstreamSettings) -> dict[str, Any]:
+    upstreams = Upstreams(FakeKinopoisk('kinopoisk', upstream, settings.seed),
+                          FakeTmdb('tmdb', upstream, settings.seed + 1),
+                          FakeSerpApi('serpapi', upstream, settings.seed + 2),
+                          FakeTelegram('telegram', telegram, settings.seed + 3))
+    for server in upstreams.all():
+        await server.start()
+    app: App = build_app(path, upstreams, settings)
+    try:
+        await app.start()
+        try:
+            driver = Driver(app.core, settings)
+            report: dict[str, Any] = driver.report(await driver.run())
+        finally:
+            await app.stop()
+    finally:
+        await app.bot.session.close()
+        for server in upstreams.all():
+            await server.close()
+    report['upstreams'] = {server.name: {'calls': dict(server.calls), 'errors': server.errors,
+                                         'throttled': server.throttled} for server in upstreams.all()}
+    report['settings'] = {'bench': asdict(settings), 'upstream': asdict(upstream), 'telegram': asdict(telegram)}
+    return report
+
+
+def _change(current: float, baseline: float) -> str:
+    if not baseline:
+        return ''
+    return f' ({baseline:.3f}, {(current - baseline) / baseline:+.0%})'
+
+
+def print_report(report: dict[str, Any], baseline: Optional[dict[str, Any]] = None) -> None:
+    baseline = baseline or {}
+    print(f'Throughput: {report["throughput"]:.1f} commands/s{_change(report["throughput"], baseline.get("throughput", 0))}')
+    for command, stats in report['commands'].items():
+        previous: dict[str, float] = baseline.get('commands', {}).get(command, {})
+        timings: str = ', '.join(f'{name} {stats[name]:.3f}s{_change(stats[name], previous.get(name, 0))}'
+                                 for name in ('p50', 'p95', 'p99'))
+        print(f'{command}: {stats["count"]} done, {stats["errors"]} failed, {timings}')
+    for name, stats in report['upstreams'].items():
+        previous: dict[str, Any] = baseline.get('upstreams', {}).get(name, {})
+        calls: int = sum(stats['calls'].values())
+        print(f'{name}: {calls} calls{_change(calls, sum(previous.get("calls", {}).values()))} {stats["calls"]}, '
+              f'{stats["errors"]} errors, {stats["throttled"]} throttled')
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m bench.run',
+                                     description='Нагрузочный прогон BotApiImpl на поддельных Telegram, Кинопоиске, '
+                                                 'TMDB и SerpAPI')
+    defaults = BenchSettings()
+    parser.add_argument('--chats', type=int, default=defaults.chats, help='сколько чатов работают одновременно')
+    parser.add_argument('--steps', type=int, default=defaults.steps, help='сколько команд отправляет каждый чат')
+    parser.add_argument('--catalog', type=int, default=defaults.catalog, help='сколько разных фильмов ищут чаты')
+    parser.add_argument('--zipf', type=float, default=defaults.zipf, help='перекос популярности фильмов')
+    parser.add_argument('--miss-rate', type=float, default=defaults.miss_rate, help='доля поисков без результата')
+    parser.add_argument('--think-time', type=float, default=defaults.think_time,
+                        help='средняя пауза между командами одного чата, секунды')
+    parser.add_argument('--client-rate', type=float, default=defaults.client_rate,
+                        help='квота бота к каждому провайдеру, запросов в секунду')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка провайдеров, секунды')
+    parser.add_argument('--jitter', type=float, default=0.02, help='разброс задержки провайдеров, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500 от провайдеров')
+    parser.add_argument('--quota', type=float, default=None, help='квота провайдеров, запросов в секунду')
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help='задержка Bot API, секунды')
+    parser.add_argument('--output', help='куда сохранить отчёт в JSON')
+    parser.add_argument('--baseline', help='отчёт JSON, с которым сравниваем результат')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    args = _parse_args()
+    bench_settings = BenchSettings(chats=args.chats, steps=args.steps, catalog=args.catalog, zipf=args.zipf,
+                                   miss_rate=args.miss_rate, think_time=args.think_time,
+                                   client_rate=args.client_rate, seed=args.seed)
+    upstream_settings = UpstreamSettings(args.latency, args.jitter, args.error_rate, args.quota)
+    telegram_settings = UpstreamSettings(args.telegram_latency, args.telegram_latency / 3)
+    directory: str = tempfile.mkdtemp(prefix='cinemabot-bench-')
+    try:
+        result: dict[str, Any] = asyncio.run(
+            run_bench(os.path.join(directory, 'bench.db'), bench_settings, upstream_settings, telegram_settings))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    baseline_report: Optional[dict[str, Any]] = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline_report = json.load(baseline_file)
+    print_report(result, baseline_report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(result, output_file, indent=2, ensure_ascii=False)
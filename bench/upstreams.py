@@ -0,0 +1,189 @@
+import asyncio
+import random
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional, Any, Awaitable, Callable
+
+from aiohttp import web
+
+
+@dataclass
+class UpstreamSettings:
+    latency: float = 0.05          # Средняя задержка ответа, секунды
+    jitter: float = 0.02           # Разброс задержки в обе стороны, секунды
+    error_rate: float = 0.0        # Доля ответов 500, от 0 до 1
+    rate: Optional[float] = None   # Квота, запросов в секунду; сверх неё отвечаем 429 с Retry-After
+
+
+# Каталог, общий для всех поддельных провайдеров: фильм с номером i есть и в Кинопоиске, и в TMDB
+def catalog_title(number: int) -> str:
+    return f'Benchmark Movie {number}'
+
+
+def _catalog_number(query: str) -> Optional[int]:
+    prefix: str = catalog_title(0)[:-1].lower()
+    query = query.strip().lower()
+    if not query.startswith(prefix) or not query[len(prefix):].isdigit():
+        return None
+    return int(query[len(prefix):])
+
+
+# Поддельный upstream: задержка, ошибки и квота настраиваются, все запросы считаются по эндпоинтам
+class FakeUpstream:
+
+    def __init__(self, name: str, settings: Optional[UpstreamSettings] = None, seed: int = 0):
+        self.name = name
+        self.settings = settings or UpstreamSettings()
+        self.calls: Counter[str] = Counter()
+        self.errors: int = 0
+        self.throttled: int = 0
+        self.url: str = ''
+        self._random = random.Random(seed)
+        self._tokens: float = self.settings.rate or 0.0
+        self._updated_at: float = time.monotonic()
+        self._runner: Optional[web.AppRunner] = None
+
+    def routes(self) -> list[web.RouteDef]:
+        raise NotImplementedError
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        self.url = f'http://127.0.0.1:{self._runner.addresses[0][1]}'
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def handler(self, endpoint: str, respond: Callable[[web.Request], Awaitable[Any]]) \
+            -> Callable[[web.Request], Awaitable[web.Response]]:
+        async def handle(request: web.Request) -> web.Response:
+            self.calls[endpoint] += 1
+            if not self._take_token():
+                self.throttled += 1
+                return web.json_response(self.error_body(429), status=429, headers={'Retry-After': '1'})
+            delay: float = self.settings.latency + self._random.uniform(-self.settings.jitter, self.settings.jitter)
+            await asyncio.sleep(max(delay, 0.0))
+            if self._random.random() < self.settings.error_rate:
+                self.errors += 1
+                return web.json_response(self.error_body(500), status=500)
+            return web.json_response(await respond(request))
+
+        return handle
+
+    def error_body(self, status: int) -> dict[str, Any]:
+        return {'error': 'quota exceeded' if status == 429 else 'internal'}
+
+    def _take_token(self) -> bool:
+        if not self.settings.rate:
+            return True
+        now: float = time.monotonic()
+        self._tokens = min(self.settings.rate, self._tokens + (now - self._updated_at) * self.settings.rate)
+        self._updated_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class FakeKinopoisk(FakeUpstream):
+
+    def routes(self) -> list[web.RouteDef]:
+        return [
+            web.get('/api/v2.1/films/search-by-keyword', self.handler('search', self.search)),
+            web.get('/api/v2.2/films/{id}', self.handler('movie', self.movie)),
+        ]
+
+    async def search(self, request: web.Request) -> dict[str, Any]:
+        number: Optional[int] = _catalog_number(request.query.get('keyword', ''))
+        if number is None:
+            return {'films': []}
+        return {'films': [{'filmId': number + 1, 'nameRu': catalog_title(number), 'nameEn': catalog_title(number),
+                           'year': str(1950 + number % 70)}]}
+
+    async def movie(self, request: web.Request) -> dict[str, Any]:
+        number: int = int(request.match_info['id']) - 1
+        return {
+            'kinopoiskId': number + 1, 'imdbId': f'tt{number:07d}', 'nameRu': catalog_title(number),
+            'nameOriginal': catalog_title(number), 'description': 'Benchmark movie description. ' * 10,
+            'webUrl': f'https://www.kinopoisk.ru/film/{number + 1}/', 'posterUrl': f'{self.url}/poster/{number}.jpg',
+            'ratingKinopoisk': 7.5, 'ratingImdb': 7.1, 'year': 1950 + number % 70,
+        }
+
+
+class FakeTmdb(FakeUpstream):
+
+    def routes(self) -> list[web.RouteDef]:
+        return [
+            web.get('/3/search/movie', self.handler('search', self.search)),
+            web.get('/3/movie/{id}', self.handler('movie', self.movie)),
+        ]
+
+    async def search(self, request: web.Request) -> dict[str, Any]:
+        number: Optional[int] = _catalog_number(request.query.get('query', ''))
+        if number is None:
+            return {'results': []}
+        return {'results': [{'id': number + 1, 'title': catalog_title(number), 'original_title': catalog_title(number),
+                             'release_date': f'{1950 + number % 70}-01-01'}]}
+
+    async def movie(self, request: web.Request) -> dict[str, Any]:
+        number: int = int(request.match_info['id']) - 1
+        return {
+            'id': number + 1, 'imdb_id': f'tt{number:07d}', 'title': catalog_title(number),
+            'original_title': catalog_title(number), 'overview': 'Benchmark movie overview. ' * 10,
+            'poster_path': f'/{number}.jpg', 'release_date': f'{1950 + number % 70}-01-01',
+        }
+
+
+class FakeSerpApi(FakeUpstream):
+
+    def routes(self) -> list[web.RouteDef]:
+        return [web.get('/search.json', self.handler('search', self.search))]
+
+    async def search(self, request: web.Request) -> dict[str, Any]:
+        query: str = request.query.get('q', '')
+        site: str = query.split()[0][len('site:'):] if query.startswith('site:') else 'example.com'
+        return {'organic_results': [{'link': f'https://{site}/watch/{zlib.crc32(query.encode())}'}]}
+
+
+# Поддельный Bot API: отвечает на методы, которые вызывает BotApiImpl, и считает вызовы по методам
+class FakeTelegram(FakeUpstream):
+
+    def __init__(self, name: str, settings: Optional[UpstreamSettings] = None, seed: int = 0):
+        super().__init__(name, settings, seed)
+        self._message_id: int = 0
+
+    def routes(self) -> list[web.RouteDef]:
+        return [web.post('/bot{token}/{method}', self.dispatch)]
+
+    async def dispatch(self, request: web.Request) -> web.Response:
+        method: str = request.match_info['method']
+        return await self.handler(method, self.call)(request)
+
+    def error_body(self, status: int) -> dict[str, Any]:
+        return {'ok': False, 'error_code': status, 'description': 'Benchmark error',
+                'parameters': {'retry_after': 1} if status == 429 else {}}
+
+    async def call(self, request: web.Request) -> dict[str, Any]:
+        method: str = request.match_info['method']
+        form = await request.post()
+        if method not in ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption'):
+            return {'ok': True, 'result': True}
+        self._message_id += 1
+        message: dict[str, Any] = {
+            'message_id': int(form.get('message_id') or self._message_id), 'date': int(time.time()),
+            'chat': {'id': int(form.get('chat_id') or 0), 'type': 'private'},
+        }
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f'photo-{self._message_id}', 'file_unique_id': f'u{self._message_id}',
+                                 'width': 500, 'height': 750}]
+            message['caption'] = form.get('caption')
+        else:
+            message['text'] = form.get('text') or form.get('caption') or ''
+        return {'ok': True, 'result': message}
@@ -1,25 +1,31 @@
+import asyncio
 import logging
+from typing import Optional, Any, Awaitable, Callable
 
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command, CommandStart, StateFilter
 # from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import default_state, State, StatesGroup
-# from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.fsm.storage.redis import RedisStorage, Redis
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
 
-from aiogram.types import (Message)
+from aiogram.types import (CallbackQuery, InlineQuery, Message, TelegramObject, Update)
 
 from config_data.config import Config, load_config
-from core.bot_core import BotApi, BotApiImpl
-from core.database import BotDatabase, BotDatabaseImpl
-from core.search import SearchEngine, TmdbSearchEngine, KpUnofficialSearchEngine
-from core.scrapper import Scrapper, GoogleRestScrapper
-
-# Инициализируем хранилище (создаем экземпляр класса RedisStorage)
-redis = Redis(host='localhost',port=6379)
-storage = RedisStorage(redis=redis)
+from core.app import App
+from core.bot_core import BotApiImpl
+from core.scheduling import SchedulingBotApi
+from core.shared_cache import CacheBackend
+
 logger = logging.getLogger(__name__)
-dp = Dispatcher(storage=storage)
+# Хэндлеры висят на роутере, диспетчер с хранилищем состояний собирает create_bot по конфигу
+router = Router()
+
+known_commands: list[str] = ['start', 'help', 'search', 'stats', 'history']
+dp: Dispatcher
+app: App
+core: SchedulingBotApi
+last_update_id: Optional[int] = None
 
 # Cоздаем класс, наследуемый от StatesGroup, для группы состояний нашей FSM
 class FSMFillForm(StatesGroup):
@@ -33,65 +39,141 @@ class FSMFillForm(StatesGroup):
     fill_education = State()   # Состояние ожидания выбора образования
     fill_wish_news = State()   # Состояние ожидания выбора получать ли новости
 
-@dp.message(CommandStart(), StateFilter(default_state))
+@router.message(CommandStart(), StateFilter(default_state))
 async def process_start_command(message: Message):
     await core.process_start_command(message)
 
 
-@dp.message(Command(commands='help'), StateFilter(default_state))
+@router.message(Command(commands='help'), StateFilter(default_state))
 async def handle_help_command(message: Message):
     await core.process_help_command(message)
 
 
 # Этот хэндлер будет срабатывать на команду "/search" в состоянии
 # по умолчанию и сообщать, что эта команда работает внутри машины состояний
-@dp.message(Command(commands='search'), StateFilter(default_state))
+@router.message(Command(commands='search'), StateFilter(default_state))
 async def process_search_command(message: Message):
     await core.process_search_command(message)
 
 
 # Этот хэндлер будет срабатывать на команду "/stats" в состоянии
 # по умолчанию и сообщать статистику использования бота
-@dp.message(Command(commands='stats'), StateFilter(default_state))
+@router.message(Command(commands='stats'), StateFilter(default_state))
 async def process_stats_command(message: Message):
     await core.process_stats_command(message)
 
 
-@dp.message(Command(commands='history'), StateFilter(default_state))
+# Этот хэндлер будет срабатывать на присланный файл со списком названий
+@router.message(F.document, StateFilter(default_state))
+async def handle_search_file(message: Message):
+    await core.process_search_file(message)
+
+
+@router.message(Command(commands='history'), StateFilter(default_state))
 async def handle_history_command(message: Message):
     await core.process_history_command(message)
 
 
+# Этот хэндлер будет срабатывать на кнопки листания истории
+@router.callback_query(F.data.startswith(BotApiImpl.history_callback_prefix + ':'))
+async def handle_history_callback(callback: CallbackQuery):
+    await core.process_history_callback(callback)
+
+
+# Этот хэндлер будет срабатывать на inline-запросы вида "@bot название"
+@router.inline_query()
+async def handle_inline_query(inline_query: InlineQuery):
+    await core.process_inline_query(inline_query)
+
+
 # Этот хэндлер будет срабатывать на любые сообщения, кроме тех
 # для которых есть отдельные хэндлеры, вне состояний
-@dp.message(StateFilter(default_state))
+@router.message(StateFilter(default_state))
 async def send_echo(message: Message):
-    await message.reply(text='Извините, моя твоя не понимать')
+    await core.process_unknown_command(message)
 
 
-# Запускаем поллинг
-if __name__ == '__main__':
+def setup_logging() -> None:
     # Конфигурируем логирование
     logging.basicConfig(
         level=logging.DEBUG,
         format='%(filename)s:%(lineno)d #%(levelname)-8s '
                '[%(asctime)s] - %(name)s - %(message)s')
 
+
+# При старте поднимаем базу, пул HTTP-соединений и метрики, при остановке (в том числе по SIGTERM)
+# дожидаемся принятых поисков и записи истории
+async def on_startup():
+    await app.start()
+
+
+async def on_shutdown():
+    await app.stop()
+
+
+# Запоминаем последнее полученное обновление, чтобы при остановке подтвердить его Telegram
+async def track_update_id(handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], update: Update,
+                          data: dict[str, Any]) -> Any:
+    global last_update_id
+    last_update_id = max(last_update_id or 0, update.update_id)
+    return await handler(update, data)
+
+
+# Поллинг останавливается, не подтвердив offset последней пачки, и новый процесс получил бы её повторно.
+# Вызываем после on_shutdown, когда уже принятые обновления обработаны
+async def confirm_updates(bot: Bot) -> None:
+    if last_update_id is None:
+        return
+    try:
+        await bot.get_updates(offset=last_update_id + 1, limit=1, timeout=0)
+    except Exception as error:
+        logger.warning('Could not confirm updates up to %s: %r', last_update_id, error)
+
+
+# Состояния FSM и общий кэш живут в Redis, если он задан в REDIS_URL, иначе в памяти процесса
+def create_storage(config: Config) -> tuple[BaseStorage, Optional[CacheBackend]]:
+    if not config.redis_url:
+        return MemoryStorage(), None
+    from aiogram.fsm.storage.redis import RedisStorage, Redis
+    from core.shared_cache import RedisCacheBackend
+    redis = Redis.from_url(config.redis_url)
+    return RedisStorage(redis=redis), RedisCacheBackend(redis)
+
+
+# Собираем все части бота по конфигу; хэндлеры выше работают с этими объектами
+def create_bot(config: Config) -> Bot:
+    global dp, app, core
+
+    storage, cache_backend = create_storage(config)
+    # Инициализируем бот
+    # Без parse_mode по умолчанию: баннеры сами просят Markdown, остальные ответы - простой текст
+    bot = Bot(token=config.tg_bot.token)
+    app = App(config, bot, cache_backend)
+    core = app.core
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(track_update_id)
+    dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return bot
+
+
+async def main(config: Config) -> None:
+    bot: Bot = create_bot(config)
+    # start_polling сам ловит SIGTERM и SIGINT: перестаёт забирать обновления и вызывает on_shutdown
+    try:
+        await dp.start_polling(bot, close_bot_session=False)
+        await confirm_updates(bot)
+    finally:
+        await bot.session.close()
+
+
+# Запускаем поллинг
+if __name__ == '__main__':
+    setup_logging()
+
     # Выводим в консоль информацию о начале запуска бота
     logger.info('Starting bot')
 
     # Загружаем конфиг в переменную config
-    config: Config = load_config()
-
-    database: BotDatabase = BotDatabaseImpl(config.database_path)
-    engines: dict[str, SearchEngine] = {
-        'kinopoisk': KpUnofficialSearchEngine(config.kp_unofficial_api_key),
-        'tmdb': TmdbSearchEngine(config.tmpdb_api_key),
-    }
-    scrapper: Scrapper = GoogleRestScrapper(config.serp_api_key)
-    known_commands: list[str] = ['start', 'help', 'search', 'stats', 'history']
-
-    # Инициализируем бот и диспетчер
-    bot = Bot(token=config.tg_bot.token, parse_mode='MarkdownV2')
-    core: BotApi = BotApiImpl(bot, database, engines, scrapper)
-    dp.run_polling(bot)
+    asyncio.run(main(load_config()))
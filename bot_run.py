@@ -1,57 +1,15 @@
-import os
+import asyncio
+import logging
 
-from aiogram import Bot, types, Dispatcher, executor
-from dotenv import load_dotenv
-from core.bot_core import BotApi, BotApiImpl
-from core.database import BotDatabase, BotDatabaseImpl
-from core.search import SearchEngine, TmdbSearchEngine, KpUnofficialSearchEngine
-from core.scrapper import Scrapper, GoogleRestScrapper
-
-load_dotenv()
-
-bot = Bot(token=os.environ['TELEGRAM_API_KEY'])
-dp = Dispatcher(bot)
-
-database: BotDatabase = BotDatabaseImpl(os.environ['DATABASE_PATH'])
-engines: dict[str, SearchEngine] = {
-    'kinopoisk': KpUnofficialSearchEngine(os.environ['KP_UNOFFICIAL_API_KEY']),
-    'tmdb': TmdbSearchEngine(os.environ['TMDB_API_KEY']),
-}
-scrapper: Scrapper = GoogleRestScrapper(os.environ['SERP_API_KEY'])
-core: BotApi = BotApiImpl(bot, database, engines, scrapper)
-
-known_commands: list[str] = ['start', 'help', 'search', 'stats', 'history']
-
-
-@dp.message_handler(commands=['start'])
-async def handle_start(message: types.Message):
-    await core.process_start_command(message)
-
-
-@dp.message_handler(commands=['help'])
-async def handle_help(message: types.Message):
-    await core.process_help_command(message)
-
-
-@dp.message_handler(commands=['search'])
-async def handle_search(message: types.Message):
-    await core.process_search_command(message)
-
-
-@dp.message_handler(commands=['stats'])
-async def handle_stats(message: types.Message):
-    await core.process_stats_command(message)
-
-
-@dp.message_handler(commands=['history'])
-async def handle_stats(message: types.Message):
-    await core.process_history_command(message)
-
-
-@dp.message_handler()
-async def handle_unknown(message: types.Message):
-    await core.process_unknown_command(message)
+from bot import main, setup_logging
+from config_data.config import load_config
 
+logger = logging.getLogger(__name__)
 
+# Точка входа для Procfile: тот же бот, что и bot.py, в режиме long polling.
+# Обновления, пришедшие во время перезапуска, не пропускаем - их заберёт новый процесс.
+# Обработанные подтверждаются при остановке, но если процесс упал, последнюю пачку он получит повторно
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    setup_logging()
+    logger.info('Starting bot')
+    asyncio.run(main(load_config()))
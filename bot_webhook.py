@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import multiprocessing
+import secrets
+import signal
+from typing import Any, Optional
+
+from aiogram import Bot
+from aiohttp import web
+
+import bot as polling_bot
+from config_data.config import Config, WebhookSettings, load_config, load_webhook_settings
+from environs import Env
+
+logger = logging.getLogger(__name__)
+
+_secret_header: str = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+# Достаём из обновления идентификатор чата (или пользователя), по которому
+# сохраняем порядок обработки и выбираем процесс-обработчик
+def get_chat_key(update: dict[str, Any]) -> int:
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        if isinstance(value.get('chat'), dict):
+            return value['chat']['id']
+        if isinstance(value.get('message'), dict) and isinstance(value['message'].get('chat'), dict):
+            return value['message']['chat']['id']
+        if isinstance(value.get('from'), dict):
+            return value['from']['id']
+        if isinstance(value.get('user'), dict):
+            return value['user']['id']
+    return update.get('update_id', 0)
+
+
+# Обрабатывает обновления конкурентно между чатами, но строго по очереди внутри одного чата
+class ChatOrderedFeeder:
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._tails: dict[int, asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, chat_key: int, update: dict[str, Any]) -> None:
+        # Inline-запросы порядка не требуют: новый запрос должен успеть отменить предыдущий, а не ждать его
+        if 'inline_query' in update:
+            task = asyncio.ensure_future(self._feed(None, update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return
+        previous: Optional[asyncio.Task] = self._tails.get(chat_key)
+        task = asyncio.ensure_future(self._feed(previous, update))
+        self._tails[chat_key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._forget(chat_key, done))
+
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self, timeout: float) -> None:
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        if pending:
+            logger.error('Dropping %s updates not handled in %s s', len(pending), timeout)
+            for task in pending:
+                task.cancel()
+
+    async def _feed(self, previous: Optional[asyncio.Task], update: dict[str, Any]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await polling_bot.dp.feed_raw_update(self.bot, update)
+        except Exception:
+            logger.exception('Update %s failed', update.get('update_id'))
+
+    def _forget(self, chat_key: int, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if self._tails.get(chat_key) is task:
+            del self._tails[chat_key]
+
+
+def _worker_main(index: int, queue: multiprocessing.Queue, drain_timeout: float) -> None:
+    # Ctrl+C и SIGTERM приходят всей группе процессов: обработчик останавливает только None из очереди,
+    # который родитель кладёт после того, как перестал принимать обновления
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    polling_bot.setup_logging()
+    config: Config = load_config()
+    # У каждого процесса свои метрики, поэтому и страница /metrics у каждого на своём порту
+    if config.metrics.port:
+        config.metrics.port += index
+    # Прогревает кэш и архивирует историю только первый процесс: база у всех общая
+    if index:
+        config.prewarm.interval = 0
+        config.retention.age = 0
+    bot: Bot = polling_bot.create_bot(config)
+    asyncio.run(_worker_loop(index, queue, bot, drain_timeout))
+
+
+async def _worker_loop(index: int, queue: multiprocessing.Queue, bot: Bot, drain_timeout: float) -> None:
+    feeder = ChatOrderedFeeder(bot)
+    await polling_bot.dp.emit_startup(bot=bot)
+    logger.info('Worker %s started', index)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            item: Optional[tuple[int, dict[str, Any]]] = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            feeder.submit(*item)
+    finally:
+        await feeder.drain(drain_timeout)
+        await polling_bot.dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        logger.info('Worker %s stopped', index)
+
+
+class WebhookServer:
+
+    def __init__(self, config: Config, settings: WebhookSettings, bot: Optional[Bot] = None):
+        self.config = config
+        self.settings = settings
+        self.bot: Optional[Bot] = bot
+        self.feeder: Optional[ChatOrderedFeeder] = None
+        self.queues: list[multiprocessing.Queue] = []
+        self.workers: list[multiprocessing.Process] = []
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.settings.path, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+    async def on_startup(self, _: web.Application) -> None:
+        if self.settings.workers > 1:
+            self._start_workers()
+            self.bot = Bot(token=self.config.tg_bot.token)
+        else:
+            self.feeder = ChatOrderedFeeder(self.bot)
+            await polling_bot.dp.emit_startup(bot=self.bot)
+        await self.bot.set_webhook(self.settings.base_url.rstrip('/') + self.settings.path,
+                                   secret_token=self.settings.secret or None)
+        logger.info('Webhook server started with %s worker(s)', self.settings.workers)
+
+    async def on_shutdown(self, _: web.Application) -> None:
+        if self.feeder is not None:
+            await self.feeder.drain(self.settings.drain_timeout)
+            await polling_bot.dp.emit_shutdown(bot=self.bot)
+        else:
+            await self._stop_workers()
+        await self.bot.session.close()
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.settings.secret and not secrets.compare_digest(request.headers.get(_secret_header, ''),
+                                                               self.settings.secret):
+            return web.Response(status=401)
+        try:
+            update: dict[str, Any] = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        chat_key: int = get_chat_key(update)
+        if self.feeder is not None:
+            self.feeder.submit(chat_key, update)
+        else:
+            self.queues[chat_key % len(self.queues)].put((chat_key, update))
+        return web.json_response({})
+
+    async def handle_health(self, _: web.Request) -> web.Response:
+        if self.feeder is not None:
+            return web.json_response({'status': 'ok', 'in_flight': self.feeder.in_flight()})
+        alive: list[bool] = [worker.is_alive() for worker in self.workers]
+        return web.json_response({'status': 'ok' if all(alive) else 'degraded', 'workers': alive},
+                                 status=200 if all(alive) else 503)
+
+    def _start_workers(self) -> None:
+        context = multiprocessing.get_context('spawn')
+        for index in range(self.settings.workers):
+            queue: multiprocessing.Queue = context.Queue()
+            worker = context.Process(target=_worker_main, args=(index, queue, self.settings.drain_timeout),
+                                     name=f'cinemabot-worker-{index}')
+            worker.start()
+            self.queues.append(queue)
+            self.workers.append(worker)
+
+    async def _stop_workers(self) -> None:
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.join, self.settings.drain_timeout + 5)
+            if worker.is_alive():
+                # SIGTERM обработчик игнорирует
+                logger.error('Worker %s did not stop in time, killing', worker.name)
+                worker.kill()
+
+
+# Запускаем веб-сервер для режима webhook; для разработки по-прежнему можно запускать bot.py
+if __name__ == '__main__':
+    polling_bot.setup_logging()
+    env = Env()
+    env.read_env()
+    webhook_settings: WebhookSettings = load_webhook_settings(env)
+    config: Config = load_config()
+    # В однопроцессном режиме бот собирается здесь, в многопроцессном - в каждом обработчике
+    server = WebhookServer(config, webhook_settings,
+                           polling_bot.create_bot(config) if webhook_settings.workers == 1 else None)
+    web.run_app(server.create_app(), host=webhook_settings.host, port=webhook_settings.port,
+                shutdown_timeout=webhook_settings.drain_timeout)
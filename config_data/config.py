@@ -1,19 +1,8 @@
-from dataclasses import dataclass
-
 from environs import Env
 
-
-@dataclass
-class TgBot:
-    token: str          # Токен для доступа к телеграм-боту
-    database_path: str  # Путь к базе данных SQL Lite
-    kp_unofficial_api_key: str # Ключ для неофициального API Кинопоиск
-    tmpdb_api_key: str  # Ключ для API TMPDB
-    serp_api_key: str   # Ключ для SERP API
-
-@dataclass
-class Config:
-    tg_bot: TgBot
+from config_data.settings import TgBot, WebhookSettings, Config, HttpSettings, SearchDeadlines, CacheSettings, \
+    WriteBehindSettings, ProviderLimits, BreakerSettings, SharedCacheSettings, IndexSettings, InlineSettings, \
+    BatchSettings, SchedulerSettings, MetricsSettings, PrewarmSettings, RetentionSettings, LifecycleSettings
 
 
 # Создаем функцию, которая будет читать файл .env и возвращать
@@ -23,11 +12,219 @@ def load_config(path: str | None = None) -> Config:
     env.read_env(path)
     return Config(
         tg_bot=TgBot(
-            token=env('BOT_TOKEN'),
+            # TELEGRAM_API_KEY - имя переменной из старого bot_run.py, оставляем для совместимости
+            token=env('BOT_TOKEN', None) or env('TELEGRAM_API_KEY'),
             database_path=env('DATABASE_PATH'),
             kp_unofficial_api_key=env('KP_UNOFFICIAL_API_KEY'),
             tmpdb_api_key=env('TMDB_API_KEY'),
             serp_api_key=env('SERP_API_KEY')
 
+        ),
+        http=load_http_settings(env),
+        deadlines=load_search_deadlines(env),
+        cache=load_cache_settings(env),
+        history_writes=load_write_behind_settings(env),
+        providers=load_provider_limits(env),
+        breakers=load_breaker_settings(env),
+        shared_cache=load_shared_cache_settings(env),
+        index=load_index_settings(env),
+        inline=load_inline_settings(env),
+        batch=load_batch_settings(env),
+        scheduler=load_scheduler_settings(env),
+        metrics=load_metrics_settings(env),
+        prewarm=load_prewarm_settings(env),
+        retention=load_retention_settings(env),
+        lifecycle=load_lifecycle_settings(env),
+        redis_url=env('REDIS_URL', None)
+    )
+
+
+# Настройки пула HTTP-соединений, все поля необязательны
+def load_http_settings(env: Env) -> HttpSettings:
+    return HttpSettings(
+        limit=env.int('HTTP_LIMIT', 100),
+        limit_per_host=env.int('HTTP_LIMIT_PER_HOST', 20),
+        keepalive_timeout=env.float('HTTP_KEEPALIVE_TIMEOUT', 30.0),
+        dns_cache_ttl=env.int('HTTP_DNS_CACHE_TTL', 300),
+        connect_timeout=env.float('HTTP_CONNECT_TIMEOUT', 3.0),
+        read_timeout=env.float('HTTP_READ_TIMEOUT', 10.0),
+        total_timeout=env.float('HTTP_TOTAL_TIMEOUT', 15.0)
+    )
+
+
+# Дедлайны стадий поиска, все поля необязательны
+def load_search_deadlines(env: Env) -> SearchDeadlines:
+    return SearchDeadlines(
+        engines=env.float('SEARCH_ENGINES_DEADLINE', 5.0),
+        links=env.float('SEARCH_LINKS_DEADLINE', 4.0),
+        hedge=env.bool('SEARCH_HEDGE', False),
+        progressive=env.bool('SEARCH_PROGRESSIVE', True),
+        progressive_grace=env.float('SEARCH_PROGRESSIVE_GRACE', 0.3)
+    )
+
+
+# Настройки кэша результатов поиска, все поля необязательны
+def load_cache_settings(env: Env) -> CacheSettings:
+    return CacheSettings(
+        memory_size=env.int('CACHE_MEMORY_SIZE', 1024),
+        ttl=env.float('CACHE_TTL', 24 * 60 * 60),
+        negative_ttl=env.float('CACHE_NEGATIVE_TTL', 10 * 60),
+        link_ttl=env.float('CACHE_LINK_TTL', 3 * 24 * 60 * 60),
+        link_max_stale=env.float('CACHE_LINK_MAX_STALE', 60 * 24 * 60 * 60),
+        poster_ttl=env.float('CACHE_POSTER_TTL', 30 * 24 * 60 * 60)
+    )
+
+
+# Настройки отложенной пакетной записи истории, все поля необязательны
+def load_write_behind_settings(env: Env) -> WriteBehindSettings:
+    return WriteBehindSettings(
+        batch_size=env.int('HISTORY_BATCH_SIZE', 100),
+        flush_interval=env.float('HISTORY_FLUSH_INTERVAL', 1.0),
+        max_queue=env.int('HISTORY_MAX_QUEUE', 10000),
+        drain_timeout=env.float('HISTORY_DRAIN_TIMEOUT', 10.0),
+        read_wait=env.float('HISTORY_READ_WAIT', 1.0)
+    )
+
+
+# Квоты внешних API по умолчанию: Кинопоиск ~20 запросов/с, TMDB ~40 запросов/с,
+# SerpAPI тарифицируется поштучно, поэтому держим его скромнее
+_default_provider_limits: dict[str, ProviderLimits] = {
+    'kinopoisk': ProviderLimits(rate=20, burst=20),
+    'tmdb': ProviderLimits(rate=40, burst=40),
+    'serpapi': ProviderLimits(rate=5, burst=5),
+}
+
+
+# Лимиты на каждого провайдера, переменные вида KINOPOISK_RATE, TMDB_MAX_WAIT и т.д.
+def load_provider_limits(env: Env) -> dict[str, ProviderLimits]:
+    result: dict[str, ProviderLimits] = {}
+    for name, defaults in _default_provider_limits.items():
+        prefix: str = name.upper()
+        result[name] = ProviderLimits(
+            rate=env.float(f'{prefix}_RATE', defaults.rate),
+            burst=env.int(f'{prefix}_BURST', defaults.burst),
+            max_wait=env.float(f'{prefix}_MAX_WAIT', defaults.max_wait),
+            retries=env.int(f'{prefix}_RETRIES', defaults.retries),
+            backoff=env.float(f'{prefix}_BACKOFF', defaults.backoff),
+            max_backoff=env.float(f'{prefix}_MAX_BACKOFF', defaults.max_backoff)
         )
-    )
\ No newline at end of file
+    return result
+
+
+# Настройки предохранителей для поисковых движков, все поля необязательны
+def load_breaker_settings(env: Env) -> BreakerSettings:
+    return BreakerSettings(
+        window=env.int('BREAKER_WINDOW', 20),
+        min_calls=env.int('BREAKER_MIN_CALLS', 5),
+        error_rate=env.float('BREAKER_ERROR_RATE', 0.5),
+        slow_call=env.float('BREAKER_SLOW_CALL', 4.0),
+        open_timeout=env.float('BREAKER_OPEN_TIMEOUT', 30.0)
+    )
+
+
+# Настройки общего для всех узлов кэша в Redis, все поля необязательны
+def load_shared_cache_settings(env: Env) -> SharedCacheSettings:
+    return SharedCacheSettings(
+        prefix=env('SHARED_CACHE_PREFIX', 'cinemabot:v1'),
+        lock_ttl=env.float('SHARED_CACHE_LOCK_TTL', 15.0),
+        lock_wait=env.float('SHARED_CACHE_LOCK_WAIT', 5.0),
+        poll_interval=env.float('SHARED_CACHE_POLL_INTERVAL', 0.1)
+    )
+
+
+# Настройки локального индекса фильмов, все поля необязательны
+def load_index_settings(env: Env) -> IndexSettings:
+    return IndexSettings(
+        min_score=env.float('INDEX_MIN_SCORE', 0.85),
+        candidates=env.int('INDEX_CANDIDATES', 20),
+        max_trigrams=env.int('INDEX_MAX_TRIGRAMS', 32),
+        max_age=env.float('INDEX_MAX_AGE', 7 * 24 * 60 * 60)
+    )
+
+
+# Настройки inline-режима, все поля необязательны
+def load_inline_settings(env: Env) -> InlineSettings:
+    return InlineSettings(
+        debounce=env.float('INLINE_DEBOUNCE', 0.3),
+        deadline=env.float('INLINE_DEADLINE', 1.5),
+        results=env.int('INLINE_RESULTS', 5),
+        min_query=env.int('INLINE_MIN_QUERY', 3),
+        upstream_limit=env.int('INLINE_UPSTREAM_LIMIT', 4),
+        cache_time=env.int('INLINE_CACHE_TIME', 300)
+    )
+
+
+# Настройки пакетного поиска по списку названий, все поля необязательны
+def load_batch_settings(env: Env) -> BatchSettings:
+    return BatchSettings(
+        max_titles=env.int('BATCH_MAX_TITLES', 50),
+        concurrency=env.int('BATCH_CONCURRENCY', 3),
+        global_concurrency=env.int('BATCH_GLOBAL_CONCURRENCY', 6),
+        send_interval=env.float('BATCH_SEND_INTERVAL', 1.0),
+        max_file_size=env.int('BATCH_MAX_FILE_SIZE', 64 * 1024)
+    )
+
+
+# Настройки планировщика обновлений, все поля необязательны
+def load_scheduler_settings(env: Env) -> SchedulerSettings:
+    return SchedulerSettings(
+        concurrency=env.int('SCHEDULER_CONCURRENCY', 16),
+        priority_concurrency=env.int('SCHEDULER_PRIORITY_CONCURRENCY', 32),
+        max_queue=env.int('SCHEDULER_MAX_QUEUE', 100),
+        max_chat_queue=env.int('SCHEDULER_MAX_CHAT_QUEUE', 5),
+        batch_concurrency=env.int('SCHEDULER_BATCH_CONCURRENCY', 4),
+        batch_max_queue=env.int('SCHEDULER_BATCH_MAX_QUEUE', 20)
+    )
+
+
+# Настройки метрик и трассировки запросов, все поля необязательны
+def load_metrics_settings(env: Env) -> MetricsSettings:
+    return MetricsSettings(
+        host=env('METRICS_HOST', '127.0.0.1'),
+        port=env.int('METRICS_PORT', 9100),
+        trace_sample=env.float('METRICS_TRACE_SAMPLE', 0.0)
+    )
+
+
+# Настройки фонового прогрева кэша популярными запросами, все поля необязательны
+def load_prewarm_settings(env: Env) -> PrewarmSettings:
+    return PrewarmSettings(
+        interval=env.float('PREWARM_INTERVAL', 15 * 60),
+        top=env.int('PREWARM_TOP', 100),
+        window=env.float('PREWARM_WINDOW', 7 * 24 * 60 * 60),
+        half_life=env.float('PREWARM_HALF_LIFE', 24 * 60 * 60),
+        ahead=env.float('PREWARM_AHEAD', 2 * 60 * 60),
+        quota_share=env.float('PREWARM_QUOTA_SHARE', 0.2)
+    )
+
+
+# Настройки архивации старой истории и сжатия базы, все поля необязательны
+def load_retention_settings(env: Env) -> RetentionSettings:
+    return RetentionSettings(
+        age=env.float('HISTORY_RETENTION_AGE', 180 * 24 * 60 * 60),
+        interval=env.float('HISTORY_RETENTION_INTERVAL', 60 * 60),
+        batch=env.int('HISTORY_RETENTION_BATCH', 2000),
+        vacuum_pages=env.int('HISTORY_VACUUM_PAGES', 256),
+        pause=env.float('HISTORY_RETENTION_PAUSE', 0.2)
+    )
+
+
+# Настройки запуска и остановки бота, все поля необязательны
+def load_lifecycle_settings(env: Env) -> LifecycleSettings:
+    return LifecycleSettings(
+        warm_up=env.bool('STARTUP_WARM_UP', True),
+        shutdown_timeout=env.float('SHUTDOWN_TIMEOUT', 25.0)
+    )
+
+
+# Настройки режима webhook, нужны только для bot_webhook.py
+def load_webhook_settings(env: Env) -> WebhookSettings:
+    return WebhookSettings(
+        base_url=env('WEBHOOK_BASE_URL'),
+        path=env('WEBHOOK_PATH', '/webhook'),
+        secret=env('WEBHOOK_SECRET', ''),
+        host=env('WEBHOOK_HOST', '0.0.0.0'),
+        port=env.int('PORT', 8080),
+        workers=env.int('WEBHOOK_WORKERS', 1),
+        drain_timeout=env.float('WEBHOOK_DRAIN_TIMEOUT', 10.0)
+    )
@@ -0,0 +1,182 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+# Настройки всех частей бота. Модули core получают их отсюда, а config.py заполняет их из переменных окружения
+
+
+@dataclass
+class TgBot:
+    token: str          # Токен для доступа к телеграм-боту
+    database_path: str  # Путь к базе данных SQL Lite
+    kp_unofficial_api_key: str # Ключ для неофициального API Кинопоиск
+    tmpdb_api_key: str  # Ключ для API TMPDB
+    serp_api_key: str   # Ключ для SERP API
+
+@dataclass
+class WebhookSettings:
+    base_url: str        # Публичный адрес бота, например https://cinemabot.herokuapp.com
+    path: str            # Путь, на который Telegram присылает обновления
+    secret: str          # Секрет, который Telegram кладёт в X-Telegram-Bot-Api-Secret-Token
+    host: str            # Адрес, на котором слушает веб-сервер
+    port: int            # Порт веб-сервера
+    workers: int         # Сколько процессов обрабатывают обновления
+    drain_timeout: float # Сколько ждём обработки уже принятых обновлений при остановке, секунды
+
+
+@dataclass
+class HttpSettings:
+    limit: int = 100                  # Всего соединений в пуле
+    limit_per_host: int = 20          # Соединений на один upstream
+    keepalive_timeout: float = 30.0   # Сколько держать простаивающее соединение
+    dns_cache_ttl: int = 300          # Время жизни кэша DNS, секунды
+    connect_timeout: float = 3.0
+    read_timeout: float = 10.0
+    total_timeout: float = 15.0
+
+
+@dataclass
+class SearchDeadlines:
+    engines: float = 5.0   # Сколько ждём ответов Кинопоиска и TMDB, секунды
+    links: float = 4.0     # Сколько ждём ссылок на онлайн-кинотеатры, секунды
+    hedge: bool = False    # Не ждать основной движок дольше его p95, если другой уже ответил
+    progressive: bool = True  # Сразу отправлять баннер и дописывать в него ссылки по мере их нахождения
+    progressive_grace: float = 0.3  # Сколько ждём ссылок до отправки заглушки; успели все - баннер без правок, секунды
+
+
+@dataclass
+class CacheSettings:
+    memory_size: int = 1024       # Сколько запросов держим в памяти процесса
+    ttl: float = 24 * 60 * 60     # Время жизни найденного фильма, секунды
+    negative_ttl: float = 10 * 60  # Время жизни пустого ответа, секунды
+    link_ttl: float = 3 * 24 * 60 * 60         # Сколько ссылка на кинотеатр считается свежей, секунды
+    link_max_stale: float = 60 * 24 * 60 * 60  # Дольше этого устаревшую ссылку не отдаём, секунды
+    poster_ttl: float = 30 * 24 * 60 * 60      # Сколько держим file_id постера в Telegram, секунды
+
+
+@dataclass
+class WriteBehindSettings:
+    batch_size: int = 100         # Сколько записей истории пишем одной транзакцией
+    flush_interval: float = 1.0   # Сколько максимум ждём набора пачки, секунды
+    max_queue: int = 10000        # Размер очереди, при переполнении запросы ждут
+    drain_timeout: float = 10.0   # Сколько ждём записи очереди при остановке, секунды
+    read_wait: float = 1.0        # Сколько чтение истории ждёт записи принятых до него поисков, секунды
+
+
+@dataclass
+class ProviderLimits:
+    rate: float = 5.0           # Сколько запросов в секунду разрешает квота
+    burst: int = 5              # Сколько запросов можно сделать разом
+    max_wait: float = 3.0       # Дольше этого в очереди к провайдеру не стоим, секунды
+    retries: int = 2            # Сколько раз повторяем запрос после 429/5xx/сетевой ошибки
+    backoff: float = 0.5        # Базовая задержка перед повтором, секунды
+    max_backoff: float = 8.0    # Максимальная задержка перед повтором, секунды
+
+
+@dataclass
+class BreakerSettings:
+    window: int = 20             # По скольким последним вызовам считаем долю ошибок
+    min_calls: int = 5           # Меньше вызовов в окне - не размыкаемся
+    error_rate: float = 0.5      # Доля ошибок и медленных вызовов, при которой размыкаемся
+    slow_call: float = 4.0       # Вызов дольше этого считается ошибкой, секунды
+    open_timeout: float = 30.0   # Сколько держим цепь разомкнутой до пробного вызова, секунды
+
+
+@dataclass
+class SharedCacheSettings:
+    prefix: str = 'cinemabot:v1'  # Префикс ключей; меняем при несовместимой смене формата
+    lock_ttl: float = 15.0        # Через сколько секунд блокировка упавшего узла снимается сама
+    lock_wait: float = 5.0        # Сколько ждём результата от узла, держащего блокировку, секунды
+    poll_interval: float = 0.1    # Как часто проверяем, не появился ли результат, секунды
+
+
+@dataclass
+class IndexSettings:
+    min_score: float = 0.85   # Минимальная похожесть названия на запрос, от 0 до 1
+    candidates: int = 20      # Сколько кандидатов из FTS5 сравниваем с запросом
+    max_trigrams: int = 32    # Сколько триграмм запроса отдаём в FTS5
+    max_age: float = 7 * 24 * 60 * 60  # Дольше этого полной записи от движка не отвечаем, а обновляем её, секунды
+
+
+@dataclass
+class InlineSettings:
+    debounce: float = 0.3       # Сколько ждём следующей буквы, прежде чем искать, секунды
+    deadline: float = 1.5       # Сколько ждём движки, если в индексе ничего не нашлось, секунды
+    results: int = 5            # Сколько фильмов показываем в подсказке
+    min_query: int = 3          # Короче этого к провайдерам не идём, только в индекс
+    upstream_limit: int = 4     # Сколько inline-запросов одновременно могут идти к провайдерам
+    cache_time: int = 300       # Сколько Telegram кэширует ответ на одинаковый запрос, секунды
+
+
+@dataclass
+class BatchSettings:
+    max_titles: int = 50            # Больше названий за раз не ищем
+    concurrency: int = 3            # Сколько названий одного списка ищем одновременно
+    global_concurrency: int = 6     # Сколько названий из всех списков ищем одновременно, чтобы не мешать /search
+    send_interval: float = 1.0      # Пауза между сообщениями с результатами, секунды (ограничение Telegram для групп)
+    max_file_size: int = 64 * 1024  # Максимальный размер файла со списком, байты
+
+
+@dataclass
+class SchedulerSettings:
+    concurrency: int = 16           # Сколько поисков выполняется одновременно во всех чатах
+    priority_concurrency: int = 32  # Сколько лёгких команд (/start, /help, /history, /stats) выполняется одновременно
+    max_queue: int = 100            # Сколько поисков может ждать очереди, дальше отвечаем "занят"
+    max_chat_queue: int = 5         # Сколько обновлений одного чата может ждать очереди
+    batch_concurrency: int = 4      # Сколько списков названий обрабатывается одновременно, отдельно от поисков
+    batch_max_queue: int = 20       # Сколько списков может ждать очереди, дальше отвечаем "занят"
+
+
+@dataclass
+class MetricsSettings:
+    host: str = '127.0.0.1'      # Адрес страницы /metrics; наружу её не открываем
+    port: int = 9100             # 0 - не поднимать страницу /metrics
+    trace_sample: float = 0.0    # Доля запросов, для которых пишем в лог разбивку по стадиям, от 0 до 1
+
+
+@dataclass
+class PrewarmSettings:
+    interval: float = 15 * 60         # Как часто прогреваем кэш, секунды; 0 - не прогревать
+    top: int = 100                    # Сколько самых популярных запросов держим прогретыми
+    window: float = 7 * 24 * 60 * 60  # За какой период смотрим историю, секунды
+    half_life: float = 24 * 60 * 60   # Через сколько вес поиска в истории падает вдвое, секунды
+    ahead: float = 2 * 60 * 60        # Обновляем записи, которые устареют раньше этого, секунды
+    quota_share: float = 0.2          # Какую долю квоты каждого провайдера можно тратить на прогрев
+    idle_poll: float = 1.0            # Пока поиски пользователей ждут в очереди, прогрев стоит; шаг проверки, секунды
+
+
+@dataclass
+class RetentionSettings:
+    age: float = 180 * 24 * 60 * 60  # Поиски старше этого уходят из history в архив, секунды; 0 - не архивировать
+    interval: float = 60 * 60        # Как часто проверяем историю, секунды
+    batch: int = 2000                # Сколько поисков переносим одной транзакцией
+    vacuum_pages: int = 256          # Сколько свободных страниц возвращаем файловой системе за один шаг
+    pause: float = 0.2               # Пауза между шагами, чтобы не занимать соединение с базой надолго, секунды
+    idle_poll: float = 1.0           # Пока поиски пользователей ждут в очереди, обслуживание стоит; шаг проверки, секунды
+
+
+@dataclass
+class LifecycleSettings:
+    warm_up: bool = True            # Сразу при старте прогреть кэш популярными запросами, не блокируя запуск
+    shutdown_timeout: float = 25.0  # Сколько после SIGTERM ждём поисков в работе и записи истории, секунды
+
+
+@dataclass
+class Config:
+    tg_bot: TgBot
+    http: HttpSettings
+    deadlines: SearchDeadlines
+    cache: CacheSettings
+    history_writes: WriteBehindSettings
+    providers: dict[str, ProviderLimits]
+    breakers: BreakerSettings
+    shared_cache: SharedCacheSettings
+    index: IndexSettings
+    inline: InlineSettings
+    batch: BatchSettings
+    scheduler: SchedulerSettings
+    metrics: MetricsSettings
+    prewarm: PrewarmSettings
+    retention: RetentionSettings
+    lifecycle: LifecycleSettings
+    redis_url: Optional[str]  # Redis для состояний FSM и общего кэша; без него всё хранится в памяти процесса
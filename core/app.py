@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiogram import Bot
+
+from config_data.settings import Config
+
+from .bot_core import BotApiImpl
+from .cache import CachingSearchEngine, CachingScrapper, PosterCache
+from .database import BotDatabaseImpl
+from .http import HttpClient
+from .metrics import Metrics, MetricsServer, InstrumentedBot, InstrumentedDatabase, InstrumentedScrapper, \
+    InstrumentedSearchEngine
+from .movie_index import MovieIndex, IndexedSearchEngine
+from .prewarm import Prewarmer
+from .resilience import CircuitBreaker, CircuitBreakerSearchEngine
+from .retention import HistoryRetention
+from .scheduling import SchedulingBotApi
+from .scrapper import GoogleRestScrapper
+from .search import SearchEngine, KpUnofficialSearchEngine, TmdbSearchEngine
+from .shared_cache import SharedCache, CacheBackend, MemoryCacheBackend, SharedCacheSearchEngine, SharedCacheScrapper
+from .singleflight import CoalescingSearchEngine, CoalescingScrapper
+from .throttling import ProviderScheduler
+from .write_behind import WriteBehindDatabase
+
+logger = logging.getLogger(__name__)
+
+
+# Все части бота, собранные по конфигу. Конструктор ничего не открывает: соединения поднимает start()
+# внутри работающего цикла событий, stop() дожидается принятых обновлений и истории и закрывает их
+class App:
+
+    def __init__(self, config: Config, bot: Bot, cache_backend: Optional[CacheBackend] = None):
+        self.config = config
+        self.bot = bot
+        self.metrics = Metrics(config.metrics)
+        self.metrics_server = MetricsServer(self.metrics)
+        self.storage = BotDatabaseImpl(config.tg_bot.database_path)
+        self.database = WriteBehindDatabase(InstrumentedDatabase(self.storage, self.metrics), config.history_writes)
+        self.http = HttpClient(config.http)
+        schedulers: dict[str, ProviderScheduler] = {
+            name: ProviderScheduler(name, self.http, limits) for name, limits in config.providers.items()
+        }
+        self.upstream_engines: dict[str, SearchEngine] = {
+            'kinopoisk': KpUnofficialSearchEngine(config.tg_bot.kp_unofficial_api_key, schedulers['kinopoisk']),
+            'tmdb': TmdbSearchEngine(config.tg_bot.tmpdb_api_key, schedulers['tmdb']),
+        }
+        self.google = GoogleRestScrapper(config.tg_bot.serp_api_key, schedulers['serpapi'])
+        self.breakers: dict[str, CircuitBreaker] = {
+            name: CircuitBreaker(name, config.breakers) for name in self.upstream_engines
+        }
+        # Без Redis общий кэш живёт в памяти процесса, как при единственном экземпляре бота
+        self.shared_cache = SharedCache(cache_backend or MemoryCacheBackend(), config.shared_cache)
+        self.index = MovieIndex(self.database, config.index)
+        self.indexed: dict[str, IndexedSearchEngine] = {
+            name: IndexedSearchEngine(
+                CoalescingSearchEngine(SharedCacheSearchEngine(
+                    CircuitBreakerSearchEngine(InstrumentedSearchEngine(engine, name, self.metrics),
+                                               self.breakers[name]),
+                    name, self.shared_cache, config.cache)),
+                name, self.index)
+            for name, engine in self.upstream_engines.items()
+        }
+        self.engines: dict[str, CachingSearchEngine] = {
+            name: CachingSearchEngine(engine, name, self.database, config.cache) for name, engine in self.indexed.items()
+        }
+        self.scrapper = CachingScrapper(
+            CoalescingScrapper(SharedCacheScrapper(InstrumentedScrapper(self.google, 'serpapi', self.metrics),
+                                                   self.shared_cache, config.cache)),
+            self.database, config.cache)
+        self.posters = PosterCache(self.database, config.cache)
+        self.core = SchedulingBotApi(
+            BotApiImpl(InstrumentedBot(bot, self.metrics), self.database, self.engines, self.scrapper,
+                       config.deadlines, self.posters, self.index, config.inline, config.batch),
+            config.scheduler, self.metrics)
+        self.prewarmer = Prewarmer(self.database, self.engines, self.scrapper, config.providers, config.prewarm,
+                                   lambda: self.core.searches.waiting > 0)
+        self.retention = HistoryRetention(self.storage, config.retention, lambda: self.core.searches.waiting > 0)
+        self.metrics.export_stats(
+            {**{f'{name}_result': engine for name, engine in self.engines.items()},
+             **{f'{name}_index': engine for name, engine in self.indexed.items()},
+             'links': self.scrapper, 'shared': self.shared_cache, 'posters': self.posters,
+             'prewarm': self.prewarmer, 'retention': self.retention},
+            self.breakers,
+            {'history_pending': self.database.pending, 'searches_waiting': lambda: self.core.searches.waiting,
+             'commands_waiting': lambda: self.core.commands.waiting})
+
+    # База, пул HTTP-соединений и страница метрик поднимаются одновременно
+    async def start(self) -> None:
+        started: float = time.monotonic()
+        await asyncio.gather(self.storage.open(), self.http.start(), self.metrics_server.start())
+        await self.database.start()
+        await self.prewarmer.start(self.config.lifecycle.warm_up)
+        await self.retention.start()
+        logger.info('Started in %.2f s', time.monotonic() - started)
+
+    # Новые обновления к этому моменту уже не приходят: дожидаемся принятых поисков, затем дописываем историю.
+    # Всё вместе укладываем в shutdown_timeout
+    async def stop(self) -> None:
+        deadline: float = time.monotonic() + self.config.lifecycle.shutdown_timeout
+        await asyncio.gather(self.prewarmer.close(), self.retention.close())
+        unfinished: int = await self.core.drain(deadline - time.monotonic())
+        if unfinished:
+            logger.error('Dropping %s updates not handled in %s s', unfinished, self.config.lifecycle.shutdown_timeout)
+        await self.database.close(max(deadline - time.monotonic(), 0.0))
+        await asyncio.gather(self.metrics_server.close(), self.http.close(), self.storage.close())
+        self.log_stats()
+
+    def log_stats(self) -> None:
+        for name, engine in self.indexed.items():
+            logger.info('Cache %s: %s, index=%s, coalesced=%s, breaker=%s', name, self.engines[name].stats,
+                        engine.stats, engine.engine.flight.saved_calls, self.breakers[name].snapshot())
+        logger.info('Cache links: %s, stale=%s, coalesced=%s', self.scrapper.stats, self.scrapper.stale_hits,
+                    self.scrapper.scrapper.flight.saved_calls)
+        logger.info('Shared cache: %s', self.shared_cache.stats)
+        logger.info('Poster file_ids: %s, rejected=%s', self.posters.stats, self.posters.rejected)
+        logger.info('Inline queries: superseded=%s, upstream skipped=%s', self.core.api.inline_superseded,
+                    self.core.api.inline_upstream_skipped)
+        logger.info('Scheduler: searches %s, commands %s, batches %s', self.core.searches.stats,
+                    self.core.commands.stats, self.core.batches.stats)
+        logger.info('Prewarm: %s', self.prewarmer.stats)
+        logger.info('History retention: %s', self.retention.stats)
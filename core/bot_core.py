@@ -1,14 +1,49 @@
+import asyncio
+import hashlib
+import io
+import logging
 from abc import ABC, abstractmethod
+from dataclasses import replace
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Callable
 
 from aiogram import Bot, types
-from .constants import HELP_MESSAGE, START_MESSAGE, UNKNOWN_COMMAND_MESSAGE, RESULT_NONE_MESSAGE
+from aiogram.exceptions import TelegramBadRequest
+from config_data.settings import SearchDeadlines, InlineSettings, BatchSettings
+
+from .constants import HELP_MESSAGE, START_MESSAGE, UNKNOWN_COMMAND_MESSAGE, RESULT_NONE_MESSAGE, \
+    HISTORY_EMPTY_MESSAGE, HISTORY_NEWER_BUTTON, HISTORY_OLDER_BUTTON, LINKS_SEARCH_PLACEHOLDER, \
+    BATCH_TRUNCATED_MESSAGE, BATCH_SUMMARY_MESSAGE, BATCH_NOT_FOUND_MESSAGE, BATCH_EMPTY_MESSAGE, \
+    BATCH_FILE_UNSUPPORTED_MESSAGE
 from .database import BotDatabase
-from .structs import SearchEntity, Movie, Banner, StatsEntity
+from .structs import SearchEntity, Movie, Banner, StatsEntity, IndexedMovie, Candidate
 from .search import SearchEngine
-from .helpers import merge_movies, movie_to_banner, first_non_none
+from .helpers import movie_to_banner, first_non_none, gather_with_deadline, movie_key, get_query, split_titles
 from .scrapper import Scrapper
+from .progressive import ProgressiveReply
+from .cache import PosterCache
+from .movie_index import MovieIndex, dump_source
+from .matching import merge_answers, match_candidates
+from .throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+# Сначала собираем выдачу всех движков и сопоставляем её, затем запрашиваем подробности только у тех,
+# кто нашёл выбранный фильм. Обе фазы укладываем в общий timeout. Через эту же функцию идёт прогрев кэша,
+# чтобы под запросом в кэше оказался тот же фильм, который получил бы пользователь
+async def search_across(engines: dict[str, SearchEngine], query: str, timeout: Optional[float],
+                        hedge_after: Optional[float] = None) -> Optional[Movie]:
+    loop = asyncio.get_running_loop()
+    deadline: Optional[float] = loop.time() + timeout if timeout is not None else None
+    candidates = await gather_with_deadline(
+        {name: engine.search_candidates(query) for name, engine in engines.items()}, timeout, hedge_after)
+    chosen: dict[str, Optional[Candidate]] = match_candidates(
+        query, {name: items or [] for name, items in candidates.items()})
+    answers = await gather_with_deadline(
+        {name: engines[name].get_movie(query, candidate) for name, candidate in chosen.items() if candidate is not None},
+        max(deadline - loop.time(), 0.0) if deadline is not None else None)
+    return merge_answers(list(answers.values()))
 
 
 class BotApi(ABC):
@@ -28,6 +63,10 @@ class BotApi(ABC):
     async def process_history_command(self, message: types.Message) -> None:
         pass
 
+    @abstractmethod
+    async def process_history_callback(self, callback: types.CallbackQuery) -> None:
+        pass
+
     @abstractmethod
     async def process_stats_command(self, message: types.Message) -> None:
         pass
@@ -36,6 +75,14 @@ class BotApi(ABC):
     async def process_search_command(self, message: types.Message) -> None:
         pass
 
+    @abstractmethod
+    async def process_search_file(self, message: types.Message) -> None:
+        pass
+
+    @abstractmethod
+    async def process_inline_query(self, inline_query: types.InlineQuery) -> None:
+        pass
+
     @abstractmethod
     async def process_unknown_command(self, message: types.Message) -> None:
         pass
@@ -43,12 +90,27 @@ class BotApi(ABC):
 
 class BotApiImpl(BotApi):
     sites_to_watch_online: list[str] = ["kinogo.biz", "rezka.ag"]
+    history_page_size: int = 10
+    history_callback_prefix: str = 'history'
 
-    def __init__(self, bot: Bot, database: BotDatabase, engines: dict[str, SearchEngine], scrapper: Scrapper):
+    def __init__(self, bot: Bot, database: BotDatabase, engines: dict[str, SearchEngine], scrapper: Scrapper,
+                 deadlines: Optional[SearchDeadlines] = None, posters: Optional[PosterCache] = None,
+                 index: Optional[MovieIndex] = None, inline: Optional[InlineSettings] = None,
+                 batch: Optional[BatchSettings] = None):
         self.bot = bot
         self.database = database
         self.engines = engines
         self.scrapper = scrapper
+        self.deadlines = deadlines or SearchDeadlines()
+        self.posters = posters
+        self.index = index
+        self.inline = inline or InlineSettings()
+        self.inline_superseded: int = 0
+        self.inline_upstream_skipped: int = 0
+        self._inline_queries: dict[int, asyncio.Task] = {}
+        self._inline_upstream = asyncio.Semaphore(self.inline.upstream_limit)
+        self.batch = batch or BatchSettings()
+        self._batch_slots = asyncio.Semaphore(self.batch.global_concurrency)
 
     async def process_start_command(self, message: types.Message) -> None:
         await self.bot.send_message(message.chat.id, START_MESSAGE)
@@ -57,45 +119,287 @@ class BotApiImpl(BotApi):
         await self.bot.send_message(message.chat.id, HELP_MESSAGE)
 
     async def process_history_command(self, message: types.Message) -> None:
-        history: list[SearchEntity] = await self.database.load_search_entities(message.chat.id)
-        result = '\n'.join(reversed([self._search_entity_to_str(item) for item in history]))
-        await self.bot.send_message(message.chat.id, result)
+        page, has_newer, has_older = await self._load_history_page(message.chat.id)
+        if not page:
+            await self.bot.send_message(message.chat.id, HISTORY_EMPTY_MESSAGE)
+            return
+        await self.bot.send_message(message.chat.id, self._history_page_to_str(page),
+                                    reply_markup=self._history_keyboard(page, has_newer, has_older))
+
+    async def process_history_callback(self, callback: types.CallbackQuery) -> None:
+        # Сообщение слишком старое или отправлено в inline-режиме: листать нечего, только снимаем часики с кнопки
+        if callback.message is None:
+            await self.bot.answer_callback_query(callback.id)
+            return
+        _, direction, search_time, row_id = callback.data.split(':')
+        position: tuple[int, int] = (int(search_time), int(row_id))
+        chat_id = callback.message.chat.id
+        if direction == 'older':
+            page, has_newer, has_older = await self._load_history_page(chat_id, before=position)
+        else:
+            page, has_newer, has_older = await self._load_history_page(chat_id, after=position)
+        if page:
+            await self.bot.edit_message_text(self._history_page_to_str(page), chat_id, callback.message.message_id,
+                                             reply_markup=self._history_keyboard(page, has_newer, has_older))
+        await self.bot.answer_callback_query(callback.id)
 
     async def process_stats_command(self, message: types.Message) -> None:
         stats: list[StatsEntity] = await self.database.load_stats_entities(message.chat.id)
-        stats = sorted(stats, key=lambda item: -item.count)
         result = '\n'.join([self._stats_entity_to_str(item) for item in stats])
         await self.bot.send_message(message.chat.id, result)
 
     async def process_search_command(self, message: types.Message) -> None:
-        result: Optional[Movie] = None
-        result_kp: Optional[Movie] = await self.engines['kinopoisk'].search_movie(message.get_args())
-        result_tmdb: Optional[Movie] = await self.engines['tmdb'].search_movie(message.get_args())
-        if not result_kp:
-            if not result_tmdb:
-                await self.bot.send_message(message.chat.id, RESULT_NONE_MESSAGE)
-                return
-        if result_kp and result_tmdb and result_kp.id_imdb == result_tmdb.id_imdb:
-            result = merge_movies([result_kp, result_tmdb])
-        else:
-            result = first_non_none([result_kp, result_tmdb])
+        query: str = get_query(message)
+        titles: list[str] = split_titles(query)
+        if len(titles) > 1:
+            await self._search_batch(message.chat.id, titles)
+            return
+        result: Optional[Movie] = await self._search_movie(query)
         if result is None:
             await self.bot.send_message(message.chat.id, RESULT_NONE_MESSAGE)
             return
-        result.links_to_watch = [await self.scrapper.get_top_link(result.title, site) for site in
-                                 self.sites_to_watch_online]
-        banner: Banner = movie_to_banner(result)
-        if banner.picture:
-            await self.bot.send_photo(message.chat.id, banner.picture, caption=banner.text, parse_mode='Markdown')
+        if self.deadlines.progressive:
+            await self._reply_progressively(message.chat.id, result)
         else:
-            await self.bot.send_message(message.chat.id, banner.text, parse_mode='Markdown')
-        search_entity = SearchEntity(message.chat.id, message.get_args(), result.title, datetime.now(), result.id_kp,
+            result.links_to_watch = await self._search_links(result)
+            await self._send_banner(message.chat.id, movie_to_banner(result), movie_key(result))
+        search_entity = SearchEntity(message.chat.id, query, result.title, datetime.now(), result.id_kp,
                                      result.id_tmdb)
         await self.database.save_search_entity(search_entity)
 
+    async def process_search_file(self, message: types.Message) -> None:
+        document = message.document
+        is_text: bool = (document.mime_type or '').startswith('text/') or (document.file_name or '').endswith('.txt')
+        if not is_text or (document.file_size or 0) > self.batch.max_file_size:
+            await self.bot.send_message(message.chat.id, BATCH_FILE_UNSUPPORTED_MESSAGE.format(
+                size=self.batch.max_file_size // 1024), parse_mode=None)
+            return
+        titles: list[str] = split_titles((await self._download(document.file_id)).decode('utf-8', 'replace'))
+        if not titles:
+            await self.bot.send_message(message.chat.id, BATCH_EMPTY_MESSAGE, parse_mode=None)
+            return
+        await self._search_batch(message.chat.id, titles)
+
+    # Inline-запросы приходят на каждую букву: отвечаем только на последний запрос пользователя,
+    # предыдущие отменяем, пока они ждут паузы в наборе
+    async def process_inline_query(self, inline_query: types.InlineQuery) -> None:
+        user_id: int = inline_query.from_user.id
+        previous: Optional[asyncio.Task] = self._inline_queries.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task: asyncio.Task = asyncio.ensure_future(self._answer_inline_query(inline_query))
+        self._inline_queries[user_id] = task
+        try:
+            await task
+        except asyncio.CancelledError:
+            if self._inline_queries.get(user_id) is task:
+                raise
+            self.inline_superseded += 1
+        finally:
+            if self._inline_queries.get(user_id) is task:
+                del self._inline_queries[user_id]
+
     async def process_unknown_command(self, message: types.Message) -> None:
         await message.reply(UNKNOWN_COMMAND_MESSAGE)
 
+    async def _answer_inline_query(self, inline_query: types.InlineQuery) -> None:
+        await asyncio.sleep(self.inline.debounce)
+        movies: list[Movie] = await self._inline_movies(inline_query.query)
+        await self.bot.answer_inline_query(inline_query.id, [self._inline_result(movie) for movie in movies],
+                                           cache_time=self.inline.cache_time)
+
+    # Сначала локальный индекс; к движкам (через все кэши) идём, только если в индексе нет готового фильма,
+    # и не больше upstream_limit запросов разом
+    async def _inline_movies(self, query: str) -> list[Movie]:
+        query = query.strip()
+        entries: list[IndexedMovie] = []
+        if self.index is not None and query:
+            entries = await self.index.complete(query, list(self.engines) + [dump_source], self.inline.results)
+        movies: list[Movie] = [entry.movie for entry in entries]
+        if len(query) < self.inline.min_query or any(self.index.is_fresh(entry) for entry in entries):
+            return movies
+        if self._inline_upstream.locked():
+            self.inline_upstream_skipped += 1
+            return movies
+        async with self._inline_upstream:
+            try:
+                movie: Optional[Movie] = await asyncio.wait_for(self._search_movie(query), self.inline.deadline)
+            except asyncio.TimeoutError:
+                movie = None
+        if movie is not None:
+            movies = [movie] + [item for item in movies if movie_key(item) != movie_key(movie)]
+        return movies[:self.inline.results]
+
+    @staticmethod
+    def _inline_result(movie: Movie) -> types.InlineQueryResultArticle:
+        return types.InlineQueryResultArticle(
+            id=hashlib.sha1(movie_key(movie).encode()).hexdigest(),
+            title=movie.title or movie.original_title or '',
+            description=(movie.original_title if movie.original_title != movie.title else None)
+                        or (movie.description or '')[:100] or None,
+            thumbnail_url=movie.poster,
+            input_message_content=types.InputTextMessageContent(message_text=movie_to_banner(movie).text,
+                                                                parse_mode='Markdown'))
+
+    async def _load_history_page(self, chat_id: int, before: Optional[tuple[int, int]] = None,
+                                 after: Optional[tuple[int, int]] = None) -> tuple[list[SearchEntity], bool, bool]:
+        size: int = self.history_page_size
+        page: list[SearchEntity] = await self.database.load_search_page(chat_id, size + 1, before, after)
+        if after is not None:
+            return page[-size:], len(page) > size, True
+        return page[:size], before is not None, len(page) > size
+
+    def _history_keyboard(self, page: list[SearchEntity], has_newer: bool,
+                          has_older: bool) -> Optional[types.InlineKeyboardMarkup]:
+        buttons: list[types.InlineKeyboardButton] = []
+        if has_newer:
+            buttons.append(types.InlineKeyboardButton(
+                text=HISTORY_NEWER_BUTTON, callback_data=self._history_callback_data('newer', page[0])))
+        if has_older:
+            buttons.append(types.InlineKeyboardButton(
+                text=HISTORY_OLDER_BUTTON, callback_data=self._history_callback_data('older', page[-1])))
+        return types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+    def _history_callback_data(self, direction: str, entity: SearchEntity) -> str:
+        return f'{self.history_callback_prefix}:{direction}:{int(entity.datetime.timestamp())}:{entity.id}'
+
+    def _history_page_to_str(self, page: list[SearchEntity]) -> str:
+        return '\n'.join([self._search_entity_to_str(item) for item in page])
+
+    async def _search_movie(self, query: str) -> Optional[Movie]:
+        primary: Optional[SearchEngine] = first_non_none(list(self.engines.values()))
+        return await search_across(self.engines, query, self.deadlines.engines,
+                                   primary.latency_budget() if primary and self.deadlines.hedge else None)
+
+    # Список названий ищем несколькими обработчиками: не больше concurrency на список и global_concurrency
+    # на все списки сразу, так что одиночные /search не ждут чужих списков. Результаты отправляем по мере готовности,
+    # историю пишем одним пакетом в конце
+    async def _search_batch(self, chat_id: int, titles: list[str]) -> None:
+        if len(titles) > self.batch.max_titles:
+            await self.bot.send_message(chat_id, BATCH_TRUNCATED_MESSAGE.format(limit=self.batch.max_titles),
+                                        parse_mode=None)
+            titles = titles[:self.batch.max_titles]
+        pending: asyncio.Queue = asyncio.Queue()
+        for title in titles:
+            pending.put_nowait(title)
+        sends = TokenBucket(1 / self.batch.send_interval, 1)
+        found: list[SearchEntity] = []
+        not_found: list[str] = []
+
+        async def worker() -> None:
+            while not pending.empty():
+                title: str = pending.get_nowait()
+                try:
+                    # Общий слот держим только на время поиска фильма: ссылки ищутся уже под лимитами провайдеров
+                    async with self._batch_slots:
+                        movie: Optional[Movie] = await self._search_movie(title)
+                    if movie is None:
+                        not_found.append(title)
+                        continue
+                    movie.links_to_watch = await self._search_links(movie)
+                    await sends.acquire(float('inf'))
+                    await self._send_banner(chat_id, movie_to_banner(movie), movie_key(movie))
+                    found.append(SearchEntity(chat_id, title, movie.title, datetime.now(), movie.id_kp, movie.id_tmdb))
+                except Exception:
+                    logger.exception('Batch search for %r failed', title)
+                    not_found.append(title)
+
+        await asyncio.gather(*[worker() for _ in range(min(self.batch.concurrency, len(titles)))])
+        if found:
+            await self.database.save_search_entities(found)
+        summary: str = BATCH_SUMMARY_MESSAGE.format(found=len(found), total=len(titles))
+        if not_found:
+            summary += '\n\n' + BATCH_NOT_FOUND_MESSAGE.format(titles='\n'.join(not_found))
+        await sends.acquire(float('inf'))
+        # Названия из файла присылает пользователь - отправляем как обычный текст, без разметки
+        await self.bot.send_message(chat_id, summary, parse_mode=None)
+
+    # Баннер уходит, как только известен фильм; ссылки дописываются правкой сообщения,
+    # итоговый текст совпадает с непрогрессивным режимом
+    async def _reply_progressively(self, chat_id: int, movie: Movie) -> None:
+        found: dict[str, str] = {}
+        finished: set[str] = set()
+        reply: Optional[ProgressiveReply] = None
+
+        def on_link(site: str, link: Optional[str]) -> None:
+            finished.add(site)
+            if link:
+                found[site] = link
+            # Последнюю ссылку покажет итоговая правка, промежуточная с заглушкой не нужна
+            if reply is not None and link and len(finished) < len(self.sites_to_watch_online):
+                reply.update(self._progress_banner(movie, found).text)
+
+        links: asyncio.Task = asyncio.ensure_future(self._search_links(movie, on_link))
+        # Ссылки из кэша находятся сразу: тогда один готовый баннер вместо заглушки и правок
+        done, _ = await asyncio.wait([links], timeout=self.deadlines.progressive_grace)
+        if done:
+            movie.links_to_watch = links.result()
+            await self._send_banner(chat_id, movie_to_banner(movie), movie_key(movie))
+            return
+        banner: Banner = self._progress_banner(movie, found)
+        try:
+            sent: types.Message = await self._send_banner(chat_id, banner, movie_key(movie))
+        except BaseException:
+            links.cancel()
+            raise
+        reply = ProgressiveReply(self.bot, chat_id, sent.message_id, bool(banner.picture), banner.text,
+                                 parse_mode='Markdown')
+        movie.links_to_watch = await links
+        await reply.finish(movie_to_banner(movie).text)
+
+    # Постер, уже загруженный в Telegram, отправляем по file_id; если Telegram его не принял - по адресу
+    async def _send_banner(self, chat_id: int, banner: Banner, key: str) -> types.Message:
+        if not banner.picture:
+            return await self.bot.send_message(chat_id, banner.text, parse_mode='Markdown')
+        file_id: Optional[str] = await self.posters.get_file_id(key, banner.picture) if self.posters else None
+        if file_id:
+            try:
+                return await self.bot.send_photo(chat_id, file_id, caption=banner.text, parse_mode='Markdown')
+            except TelegramBadRequest as error:
+                # Остальные ошибки (таймаут, flood control, разметка подписи) не значат, что file_id плох,
+                # а после таймаута фото могло уже дойти - повторная отправка дала бы второй баннер
+                if not self._is_file_id_error(error):
+                    raise
+                logger.warning('Poster file_id for %s rejected, sending by url: %r', key, error)
+                self.posters.forget(key)
+        message: types.Message = await self.bot.send_photo(chat_id, banner.picture, caption=banner.text,
+                                                           parse_mode='Markdown')
+        if self.posters and message.photo:
+            self.posters.remember(key, banner.picture, message.photo[-1].file_id)
+        return message
+
+    @staticmethod
+    def _is_file_id_error(error: TelegramBadRequest) -> bool:
+        text: str = error.message.lower()
+        return 'file identifier' in text or 'file_id' in text or 'file id' in text
+
+    def _progress_banner(self, movie: Movie, found: dict[str, str]) -> Banner:
+        links: list[str] = [found[site] for site in self.sites_to_watch_online if site in found]
+        banner: Banner = movie_to_banner(replace(movie, links_to_watch=links))
+        return Banner(banner.text + LINKS_SEARCH_PLACEHOLDER, banner.picture)
+
+    async def _search_links(self, movie: Movie,
+                            on_link: Optional[Callable[[str, Optional[str]], None]] = None) -> list[str]:
+        links = await gather_with_deadline(
+            {site: self._search_link(movie, site, on_link) for site in self.sites_to_watch_online},
+            self.deadlines.links)
+        return [links[site] for site in self.sites_to_watch_online if links[site]]
+
+    async def _search_link(self, movie: Movie, site: str,
+                           on_link: Optional[Callable[[str, Optional[str]], None]]) -> Optional[str]:
+        link: Optional[str] = await self.scrapper.get_top_link(movie.title, site, movie_key(movie))
+        if on_link is not None:
+            on_link(site, link)
+        return link
+
+    async def _download(self, file_id: str) -> bytes:
+        destination = io.BytesIO()
+        if hasattr(self.bot, 'download'):
+            await self.bot.download(file_id, destination=destination)
+        else:
+            await self.bot.download_file_by_id(file_id, destination=destination)
+        return destination.getvalue()
+
     @staticmethod
     def _search_entity_to_str(entity: SearchEntity) -> str:
         return f'{entity.datetime}: {entity.text} -> "{entity.title}"'
@@ -0,0 +1,293 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Optional, Any
+
+from config_data.settings import CacheSettings
+
+from .database import BotDatabase
+from .helpers import normalize_query, movie_key, BackgroundTasks, refreshing, is_refreshing
+from .scrapper import Scrapper, ScrapperDecorator
+from .search import SearchEngine, SearchEngineDecorator
+from .structs import Movie, Candidate, CachedMovie, CachedLink, CachedPoster
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    persistent_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.persistent_hits
+
+    def __str__(self) -> str:
+        return f'hits={self.hits} (memory={self.memory_hits}, persistent={self.persistent_hits}) misses={self.misses}'
+
+
+class LruCache:
+    _missing = object()
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict[Any, tuple[Any, float]] = OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._items.get(key, self._missing)
+        if item is self._missing:
+            return default
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key: Any, value: Any, ttl: float) -> None:
+        self._items[key] = (value, time.monotonic() + ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        self._items.pop(key, None)
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, self._missing) is not self._missing
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class CachingSearchEngine(SearchEngineDecorator):
+
+    def __init__(self, engine: SearchEngine, name: str, database: BotDatabase,
+                 settings: Optional[CacheSettings] = None):
+        super().__init__(engine)
+        self.name = name
+        self.database = database
+        self.settings = settings or CacheSettings()
+        self.stats = CacheStats()
+        self._memory = LruCache(self.settings.memory_size)
+        # Выдача движка по запросу - и тогда, когда его кандидат не был выбран и ответа по запросу у него нет
+        self._candidates = LruCache(self.settings.memory_size)
+        self._background = BackgroundTasks()
+
+    async def search_movie(self, query: str) -> Optional[Movie]:
+        key: str = normalize_query(query)
+        hit, movie = await self._lookup(key)
+        if hit:
+            return movie
+        self.stats.misses += 1
+        return await self._fetch(key, query)
+
+    # Ответ по запросу из кэша - готовый кандидат, подробности для него уже не нужны
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        key: str = normalize_query(query)
+        hit, movie = await self._lookup(key)
+        if hit:
+            return [Candidate(movie, True)] if movie else []
+        listed: Optional[list[Candidate]] = self._candidates.get(key) if not is_refreshing() else None
+        if listed is not None:
+            self.stats.memory_hits += 1
+            return self._copy_candidates(listed)
+        self.stats.misses += 1
+        candidates: list[Candidate] = await self.engine.search_candidates(query)
+        if candidates:
+            self._candidates.put(key, self._copy_candidates(candidates), self.settings.ttl)
+        else:
+            now: float = time.time()
+            self._remember(key, None, now)
+            self._persist(key, None, now)
+        return candidates
+
+    # Подробности кэшируем и по запросу, и по самому фильму: другой запрос, приведший к тому же фильму,
+    # обойдётся без запроса к провайдеру
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        if candidate.complete:
+            return self._copy(candidate.movie)
+        details_key: str = '#' + movie_key(candidate.movie)
+        hit, movie = await self._lookup(details_key)
+        now: float = time.time()
+        if not hit:
+            self.stats.misses += 1
+            movie = await self.engine.get_movie(query, candidate)
+            self._remember(details_key, movie, now)
+            self._persist(details_key, movie, now)
+        key: str = normalize_query(query)
+        self._remember(key, movie, now)
+        self._persist(key, movie, now)
+        return self._copy(movie)
+
+    # Сколько секунд ещё свежа запись по запросу; 0 - записи нет или она устарела
+    async def freshness(self, query: str) -> float:
+        cached: Optional[CachedMovie] = await self.database.load_cached_movie(self.name, normalize_query(query))
+        if cached is None:
+            return 0.0
+        return max(self._ttl(cached.movie) - (time.time() - cached.cached_at), 0.0)
+
+    def _copy_candidates(self, candidates: list[Candidate]) -> list[Candidate]:
+        return [Candidate(self._copy(item.movie), item.complete) for item in candidates]
+
+    async def _lookup(self, key: str) -> tuple[bool, Optional[Movie]]:
+        # При обновлении в обход кэшей старую запись не отдаём
+        if is_refreshing():
+            return False, None
+        if key in self._memory:
+            self.stats.memory_hits += 1
+            return True, self._copy(self._memory.get(key))
+        cached: Optional[CachedMovie] = await self.database.load_cached_movie(self.name, key)
+        if cached is not None and time.time() - cached.cached_at < self._ttl(cached.movie):
+            self.stats.persistent_hits += 1
+            self._remember(key, cached.movie, cached.cached_at)
+            return True, self._copy(cached.movie)
+        return False, None
+
+    async def _fetch(self, key: str, query: str) -> Optional[Movie]:
+        movie: Optional[Movie] = await self.engine.search_movie(query)
+        now: float = time.time()
+        self._remember(key, movie, now)
+        self._persist(key, movie, now)
+        return self._copy(movie)
+
+    def _remember(self, key: str, movie: Optional[Movie], cached_at: float) -> None:
+        ttl: float = self._ttl(movie) - (time.time() - cached_at)
+        if ttl > 0:
+            self._memory.put(key, self._copy(movie), ttl)
+
+    def _persist(self, key: str, movie: Optional[Movie], cached_at: float) -> None:
+        self._background.spawn(self.database.save_cached_movie(self.name, key, self._copy(movie), cached_at),
+                               f'Saving {self.name} cache entry')
+
+    def _ttl(self, movie: Optional[Movie]) -> float:
+        return self.settings.ttl if movie else self.settings.negative_ttl
+
+    @staticmethod
+    def _copy(movie: Optional[Movie]) -> Optional[Movie]:
+        return replace(movie) if movie else None
+
+
+class CachingScrapper(ScrapperDecorator):
+
+    def __init__(self, scrapper: Scrapper, database: BotDatabase, settings: Optional[CacheSettings] = None):
+        super().__init__(scrapper)
+        self.database = database
+        self.settings = settings or CacheSettings()
+        self.stats = CacheStats()
+        self.stale_hits: int = 0
+        self._memory = LruCache(self.settings.memory_size)
+        self._refreshing: set[tuple[str, str]] = set()
+        self._background = BackgroundTasks()
+
+    async def get_top_link(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
+        cache_key: tuple[str, str] = self._cache_key(query, cite, key)
+        cached: Optional[CachedLink] = self._memory.get(cache_key)
+        if cached is not None:
+            self.stats.memory_hits += 1
+        else:
+            cached = await self.database.load_cached_link(*cache_key)
+            if cached is not None:
+                self.stats.persistent_hits += 1
+                self._remember(cache_key, cached)
+
+        age: float = time.time() - cached.cached_at if cached is not None else float('inf')
+        if age < self._ttl(cached):
+            return cached.link
+        if cached is not None and cached.link and age < self.settings.link_max_stale:
+            self.stale_hits += 1
+            self._refresh_in_background(query, cite, key, cache_key)
+            return cached.link
+
+        self.stats.misses += 1
+        return await self._refresh(query, cite, key, cache_key)
+
+    async def freshness(self, query: str, cite: Optional[str], key: Optional[str] = None) -> float:
+        cache_key: tuple[str, str] = self._cache_key(query, cite, key)
+        cached: Optional[CachedLink] = self._memory.get(cache_key) or await self.database.load_cached_link(*cache_key)
+        if cached is None:
+            return 0.0
+        return max(self._ttl(cached) - (time.time() - cached.cached_at), 0.0)
+
+    async def refresh(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
+        with refreshing():
+            return await self._refresh(query, cite, key, self._cache_key(query, cite, key))
+
+    async def _refresh(self, query: str, cite: Optional[str], key: Optional[str],
+                       cache_key: tuple[str, str]) -> Optional[str]:
+        link: Optional[str] = await self.scrapper.get_top_link(query, cite, key)
+        cached = CachedLink(link, time.time())
+        self._remember(cache_key, cached)
+        self._background.spawn(self.database.save_cached_link(*cache_key, cached.link, cached.cached_at),
+                               'Saving link cache entry')
+        return link
+
+    def _refresh_in_background(self, query: str, cite: Optional[str], key: Optional[str],
+                               cache_key: tuple[str, str]) -> None:
+        if cache_key in self._refreshing:
+            return
+        self._refreshing.add(cache_key)
+        task = self._background.spawn(self._refresh(query, cite, key, cache_key), f'Refreshing link for {cache_key}')
+        task.add_done_callback(lambda _: self._refreshing.discard(cache_key))
+
+    @staticmethod
+    def _cache_key(query: str, cite: Optional[str], key: Optional[str]) -> tuple[str, str]:
+        return key or f'title:{normalize_query(query)}', cite or ''
+
+    def _remember(self, cache_key: tuple[str, str], cached: CachedLink) -> None:
+        ttl: float = self.settings.link_max_stale - (time.time() - cached.cached_at)
+        if ttl > 0:
+            self._memory.put(cache_key, cached, ttl)
+
+    def _ttl(self, cached: Optional[CachedLink]) -> float:
+        if cached is None:
+            return 0
+        return self.settings.link_ttl if cached.link else self.settings.negative_ttl
+
+
+# file_id постеров, уже загруженных в Telegram: повторная отправка по file_id не заставляет Telegram
+# заново скачивать картинку с Кинопоиска или TMDB
+class PosterCache:
+
+    def __init__(self, database: BotDatabase, settings: Optional[CacheSettings] = None):
+        self.database = database
+        self.settings = settings or CacheSettings()
+        self.stats = CacheStats()
+        self.rejected: int = 0
+        self._memory = LruCache(self.settings.memory_size)
+        self._background = BackgroundTasks()
+
+    async def get_file_id(self, key: str, poster: str) -> Optional[str]:
+        cached: Optional[CachedPoster] = self._memory.get(key)
+        if cached is not None:
+            self.stats.memory_hits += 1
+        else:
+            cached = await self.database.load_cached_poster(key)
+            if cached is not None and time.time() - cached.cached_at < self.settings.poster_ttl:
+                self.stats.persistent_hits += 1
+                self._remember(key, cached)
+            else:
+                cached = None
+        if cached is None or cached.poster != poster:
+            self.stats.misses += 1
+            return None
+        return cached.file_id
+
+    def remember(self, key: str, poster: str, file_id: str) -> None:
+        cached = CachedPoster(poster, file_id, time.time())
+        self._remember(key, cached)
+        self._background.spawn(self.database.save_cached_poster(key, poster, file_id, cached.cached_at),
+                               'Saving poster file_id')
+
+    def forget(self, key: str) -> None:
+        self.rejected += 1
+        self._memory.pop(key)
+        self._background.spawn(self.database.delete_cached_poster(key), 'Deleting poster file_id')
+
+    def _remember(self, key: str, cached: CachedPoster) -> None:
+        ttl: float = self.settings.poster_ttl - (time.time() - cached.cached_at)
+        if ttl > 0:
+            self._memory.put(key, cached, ttl)
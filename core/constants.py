@@ -1,4 +1,14 @@
 START_MESSAGE = "Hello, I can help you in searching for some awesome movies! Use /help command to get instructed."
-HELP_MESSAGE = "/help prints instructions for bot usage\n/search [followed by keywords] searches the best movie for given keywords \n/history gives you a list of successfull search attempts\n/stats gives you info on your views of different movies\n\nExample of a search request:\n\n/search Смешарики"
+HELP_MESSAGE = "/help prints instructions for bot usage\n/search [followed by keywords] searches the best movie for given keywords \n/history gives you a list of successfull search attempts\n/stats gives you info on your views of different movies\n\nSeveral titles on separate lines after /search, or a .txt file with one title per line, are searched as a batch\n\nExample of a search request:\n\n/search Смешарики"
 UNKNOWN_COMMAND_MESSAGE = "Sorry, unknown command"
 RESULT_NONE_MESSAGE = "Sorry, bot couldn't find anything appropriate for given keywords :("
+HISTORY_EMPTY_MESSAGE = "Your search history is empty"
+HISTORY_NEWER_BUTTON = "« Newer"
+HISTORY_OLDER_BUTTON = "Older »"
+LINKS_SEARCH_PLACEHOLDER = "_Ищем, где посмотреть онлайн…_"
+BATCH_TRUNCATED_MESSAGE = "Only the first {limit} titles will be searched"
+BATCH_SUMMARY_MESSAGE = "Found {found} of {total} titles"
+BATCH_NOT_FOUND_MESSAGE = "Not found:\n{titles}"
+BATCH_EMPTY_MESSAGE = "The file has no titles to search"
+BATCH_FILE_UNSUPPORTED_MESSAGE = "Send a .txt file with one title per line, no larger than {size} KB"
+BUSY_MESSAGE = "Sorry, the bot is busy right now, please try again in a minute"
@@ -1,12 +1,20 @@
 import asyncio
+import contextlib
 import datetime
+import json
+import logging
+import time
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Optional, AsyncIterator
 
-from aiogram import types
-from .structs import SearchEntity, StatsEntity
+from .structs import SearchEntity, StatsEntity, Movie, CachedMovie, CachedLink, CachedPoster, IndexedMovie, \
+    QueryCount
+from .helpers import movie_to_json, movie_from_json, movie_key
+from .migrations import apply_pragmas, migrate, supports_trigram
 import aiosqlite
 
+logger = logging.getLogger(__name__)
+
 
 class BotDatabase(ABC):
 
@@ -15,80 +23,380 @@ class BotDatabase(ABC):
         pass
 
     @abstractmethod
-    async def load_search_entities(self, chat_id: types.base.Integer) -> list[SearchEntity]:
+    async def save_search_entities(self, entities: list[SearchEntity]) -> None:
+        pass
+
+    @abstractmethod
+    async def load_search_entities(self, chat_id: int) -> list[SearchEntity]:
+        pass
+
+    @abstractmethod
+    async def load_search_page(self, chat_id: int, limit: int,
+                               before: Optional[tuple[int, int]] = None,
+                               after: Optional[tuple[int, int]] = None) -> list[SearchEntity]:
+        pass
+
+    @abstractmethod
+    async def load_stats_entities(self, chat_id: int) -> list[StatsEntity]:
+        pass
+
+    # Сколько раз искали каждый запрос по часам, начиная с since (unix-время), по всем чатам
+    @abstractmethod
+    async def load_query_counts(self, since: int) -> list[QueryCount]:
+        pass
+
+    @abstractmethod
+    async def load_cached_movie(self, engine: str, query: str) -> Optional[CachedMovie]:
+        pass
+
+    @abstractmethod
+    async def save_cached_movie(self, engine: str, query: str, movie: Optional[Movie], cached_at: float) -> None:
+        pass
+
+    @abstractmethod
+    async def load_cached_link(self, key: str, site: str) -> Optional[CachedLink]:
         pass
 
     @abstractmethod
-    async def load_stats_entities(self, chat_id: types.base.Integer) -> list[StatsEntity]:
+    async def save_cached_link(self, key: str, site: str, link: Optional[str], cached_at: float) -> None:
         pass
 
+    @abstractmethod
+    async def load_cached_poster(self, key: str) -> Optional[CachedPoster]:
+        pass
+
+    @abstractmethod
+    async def save_cached_poster(self, key: str, poster: str, file_id: str, cached_at: float) -> None:
+        pass
+
+    @abstractmethod
+    async def delete_cached_poster(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    async def load_index_candidates(self, match: str, sources: list[str], limit: int) -> list[IndexedMovie]:
+        pass
+
+    @abstractmethod
+    async def save_indexed_movies(self, entries: list[IndexedMovie]) -> None:
+        pass
+
+
+class BotDatabaseDecorator(BotDatabase):
+
+    def __init__(self, database: BotDatabase):
+        self.database = database
+
+    async def save_search_entity(self, entity: SearchEntity) -> None:
+        await self.database.save_search_entity(entity)
+
+    async def save_search_entities(self, entities: list[SearchEntity]) -> None:
+        await self.database.save_search_entities(entities)
+
+    async def load_search_entities(self, chat_id: int) -> list[SearchEntity]:
+        return await self.database.load_search_entities(chat_id)
+
+    async def load_search_page(self, chat_id: int, limit: int,
+                               before: Optional[tuple[int, int]] = None,
+                               after: Optional[tuple[int, int]] = None) -> list[SearchEntity]:
+        return await self.database.load_search_page(chat_id, limit, before, after)
+
+    async def load_stats_entities(self, chat_id: int) -> list[StatsEntity]:
+        return await self.database.load_stats_entities(chat_id)
+
+    async def load_query_counts(self, since: int) -> list[QueryCount]:
+        return await self.database.load_query_counts(since)
+
+    async def load_cached_movie(self, engine: str, query: str) -> Optional[CachedMovie]:
+        return await self.database.load_cached_movie(engine, query)
+
+    async def save_cached_movie(self, engine: str, query: str, movie: Optional[Movie], cached_at: float) -> None:
+        await self.database.save_cached_movie(engine, query, movie, cached_at)
+
+    async def load_cached_link(self, key: str, site: str) -> Optional[CachedLink]:
+        return await self.database.load_cached_link(key, site)
+
+    async def save_cached_link(self, key: str, site: str, link: Optional[str], cached_at: float) -> None:
+        await self.database.save_cached_link(key, site, link, cached_at)
+
+    async def load_cached_poster(self, key: str) -> Optional[CachedPoster]:
+        return await self.database.load_cached_poster(key)
+
+    async def save_cached_poster(self, key: str, poster: str, file_id: str, cached_at: float) -> None:
+        await self.database.save_cached_poster(key, poster, file_id, cached_at)
+
+    async def delete_cached_poster(self, key: str) -> None:
+        await self.database.delete_cached_poster(key)
+
+    async def load_index_candidates(self, match: str, sources: list[str], limit: int) -> list[IndexedMovie]:
+        return await self.database.load_index_candidates(match, sources, limit)
+
+    async def save_indexed_movies(self, entries: list[IndexedMovie]) -> None:
+        await self.database.save_indexed_movies(entries)
+
 
 _sql_requests: dict[str, str] = {
-    'table_exists': "SELECT name FROM sqlite_master WHERE type='table' AND name='{}';",
-    'create_table_history': "CREATE TABLE history (chat_id INTEGER, text STRING, title STRING, search_time TIMESTAMP, kp_id INTEGER, tmdb_id INTEGER)",
-    'save_search_entity': "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)",
-    'load_search_entities': "SELECT chat_id, text, title, search_time, kp_id, tmdb_id FROM history WHERE chat_id = {}",
-    'load_stats_entities': "SELECT title, kp_id, tmdb_id, COUNT(*) FROM history WHERE chat_id = {} GROUP By kp_id, tmdb_id, title;"
+    'save_search_entity': "INSERT INTO history (chat_id, text, title, search_time, kp_id, tmdb_id) VALUES (?, ?, ?, ?, ?, ?)",
+    'load_search_entities': "SELECT chat_id, text, title, search_time, kp_id, tmdb_id, id FROM history WHERE chat_id = ? ORDER BY search_time, id",
+    'load_search_page': "SELECT chat_id, text, title, search_time, kp_id, tmdb_id, id FROM history WHERE chat_id = ? ORDER BY search_time DESC, id DESC LIMIT ?",
+    'load_search_page_before': "SELECT chat_id, text, title, search_time, kp_id, tmdb_id, id FROM history WHERE chat_id = ? AND (search_time, id) < (?, ?) ORDER BY search_time DESC, id DESC LIMIT ?",
+    'load_search_page_after': "SELECT chat_id, text, title, search_time, kp_id, tmdb_id, id FROM history WHERE chat_id = ? AND (search_time, id) > (?, ?) ORDER BY search_time, id LIMIT ?",
+    'update_stats': "INSERT INTO stats VALUES (?, ?, ?, ?, 1) ON CONFLICT (chat_id, kp_id, tmdb_id, title) DO UPDATE SET count = count + 1",
+    'load_stats_entities': "SELECT title, kp_id, tmdb_id, count FROM stats WHERE chat_id = ? ORDER BY count DESC",
+    'load_query_counts': "SELECT text, title, search_time / 3600 * 3600 AS hour, COUNT(*) FROM history WHERE search_time >= ? GROUP BY text, title, hour "
+                         "UNION ALL SELECT q.value, t.value, a.day, SUM(a.count) FROM history_archive a LEFT JOIN history_strings q ON q.id = a.query_id LEFT JOIN history_strings t ON t.id = a.title_id WHERE a.day >= ? GROUP BY a.query_id, a.title_id, a.day",
+    'clear_stats': "DELETE FROM stats",
+    # Счётчики из живой истории и из архива вместе, чтобы /stats не терял заархивированные поиски
+    'rebuild_stats': "INSERT INTO stats SELECT chat_id, IFNULL(kp_id, -1), IFNULL(tmdb_id, -1), IFNULL(title, ''), SUM(count) FROM ("
+                     "SELECT chat_id, kp_id, tmdb_id, title, COUNT(*) AS count FROM history GROUP BY chat_id, kp_id, tmdb_id, title "
+                     "UNION ALL SELECT a.chat_id, a.kp_id, a.tmdb_id, t.value, SUM(a.count) FROM history_archive a LEFT JOIN history_strings t ON t.id = a.title_id GROUP BY a.chat_id, a.kp_id, a.tmdb_id, a.title_id"
+                     ") GROUP BY 1, 2, 3, 4",
+    # Один вызов executescript, поэтому запросы других корутин на том же соединении не вклиниваются в середину.
+    # В срез попадают limit самых старых поисков до before; новые поиски в него не попадут, их время больше before
+    'archive_history': """
+        CREATE TEMP TABLE IF NOT EXISTS archive_slice (id INTEGER PRIMARY KEY);
+        BEGIN;
+        DELETE FROM archive_slice;
+        INSERT INTO archive_slice SELECT id FROM history WHERE search_time < {before} ORDER BY search_time LIMIT {limit};
+        INSERT OR IGNORE INTO history_strings (value)
+            SELECT text FROM history WHERE id IN archive_slice AND text IS NOT NULL
+            UNION SELECT title FROM history WHERE id IN archive_slice AND title IS NOT NULL;
+        INSERT INTO history_archive (chat_id, day, query_id, title_id, kp_id, tmdb_id, count)
+            SELECT h.chat_id, h.search_time / 86400 * 86400, IFNULL(q.id, 0), IFNULL(t.id, 0), h.kp_id, h.tmdb_id, COUNT(*)
+            FROM history h LEFT JOIN history_strings q ON q.value = h.text LEFT JOIN history_strings t ON t.value = h.title
+            WHERE h.id IN archive_slice GROUP BY 1, 2, 3, 4, 5, 6
+            ON CONFLICT (chat_id, day, query_id, title_id, kp_id, tmdb_id) DO UPDATE SET count = count + excluded.count;
+        DELETE FROM history WHERE id IN archive_slice;
+        COMMIT;
+    """,
+    'archived_count': "SELECT COUNT(*) FROM archive_slice",
+    'auto_vacuum': "PRAGMA auto_vacuum",
+    'freelist_count': "PRAGMA freelist_count",
+    # Через executescript: обычный execute выполняет только первый шаг прагмы и освобождает одну страницу
+    'incremental_vacuum': "PRAGMA incremental_vacuum({pages});",
+    'enable_incremental_vacuum': "PRAGMA auto_vacuum = INCREMENTAL",
+    'vacuum': "VACUUM",
+    'load_cached_movie': "SELECT movie, cached_at FROM movie_cache WHERE engine = ? AND query = ?",
+    'save_cached_movie': "INSERT OR REPLACE INTO movie_cache VALUES (?, ?, ?, ?)",
+    'load_cached_link': "SELECT link, cached_at FROM link_cache WHERE key = ? AND site = ?",
+    'save_cached_link': "INSERT OR REPLACE INTO link_cache VALUES (?, ?, ?, ?)",
+    'load_cached_poster': "SELECT poster, file_id, cached_at FROM poster_cache WHERE key = ?",
+    'save_cached_poster': "INSERT OR REPLACE INTO poster_cache VALUES (?, ?, ?, ?)",
+    'delete_cached_poster': "DELETE FROM poster_cache WHERE key = ?",
+    'load_index_candidates': "SELECT i.source, i.movie, i.complete, i.names, i.updated_at FROM movie_index_fts JOIN movie_index i ON i.id = movie_index_fts.rowid WHERE movie_index_fts MATCH ? AND i.source IN (SELECT value FROM json_each(?)) ORDER BY bm25(movie_index_fts) LIMIT ?",
+    'save_indexed_movie': "INSERT INTO movie_index (source, key, movie, complete, names, updated_at) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (source, key) DO UPDATE SET movie = excluded.movie, complete = excluded.complete, names = excluded.names, updated_at = excluded.updated_at",
+    'optimize_index': "INSERT INTO movie_index_fts (movie_index_fts) VALUES ('optimize')"
 }
 
 
 class BotDatabaseImpl(BotDatabase):
 
     def __init__(self, db_path: str):
-        asyncio.get_event_loop().run_until_complete(self._init(db_path))
+        self.db_path = db_path
+        self.connection: Optional[aiosqlite.Connection] = None
+        self.index_enabled: bool = False
+        self._write_lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        if self.connection is not None:
+            return
+        connection: aiosqlite.Connection = await aiosqlite.connect(self.db_path)
+        try:
+            await apply_pragmas(connection)
+            self.index_enabled = await supports_trigram(connection)
+            if not self.index_enabled:
+                logger.warning('SQLite %s has no FTS5 trigram tokenizer (needs 3.34+), movie index is disabled',
+                               aiosqlite.sqlite_version)
+            await migrate(connection, self.index_enabled)
+        except Exception:
+            await connection.close()
+            raise
+        self.connection = connection
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+    # Все корутины пишут через одно соединение: без блокировки commit одной из них зафиксировал бы
+    # половину транзакции другой (например, историю без обновления stats)
+    @contextlib.asynccontextmanager
+    async def _transaction(self) -> AsyncIterator[None]:
+        async with self._write_lock:
+            await self.connection.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                await self.connection.rollback()
+                raise
+            await self.connection.commit()
 
     async def save_search_entity(self, entity: SearchEntity) -> None:
-        await self.connection.execute(_sql_requests['save_search_entity'],
-                                      (entity.chat_id,
-                                       entity.text,
-                                       entity.title,
-                                       entity.datetime,
-                                       self._int_to_none(entity.kp_id),
-                                       self._int_to_none(entity.tmdb_id)))
-        await self.connection.commit()
-
-    async def load_search_entities(self, chat_id: types.base.Integer) -> list[SearchEntity]:
-        cursor = await self.connection.execute(_sql_requests['load_search_entities'].format(chat_id))
+        await self.save_search_entities([entity])
+
+    async def save_search_entities(self, entities: list[SearchEntity]) -> None:
+        async with self._transaction():
+            await self.connection.executemany(_sql_requests['save_search_entity'],
+                                              [(entity.chat_id,
+                                                entity.text,
+                                                entity.title,
+                                                int(entity.datetime.timestamp()),
+                                                self._int_to_none(entity.kp_id),
+                                                self._int_to_none(entity.tmdb_id)) for entity in entities])
+            await self.connection.executemany(_sql_requests['update_stats'],
+                                              [(entity.chat_id,
+                                                self._int_to_none(entity.kp_id),
+                                                self._int_to_none(entity.tmdb_id),
+                                                entity.title or '') for entity in entities])
+
+    async def load_search_entities(self, chat_id: int) -> list[SearchEntity]:
+        cursor = await self.connection.execute(_sql_requests['load_search_entities'], (chat_id,))
         rows = await cursor.fetchall()
-        result = []
-        for row in rows:
-            date = datetime.datetime.strptime(row[3].split('.')[0], "%Y-%m-%d %H:%M:%S")
-            result.append(SearchEntity(
-                row[0],
-                row[1],
-                row[2],
-                date,
-                self._get_int_optional(row[4]),
-                self._get_int_optional(row[5])))
-        return result
+        return [self._row_to_search_entity(row) for row in rows]
+
+    async def load_search_page(self, chat_id: int, limit: int,
+                               before: Optional[tuple[int, int]] = None,
+                               after: Optional[tuple[int, int]] = None) -> list[SearchEntity]:
+        if after is not None:
+            cursor = await self.connection.execute(_sql_requests['load_search_page_after'], (chat_id, *after, limit))
+            rows = reversed(await cursor.fetchall())
+        elif before is not None:
+            cursor = await self.connection.execute(_sql_requests['load_search_page_before'], (chat_id, *before, limit))
+            rows = await cursor.fetchall()
+        else:
+            cursor = await self.connection.execute(_sql_requests['load_search_page'], (chat_id, limit))
+            rows = await cursor.fetchall()
+        return [self._row_to_search_entity(row) for row in rows]
 
-    async def load_stats_entities(self, chat_id: types.base.Integer) -> list[StatsEntity]:
-        cursor = await self.connection.execute(_sql_requests['load_stats_entities'].format(chat_id))
+    async def load_stats_entities(self, chat_id: int) -> list[StatsEntity]:
+        cursor = await self.connection.execute(_sql_requests['load_stats_entities'], (chat_id,))
         rows = await cursor.fetchall()
         result = []
         for row in rows:
             result.append(StatsEntity(
-                row[0],
+                row[0] or None,
                 self._get_int_optional(row[1]),
                 self._get_int_optional(row[2]),
                 row[3]))
         return result
 
-    async def _init(self, db_path: str):
-        connection = aiosqlite.connect(db_path)
-        self.connection = connection
-        await self.connection.__aenter__()
-        await self._init_tables()
-
-    async def _init_tables(self):
-        if not await self._check_table_exists('history'):
-            query: str = _sql_requests['create_table_history']
-            await self.connection.execute(query)
-
-    async def _check_table_exists(self, table_name: str):
-        cursor = await self.connection.execute(_sql_requests['table_exists'].format(table_name))
-        result = await cursor.fetchone()
-        return True if result else False
+    async def load_query_counts(self, since: int) -> list[QueryCount]:
+        cursor = await self.connection.execute(_sql_requests['load_query_counts'], (since, since))
+        rows = await cursor.fetchall()
+        return [QueryCount(row[0], row[1], row[2], row[3]) for row in rows]
+
+    async def rebuild_stats(self) -> None:
+        async with self._transaction():
+            await self.connection.execute(_sql_requests['clear_stats'])
+            await self.connection.execute(_sql_requests['rebuild_stats'])
+
+    # Переносит в архив до limit поисков старше before (unix-время); возвращает, сколько перенесли
+    async def archive_history(self, before: int, limit: int) -> int:
+        # Скрипт сам открывает и фиксирует транзакцию, поэтому берём только блокировку записи
+        async with self._write_lock:
+            try:
+                await self.connection.executescript(_sql_requests['archive_history'].format(before=int(before),
+                                                                                            limit=int(limit)))
+            except Exception:
+                await self.connection.rollback()
+                raise
+            cursor = await self.connection.execute(_sql_requests['archived_count'])
+            row = await cursor.fetchone()
+        return row[0]
+
+    # Возвращает в файловую систему до pages свободных страниц; работает, только если база в режиме auto_vacuum
+    # INCREMENTAL. Возвращает, сколько страниц освободили
+    async def incremental_vacuum(self, pages: int) -> int:
+        cursor = await self.connection.execute(_sql_requests['auto_vacuum'])
+        if (await cursor.fetchone())[0] != 2:
+            return 0
+        async with self._write_lock:
+            before: int = await self._freelist_count()
+            if not before:
+                return 0
+            await self.connection.executescript(_sql_requests['incremental_vacuum'].format(pages=int(pages)))
+            return before - await self._freelist_count()
+
+    # Полная перепаковка файла; заодно переводит старую базу в режим auto_vacuum INCREMENTAL.
+    # Блокирует базу на всё время работы, поэтому запускается только из core.maintenance
+    async def vacuum(self) -> None:
+        async with self._write_lock:
+            await self.connection.execute(_sql_requests['enable_incremental_vacuum'])
+            await self.connection.execute(_sql_requests['vacuum'])
+
+    async def load_cached_movie(self, engine: str, query: str) -> Optional[CachedMovie]:
+        cursor = await self.connection.execute(_sql_requests['load_cached_movie'], (engine, query))
+        row = await cursor.fetchone()
+        if not row:
+            return None
+        return CachedMovie(movie_from_json(row[0]) if row[0] else None, row[1])
+
+    async def save_cached_movie(self, engine: str, query: str, movie: Optional[Movie], cached_at: float) -> None:
+        async with self._transaction():
+            await self.connection.execute(_sql_requests['save_cached_movie'],
+                                          (engine, query, movie_to_json(movie) if movie else None, cached_at))
+
+    async def load_cached_link(self, key: str, site: str) -> Optional[CachedLink]:
+        cursor = await self.connection.execute(_sql_requests['load_cached_link'], (key, site))
+        row = await cursor.fetchone()
+        return CachedLink(row[0], row[1]) if row else None
+
+    async def save_cached_link(self, key: str, site: str, link: Optional[str], cached_at: float) -> None:
+        async with self._transaction():
+            await self.connection.execute(_sql_requests['save_cached_link'], (key, site, link, cached_at))
+
+    async def load_cached_poster(self, key: str) -> Optional[CachedPoster]:
+        cursor = await self.connection.execute(_sql_requests['load_cached_poster'], (key,))
+        row = await cursor.fetchone()
+        return CachedPoster(row[0], row[1], row[2]) if row else None
+
+    async def save_cached_poster(self, key: str, poster: str, file_id: str, cached_at: float) -> None:
+        async with self._transaction():
+            await self.connection.execute(_sql_requests['save_cached_poster'], (key, poster, file_id, cached_at))
+
+    async def delete_cached_poster(self, key: str) -> None:
+        async with self._transaction():
+            await self.connection.execute(_sql_requests['delete_cached_poster'], (key,))
+
+    # Без триграммного FTS5 индекс пуст: записи копятся в movie_index и попадут в поиск после обновления SQLite
+    async def load_index_candidates(self, match: str, sources: list[str], limit: int) -> list[IndexedMovie]:
+        if not self.index_enabled:
+            return []
+        cursor = await self.connection.execute(_sql_requests['load_index_candidates'],
+                                               (match, json.dumps(sources), limit))
+        rows = await cursor.fetchall()
+        return [IndexedMovie(row[0], movie_from_json(row[1]), bool(row[2]), row[3], row[4]) for row in rows]
+
+    async def save_indexed_movies(self, entries: list[IndexedMovie]) -> None:
+        now: float = time.time()
+        async with self._transaction():
+            await self.connection.executemany(_sql_requests['save_indexed_movie'],
+                                              [(entry.source,
+                                                movie_key(entry.movie),
+                                                movie_to_json(entry.movie),
+                                                int(entry.complete),
+                                                entry.names,
+                                                now) for entry in entries])
+
+    async def optimize_index(self) -> None:
+        if not self.index_enabled:
+            return
+        async with self._transaction():
+            await self.connection.execute(_sql_requests['optimize_index'])
+
+    async def _freelist_count(self) -> int:
+        cursor = await self.connection.execute(_sql_requests['freelist_count'])
+        return (await cursor.fetchone())[0]
+
+    def _row_to_search_entity(self, row: tuple) -> SearchEntity:
+        return SearchEntity(
+            row[0],
+            row[1],
+            row[2],
+            datetime.datetime.fromtimestamp(row[3]),
+            self._get_int_optional(row[4]),
+            self._get_int_optional(row[5]),
+            row[6])
 
     @staticmethod
     def _int_to_none(x: Optional[int]) -> int:
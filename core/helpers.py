@@ -1,7 +1,17 @@
-from typing import Optional, Any
+import asyncio
+import contextlib
+import json
+import logging
+import re
+from contextvars import ContextVar
+from typing import Optional, Any, Awaitable, Coroutine, Iterator
+
+from aiogram import types
 
 from .structs import Movie, Banner
-from dataclasses import fields
+from dataclasses import fields, asdict
+
+logger = logging.getLogger(__name__)
 
 
 def merge_movies(movies: list[Movie]) -> Optional[Movie]:
@@ -53,3 +63,172 @@ def first_non_none(lst: list[Any]) -> Optional[Any]:
         if item:
             return item
     return None
+
+
+# Текст после команды: /search Матрица -> Матрица
+def get_query(message: types.Message) -> str:
+    if hasattr(message, 'get_args'):
+        return message.get_args()
+    parts = (message.text or '').split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ''
+
+
+# Названия списка по одному на строку, без пустых строк и повторов
+def split_titles(text: str) -> list[str]:
+    return list(dict.fromkeys(line.strip() for line in text.splitlines() if line.strip()))
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r'\s+', ' ', query).strip().lower().replace('ё', 'е')
+
+
+_cyrillic_to_latin: dict[str, str] = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y',
+    'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e',
+    'ю': 'yu', 'я': 'ya',
+}
+
+
+# Приводим название к латинице, чтобы "Брат", "brat" и "Brаt" с опечаткой сравнивались в одном алфавите
+def transliterate(text: str) -> str:
+    return ''.join(_cyrillic_to_latin.get(char, char) for char in normalize_query(text))
+
+
+def clean_title(text: str) -> str:
+    return ' '.join(re.sub(r'[^\w ]+', ' ', normalize_query(text)).split())
+
+
+def movie_key(movie: Movie) -> str:
+    if movie.id_imdb:
+        return f'imdb:{movie.id_imdb}'
+    if movie.id_kp:
+        return f'kp:{movie.id_kp}'
+    if movie.id_tmdb:
+        return f'tmdb:{movie.id_tmdb}'
+    return f'title:{normalize_query(movie.title or "")}'
+
+
+def movie_to_json(movie: Movie) -> str:
+    return json.dumps(asdict(movie), ensure_ascii=False)
+
+
+def movie_from_json(data: str) -> Movie:
+    known: set[str] = {field.name for field in fields(Movie)}
+    return Movie(**{key: value for key, value in json.loads(data).items() if key in known})
+
+
+# Компактная форма для общего кэша: значения полей списком в порядке объявления,
+# хвостовые None отбрасываются. Порядок полей Movie менять нельзя, только дописывать новые в конец.
+def movie_to_compact(movie: Optional[Movie]) -> str:
+    if movie is None:
+        return 'null'
+    values: list[Any] = [getattr(movie, field.name) for field in fields(Movie)]
+    while values and values[-1] is None:
+        values.pop()
+    return json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+
+
+def movie_from_compact(data: str) -> Optional[Movie]:
+    values: Optional[list[Any]] = json.loads(data)
+    if values is None:
+        return None
+    return Movie(*values[:len(fields(Movie))])
+
+
+async def gather_with_deadline(aws: dict[str, Awaitable[Any]], timeout: Optional[float],
+                               hedge_after: Optional[float] = None) -> dict[str, Optional[Any]]:
+    tasks: dict[str, asyncio.Task] = {name: asyncio.ensure_future(aw) for name, aw in aws.items()}
+    if not tasks:
+        return {}
+    deadline: Optional[float] = asyncio.get_running_loop().time() + timeout if timeout is not None else None
+    try:
+        primary: asyncio.Task = next(iter(tasks.values()))
+        if hedge_after is not None and len(tasks) > 1:
+            await asyncio.wait([primary], timeout=_time_left(deadline, hedge_after))
+        if primary.done() or hedge_after is None or len(tasks) == 1:
+            await asyncio.wait(tasks.values(), timeout=_time_left(deadline))
+        else:
+            # Первый источник не уложился в свой обычный бюджет: берём первый непустой ответ
+            await _wait_for_first_answer(list(tasks.values()), deadline)
+    finally:
+        pending: set[asyncio.Task] = {task for task in tasks.values() if not task.done()}
+        for task in pending:
+            task.cancel()
+    result: dict[str, Optional[Any]] = {}
+    for name, task in tasks.items():
+        if task in pending:
+            logger.warning('%s did not answer in time', name)
+            result[name] = None
+        elif task.cancelled():
+            # Задачу отменили изнутри (например, общий запрос single-flight) - это отсутствие ответа, а не ошибка поиска
+            logger.warning('%s was cancelled', name)
+            result[name] = None
+        elif task.exception() is not None:
+            logger.warning('%s failed: %r', name, task.exception())
+            result[name] = None
+        else:
+            result[name] = task.result()
+    return result
+
+
+async def _wait_for_first_answer(tasks: list[asyncio.Task], deadline: Optional[float]) -> None:
+    pending: set[asyncio.Task] = {task for task in tasks if not task.done()}
+    while pending and not any(_has_answer(task) for task in tasks):
+        done, pending = await asyncio.wait(pending, timeout=_time_left(deadline),
+                                           return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            return
+
+
+def _has_answer(task: asyncio.Task) -> bool:
+    return task.done() and not task.cancelled() and task.exception() is None and bool(task.result())
+
+
+def _time_left(deadline: Optional[float], cap: Optional[float] = None) -> Optional[float]:
+    if deadline is None:
+        return cap
+    left: float = max(deadline - asyncio.get_running_loop().time(), 0.0)
+    return min(left, cap) if cap is not None else left
+
+
+class BackgroundTasks:
+
+    def __init__(self):
+        self._tasks: set[asyncio.Task] = set()
+
+    def spawn(self, coro: Coroutine[Any, Any, Any], description: str) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._on_done(done, description))
+        return task
+
+    async def wait(self, timeout: Optional[float] = None) -> None:
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def _on_done(self, task: asyncio.Task, description: str) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('%s failed: %r', description, task.exception())
+
+
+_refreshing: ContextVar[bool] = ContextVar('refreshing', default=False)
+
+
+# Внутри этого блока промежуточные кэши (общий кэш, локальный индекс) не отвечают сохранёнными значениями,
+# а пропускают запрос к провайдеру и сохраняют свежий ответ
+@contextlib.contextmanager
+def refreshing() -> Iterator[None]:
+    token = _refreshing.set(True)
+    try:
+        yield
+    finally:
+        _refreshing.reset(token)
+
+
+def is_refreshing() -> bool:
+    return _refreshing.get()
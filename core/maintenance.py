@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from config_data.settings import RetentionSettings
+
+from .database import BotDatabaseImpl
+from .movie_index import MovieIndex, dump_readers, dump_source
+from .retention import HistoryRetention
+from .structs import Movie
+
+logger = logging.getLogger(__name__)
+
+
+async def backfill_stats(database: BotDatabaseImpl, _: argparse.Namespace) -> None:
+    await database.rebuild_stats()
+    logger.info('Stats table rebuilt from history and archive')
+
+
+async def archive_history(database: BotDatabaseImpl, args: argparse.Namespace) -> None:
+    retention = HistoryRetention(database, RetentionSettings(age=args.days * 24 * 60 * 60, batch=args.batch_size,
+                                                             pause=0.0))
+    archived: int = await retention.run_once()
+    logger.info('Archived %s searches, freed %s pages', archived, retention.stats.vacuumed)
+
+
+async def vacuum(database: BotDatabaseImpl, _: argparse.Namespace) -> None:
+    await database.vacuum()
+    logger.info('Database compacted, incremental vacuum enabled')
+
+
+async def import_index(database: BotDatabaseImpl, args: argparse.Namespace) -> None:
+    if not database.index_enabled:
+        logger.error('Movie index is disabled: SQLite has no FTS5 trigram tokenizer')
+        return
+    index = MovieIndex(database)
+    batch: list[Movie] = []
+    imported: int = 0
+    for movie in dump_readers[args.format](args.path):
+        batch.append(movie)
+        if len(batch) >= args.batch_size:
+            await index.add(dump_source, batch, False)
+            imported += len(batch)
+            batch = []
+            logger.info('Imported %s titles', imported)
+    if batch:
+        await index.add(dump_source, batch, False)
+        imported += len(batch)
+    await database.optimize_index()
+    logger.info('Imported %s titles from %s', imported, args.path)
+
+
+_commands = {
+    'backfill-stats': backfill_stats,
+    'import-index': import_index,
+    'archive-history': archive_history,
+    'vacuum': vacuum,
+}
+
+
+async def _main(args: argparse.Namespace) -> None:
+    database = BotDatabaseImpl(args.database)
+    await database.open()
+    try:
+        await _commands[args.command](database, args)
+    finally:
+        await database.close()
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m core.maintenance', description='Обслуживание базы данных бота')
+    parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'database.db'),
+                        help='путь к базе SQLite (по умолчанию DATABASE_PATH)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('backfill-stats', help='пересчитать таблицу stats по истории поиска и архиву')
+    import_parser = subparsers.add_parser('import-index', help='загрузить выгрузку названий в локальный индекс фильмов')
+    import_parser.add_argument('--format', choices=sorted(dump_readers), required=True,
+                               help='imdb - title.basics.tsv(.gz), tmdb - movie_ids_*.json(.gz)')
+    import_parser.add_argument('--batch-size', type=int, default=10000, help='сколько записей пишем одной транзакцией')
+    import_parser.add_argument('path', help='путь к файлу выгрузки')
+    archive_parser = subparsers.add_parser('archive-history', help='перенести старые поиски в архив и сжать базу')
+    archive_parser.add_argument('--days', type=float, default=RetentionSettings.age / (24 * 60 * 60),
+                                help='переносить поиски старше стольких дней')
+    archive_parser.add_argument('--batch-size', type=int, default=RetentionSettings.batch,
+                                help='сколько поисков переносим одной транзакцией')
+    subparsers.add_parser('vacuum', help='полностью перепаковать базу и включить постепенное сжатие; бот лучше '
+                                         'остановить')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = _parse_args()
+    asyncio.run(_main(args))
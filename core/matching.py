@@ -0,0 +1,114 @@
+import re
+from difflib import SequenceMatcher
+from typing import Optional, Any
+
+from .helpers import clean_title, transliterate, merge_movies
+from .structs import Movie, Candidate
+
+_year_pattern = re.compile(r'\b(?:19|20)\d{2}\b')
+
+# Веса составляющих оценки кандидата: похожесть названия - от 0 до 1, остальное - поправки к ней
+_year_bonus: float = 0.3
+_position_weight: float = 0.2
+_same_title: float = 0.9
+_agreement_bonus: float = 0.5
+
+
+def parse_year(value: Any) -> Optional[int]:
+    found = re.search(r'\d{4}', str(value or ''))
+    return int(found.group()) if found else None
+
+
+# "Дюна 2021" -> ("Дюна", 2021)
+def split_query_year(query: str) -> tuple[str, Optional[int]]:
+    found = _year_pattern.search(query)
+    if not found:
+        return query, None
+    title: str = (query[:found.start()] + query[found.end():]).strip()
+    return (title, int(found.group())) if title else (query, None)
+
+
+def _names(title: Optional[str], original_title: Optional[str]) -> set[str]:
+    names: set[str] = set()
+    for name in (title, original_title):
+        if name:
+            names.update({clean_title(name), transliterate(clean_title(name))})
+    names.discard('')
+    return names
+
+
+def title_similarity(names: set[str], movie: Movie) -> float:
+    return max((SequenceMatcher(None, name, candidate).ratio()
+                for name in names for candidate in _names(movie.title, movie.original_title)), default=0.0)
+
+
+# Оценка кандидата из поисковой выдачи: похожесть названия на запрос, совпадение года, если он указан в запросе,
+# и место в выдаче провайдера, которое решает, когда названия одинаково непохожи (например, запрос на другом языке)
+def score_candidate(query: str, candidate: Movie, position: int, total: int) -> float:
+    title, year = split_query_year(query)
+    # Число из названия ("Бегущий по лезвию 2049") годом не считаем
+    if year and str(year) in _title_words(candidate):
+        title, year = query, None
+    score: float = title_similarity(_names(title, None), candidate)
+    if year and candidate.year:
+        score += _year_bonus if candidate.year == year else -_year_bonus
+    return score + _position_weight * (1 - position / total)
+
+
+def _title_words(movie: Movie) -> set[str]:
+    return {word for name in (movie.title, movie.original_title) if name for word in clean_title(name).split()}
+
+
+def pick_best_candidate(query: str, candidates: list[Movie]) -> Optional[Movie]:
+    if not candidates:
+        return None
+    scores: list[float] = [score_candidate(query, candidate, position, len(candidates))
+                           for position, candidate in enumerate(candidates)]
+    return candidates[scores.index(max(scores))]
+
+
+# Сопоставляем выдачу всех провайдеров до запроса подробностей. Лучшим считается кандидат, у которого
+# собственная оценка плюс лучшие совпадающие с ним кандидаты других провайдеров выше всего. Для остальных провайдеров
+# выбираем совпадающий с ним кандидат, а если такого нет - None: подробности у них не запрашиваем,
+# merge_answers всё равно отбросил бы чужой фильм
+def match_candidates(query: str, candidates: dict[str, list[Candidate]]) -> dict[str, Optional[Candidate]]:
+    scored: dict[str, list[tuple[float, Candidate]]] = {
+        name: [(score_candidate(query, item.movie, position, len(items)), item) for position, item in enumerate(items)]
+        for name, items in candidates.items()
+    }
+    best: Optional[tuple[float, str, Candidate]] = None
+    for name, items in scored.items():
+        for score, item in items:
+            total: float = score + sum(max((other_score + _agreement_bonus for other_score, other in others
+                                            if same_movie(item.movie, other.movie)), default=0.0)
+                                       for other_name, others in scored.items() if other_name != name)
+            if best is None or total > best[0]:
+                best = (total, name, item)
+    result: dict[str, Optional[Candidate]] = {name: None for name in candidates}
+    if best is None:
+        return result
+    _, anchor_name, anchor = best
+    result[anchor_name] = anchor
+    for name, items in scored.items():
+        if name != anchor_name:
+            matching: list[tuple[float, Candidate]] = [(score, item) for score, item in items
+                                                       if same_movie(anchor.movie, item.movie)]
+            result[name] = max(matching, key=lambda pair: pair[0])[1] if matching else None
+    return result
+
+
+# Один ли это фильм у разных провайдеров: по IMDB id, если он есть у обоих, иначе по названию и году
+def same_movie(first: Movie, second: Movie) -> bool:
+    if first.id_imdb and second.id_imdb:
+        return first.id_imdb == second.id_imdb
+    if not first.year or not second.year or abs(first.year - second.year) > 1:
+        return False
+    return title_similarity(_names(first.title, first.original_title), second) >= _same_title
+
+
+# Сводим ответы движков: первый найденный фильм дополняем ответами остальных, если это тот же фильм
+def merge_answers(movies: list[Optional[Movie]]) -> Optional[Movie]:
+    found: list[Movie] = [movie for movie in movies if movie]
+    if not found:
+        return None
+    return merge_movies([found[0]] + [movie for movie in found[1:] if same_movie(found[0], movie)])
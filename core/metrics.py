@@ -0,0 +1,366 @@
+import contextlib
+import logging
+import random
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields, is_dataclass
+from typing import Optional, Any, Callable, AsyncIterator, Iterator
+
+from aiohttp import web
+
+from config_data.settings import MetricsSettings
+
+from .database import BotDatabase, BotDatabaseDecorator
+from .resilience import CircuitBreaker
+from .scrapper import Scrapper, ScrapperDecorator
+from .search import SearchEngine, SearchEngineDecorator
+from .structs import SearchEntity, StatsEntity, Movie, CachedMovie, CachedLink, CachedPoster, IndexedMovie, \
+    QueryCount, Candidate
+
+logger = logging.getLogger(__name__)
+
+_default_buckets: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    type: str = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    # Для счётчиков, которые уже ведут сами компоненты (кэши, предохранители): переносим их значение как есть
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for labels, value in self.values.items():
+            yield self.name, dict(zip(self.labels, labels)), value
+
+
+class Gauge(Counter):
+    type: str = 'gauge'
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    type: str = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...],
+                 buckets: tuple[float, ...] = _default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts, total = self.values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        total[0] += value
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for labels, (counts, total) in self.values.items():
+            base: dict[str, str] = dict(zip(self.labels, labels))
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', {**base, 'le': repr(bound)}, count
+            yield f'{self.name}_bucket', {**base, 'le': '+Inf'}, counts[-1]
+            yield f'{self.name}_sum', base, total[0]
+            yield f'{self.name}_count', base, counts[-1]
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics: list[Any] = []
+        self._collectors: list[Callable[[], None]] = []
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Histogram:
+        return self._register(Histogram(name, documentation, labels))
+
+    # Колбэк вызывается перед каждой выдачей метрик и обновляет значения, которые снимаются с компонентов
+    def on_collect(self, collector: Callable[[], None]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception('Metrics collector failed')
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric: Any) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    @staticmethod
+    def _format_labels(labels: dict[str, str]) -> str:
+        if not labels:
+            return ''
+        escaped: list[str] = []
+        for key, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+
+@dataclass
+class Trace:
+    name: str
+    started: float = field(default_factory=time.monotonic)
+    stages: list[tuple[str, float, float, bool]] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        total: float = time.monotonic() - self.started
+        stages: str = ', '.join(f'{name} {start:.3f}+{duration:.3f}s{"" if ok else " failed"}'
+                                for name, start, duration, ok in self.stages)
+        return f'{self.name} {total:.3f}s: {stages}'
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+
+
+# Гистограммы задержек, счётчики ошибок и число выполняющихся вызовов по стадиям поиска:
+# stage - вид стадии (engine, scrapper, database, telegram, command), name - провайдер, метод или команда
+class Metrics:
+
+    def __init__(self, settings: Optional[MetricsSettings] = None, registry: Optional[MetricsRegistry] = None):
+        self.settings = settings or MetricsSettings()
+        self.registry = registry or MetricsRegistry()
+        self.latency = self.registry.histogram('cinemabot_stage_seconds', 'Stage latency', ('stage', 'name'))
+        self.errors = self.registry.counter('cinemabot_stage_errors_total', 'Failed stage calls', ('stage', 'name'))
+        self.in_flight = self.registry.gauge('cinemabot_stage_in_flight', 'Stage calls in progress', ('stage', 'name'))
+        self.shed = self.registry.counter('cinemabot_shed_total', 'Updates rejected under load', ('command',))
+
+    @contextlib.asynccontextmanager
+    async def measure(self, stage: str, name: str) -> AsyncIterator[None]:
+        started: float = time.monotonic()
+        ok: bool = False
+        self.in_flight.inc(stage, name)
+        try:
+            yield
+            ok = True
+        finally:
+            duration: float = time.monotonic() - started
+            self.in_flight.dec(stage, name)
+            self.latency.observe(duration, stage, name)
+            if not ok:
+                self.errors.inc(stage, name)
+            trace: Optional[Trace] = _current_trace.get()
+            if trace is not None:
+                trace.stages.append((f'{stage}:{name}', started - trace.started, duration, ok))
+
+    # Для доли trace_sample запросов пишем в лог все стадии, пройденные внутри этого блока
+    @contextlib.contextmanager
+    def trace(self, name: str) -> Iterator[None]:
+        if self.settings.trace_sample <= 0 or random.random() >= self.settings.trace_sample:
+            yield
+            return
+        trace = Trace(name)
+        token = _current_trace.set(trace)
+        try:
+            yield
+        finally:
+            _current_trace.reset(token)
+            logger.info('Trace %s', trace)
+
+    # Снимаем при выдаче метрик статистику, которую уже ведут кэши, предохранители и очереди
+    def export_stats(self, caches: dict[str, Any], breakers: dict[str, CircuitBreaker],
+                     gauges: dict[str, Callable[[], float]]) -> None:
+        cache_events = self.registry.counter('cinemabot_cache_events_total', 'Cache lookups by outcome',
+                                             ('cache', 'event'))
+        breaker_state = self.registry.gauge('cinemabot_breaker_state', 'Circuit state: 0 closed, 1 half-open, 2 open',
+                                            ('provider',))
+        breaker_trips = self.registry.counter('cinemabot_breaker_trips_total', 'Circuit trips', ('provider',))
+        breaker_rejected = self.registry.counter('cinemabot_breaker_rejected_total', 'Calls rejected by open circuit',
+                                                 ('provider',))
+        values = self.registry.gauge('cinemabot_component_value', 'Queue depths and other component values',
+                                     ('component',))
+        states: dict[str, int] = {CircuitBreaker.closed: 0, CircuitBreaker.half_open: 1, CircuitBreaker.open: 2}
+
+        def collect() -> None:
+            for cache, component in caches.items():
+                stats = component.stats
+                for stats_field in fields(stats) if is_dataclass(stats) else ():
+                    cache_events.set(getattr(stats, stats_field.name), cache, stats_field.name)
+            for provider, breaker in breakers.items():
+                breaker_state.set(states[breaker.state], provider)
+                breaker_trips.set(breaker.trips, provider)
+                breaker_rejected.set(breaker.rejected, provider)
+            for component, value in gauges.items():
+                values.set(value(), component)
+
+        self.registry.on_collect(collect)
+
+
+class MetricsServer:
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        if self._runner is not None or not self.metrics.settings.port:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.metrics.settings.host, self.metrics.settings.port).start()
+        logger.info('Metrics on http://%s:%s/metrics', self.metrics.settings.host, self.metrics.settings.port)
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_metrics(self, _: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.registry.render(), content_type='text/plain', charset='utf-8')
+
+
+class InstrumentedSearchEngine(SearchEngineDecorator):
+
+    def __init__(self, engine: SearchEngine, name: str, metrics: Metrics):
+        super().__init__(engine)
+        self.name = name
+        self.metrics = metrics
+
+    async def search_movie(self, query: str) -> Optional[Movie]:
+        async with self.metrics.measure('engine', self.name):
+            return await self.engine.search_movie(query)
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        async with self.metrics.measure('engine', self.name):
+            return await self.engine.search_candidates(query)
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        async with self.metrics.measure('details', self.name):
+            return await self.engine.get_movie(query, candidate)
+
+
+class InstrumentedScrapper(ScrapperDecorator):
+
+    def __init__(self, scrapper: Scrapper, name: str, metrics: Metrics):
+        super().__init__(scrapper)
+        self.name = name
+        self.metrics = metrics
+
+    async def get_top_link(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
+        async with self.metrics.measure('scrapper', self.name):
+            return await self.scrapper.get_top_link(query, cite, key)
+
+
+class InstrumentedDatabase(BotDatabaseDecorator):
+
+    def __init__(self, database: BotDatabase, metrics: Metrics):
+        super().__init__(database)
+        self.metrics = metrics
+
+    async def save_search_entity(self, entity: SearchEntity) -> None:
+        async with self.metrics.measure('database', 'save_search_entity'):
+            await super().save_search_entity(entity)
+
+    async def save_search_entities(self, entities: list[SearchEntity]) -> None:
+        async with self.metrics.measure('database', 'save_search_entities'):
+            await super().save_search_entities(entities)
+
+    async def load_search_entities(self, chat_id: int) -> list[SearchEntity]:
+        async with self.metrics.measure('database', 'load_search_entities'):
+            return await super().load_search_entities(chat_id)
+
+    async def load_search_page(self, chat_id: int, limit: int,
+                               before: Optional[tuple[int, int]] = None,
+                               after: Optional[tuple[int, int]] = None) -> list[SearchEntity]:
+        async with self.metrics.measure('database', 'load_search_page'):
+            return await super().load_search_page(chat_id, limit, before, after)
+
+    async def load_stats_entities(self, chat_id: int) -> list[StatsEntity]:
+        async with self.metrics.measure('database', 'load_stats_entities'):
+            return await super().load_stats_entities(chat_id)
+
+    async def load_query_counts(self, since: int) -> list[QueryCount]:
+        async with self.metrics.measure('database', 'load_query_counts'):
+            return await super().load_query_counts(since)
+
+    async def load_cached_movie(self, engine: str, query: str) -> Optional[CachedMovie]:
+        async with self.metrics.measure('database', 'load_cached_movie'):
+            return await super().load_cached_movie(engine, query)
+
+    async def save_cached_movie(self, engine: str, query: str, movie: Optional[Movie], cached_at: float) -> None:
+        async with self.metrics.measure('database', 'save_cached_movie'):
+            await super().save_cached_movie(engine, query, movie, cached_at)
+
+    async def load_cached_link(self, key: str, site: str) -> Optional[CachedLink]:
+        async with self.metrics.measure('database', 'load_cached_link'):
+            return await super().load_cached_link(key, site)
+
+    async def save_cached_link(self, key: str, site: str, link: Optional[str], cached_at: float) -> None:
+        async with self.metrics.measure('database', 'save_cached_link'):
+            await super().save_cached_link(key, site, link, cached_at)
+
+    async def load_cached_poster(self, key: str) -> Optional[CachedPoster]:
+        async with self.metrics.measure('database', 'load_cached_poster'):
+            return await super().load_cached_poster(key)
+
+    async def save_cached_poster(self, key: str, poster: str, file_id: str, cached_at: float) -> None:
+        async with self.metrics.measure('database', 'save_cached_poster'):
+            await super().save_cached_poster(key, poster, file_id, cached_at)
+
+    async def delete_cached_poster(self, key: str) -> None:
+        async with self.metrics.measure('database', 'delete_cached_poster'):
+            await super().delete_cached_poster(key)
+
+    async def load_index_candidates(self, match: str, sources: list[str], limit: int) -> list[IndexedMovie]:
+        async with self.metrics.measure('database', 'load_index_candidates'):
+            return await super().load_index_candidates(match, sources, limit)
+
+    async def save_indexed_movies(self, entries: list[IndexedMovie]) -> None:
+        async with self.metrics.measure('database', 'save_indexed_movies'):
+            await super().save_indexed_movies(entries)
+
+
+# Обёртка над aiogram.Bot: вызовы Telegram API, которые делает BotApiImpl, попадают в метрики,
+# остальные атрибуты отдаются как есть
+class InstrumentedBot:
+    instrumented: frozenset[str] = frozenset({
+        'send_message', 'send_photo', 'edit_message_text', 'edit_message_caption', 'answer_inline_query',
+        'answer_callback_query', 'download', 'download_file_by_id',
+    })
+
+    def __init__(self, bot: Any, metrics: Metrics):
+        self.bot = bot
+        self.metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        attribute: Any = getattr(self.bot, name)
+        if name not in self.instrumented:
+            return attribute
+
+        async def measured(*args: Any, **kwargs: Any) -> Any:
+            async with self.metrics.measure('telegram', name):
+                return await attribute(*args, **kwargs)
+
+        return measured
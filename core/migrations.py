@@ -0,0 +1,143 @@
+import logging
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Полнотекстовый индекс по названиям фильмов. Триграммный токенизатор FTS5 есть только в SQLite 3.34+:
+# на более старой версии эти запросы пропускаем, и локальный индекс фильмов отключён
+_index_fts: list[str] = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movie_index_fts USING fts5(names, content='movie_index', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS movie_index_insert AFTER INSERT ON movie_index BEGIN "
+    "INSERT INTO movie_index_fts (rowid, names) VALUES (new.id, new.names); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_index_delete AFTER DELETE ON movie_index BEGIN "
+    "INSERT INTO movie_index_fts (movie_index_fts, rowid, names) VALUES ('delete', old.id, old.names); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_index_update AFTER UPDATE ON movie_index BEGIN "
+    "INSERT INTO movie_index_fts (movie_index_fts, rowid, names) VALUES ('delete', old.id, old.names); "
+    "INSERT INTO movie_index_fts (rowid, names) VALUES (new.id, new.names); END",
+]
+
+# Каждая миграция - список запросов, выполняемых в одной транзакции.
+# Номер версии схемы = индекс миграции + 1, хранится в PRAGMA user_version.
+# Уже выпущенные миграции не меняем, только дописываем новые в конец.
+_migrations: list[list[str]] = [
+    [
+        "CREATE TABLE IF NOT EXISTS history (chat_id INTEGER, text STRING, title STRING, search_time TIMESTAMP, kp_id INTEGER, tmdb_id INTEGER)",
+        "CREATE TABLE IF NOT EXISTS movie_cache (engine TEXT, query TEXT, movie TEXT, cached_at REAL, PRIMARY KEY (engine, query))",
+        "CREATE TABLE IF NOT EXISTS link_cache (key TEXT, site TEXT, link TEXT, cached_at REAL, PRIMARY KEY (key, site))",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS history_chat_time ON history (chat_id, search_time)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS stats (chat_id INTEGER, kp_id INTEGER, tmdb_id INTEGER, title STRING, count INTEGER, PRIMARY KEY (chat_id, kp_id, tmdb_id, title))",
+        "CREATE INDEX IF NOT EXISTS stats_chat_count ON stats (chat_id, count DESC)",
+        "INSERT OR REPLACE INTO stats SELECT chat_id, kp_id, tmdb_id, title, COUNT(*) FROM history GROUP BY chat_id, kp_id, tmdb_id, title",
+    ],
+    [
+        # search_time хранился строкой локального времени, переводим в unix-время
+        "UPDATE history SET search_time = CAST(strftime('%s', search_time, 'utc') AS INTEGER) WHERE typeof(search_time) = 'text'",
+    ],
+    [
+        # Локальный индекс фильмов: source - движок, вернувший фильм, либо dump для записей из выгрузок.
+        # names - все известные названия и их транслитерации через перевод строки, по ним строится триграммный FTS5
+        "CREATE TABLE IF NOT EXISTS movie_index (id INTEGER PRIMARY KEY, source TEXT, key TEXT, movie TEXT, complete INTEGER, names TEXT, updated_at REAL, UNIQUE (source, key))",
+        *_index_fts,
+    ],
+    [
+        # file_id постера в Telegram; poster - адрес, с которого он был загружен, чтобы заметить смену постера
+        "CREATE TABLE IF NOT EXISTS poster_cache (key TEXT PRIMARY KEY, poster TEXT, file_id TEXT, cached_at REAL)",
+    ],
+    [
+        # Популярные запросы по всем чатам за последние дни для прогрева кэша
+        "CREATE INDEX IF NOT EXISTS history_time ON history (search_time)",
+    ],
+    [
+        # Архив старой истории: строки запросов и названий хранятся один раз в history_strings,
+        # поиски одного чата за день с одним результатом свёрнуты в одну строку со счётчиком. 0 - строки нет
+        "CREATE TABLE IF NOT EXISTS history_strings (id INTEGER PRIMARY KEY, value TEXT UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS history_archive (chat_id INTEGER, day INTEGER, query_id INTEGER, title_id INTEGER, kp_id INTEGER, tmdb_id INTEGER, count INTEGER, PRIMARY KEY (chat_id, day, query_id, title_id, kp_id, tmdb_id)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS history_archive_day ON history_archive (day)",
+    ],
+    [
+        # NULL в ключе stats не даёт сработать ON CONFLICT, и каждый поиск без результата или без одного из id
+        # заводил новую строку. Ключ теперь NOT NULL: -1 - нет id, '' - нет названия; дубликаты сливаем
+        "CREATE TABLE stats_merged (chat_id INTEGER NOT NULL, kp_id INTEGER NOT NULL, tmdb_id INTEGER NOT NULL, title STRING NOT NULL, count INTEGER, PRIMARY KEY (chat_id, kp_id, tmdb_id, title))",
+        "INSERT INTO stats_merged SELECT chat_id, IFNULL(kp_id, -1), IFNULL(tmdb_id, -1), IFNULL(title, ''), SUM(count) FROM stats GROUP BY 1, 2, 3, 4",
+        "DROP TABLE stats",
+        "ALTER TABLE stats_merged RENAME TO stats",
+        "CREATE INDEX IF NOT EXISTS stats_chat_count ON stats (chat_id, count DESC)",
+    ],
+    [
+        # Курсоры /history в уже отправленных кнопках - (search_time, rowid), а VACUUM может перенумеровать rowid
+        # таблицы без INTEGER PRIMARY KEY. Делаем его явным id с прежними значениями, чтобы старые кнопки работали
+        "CREATE TABLE history_keyed (id INTEGER PRIMARY KEY, chat_id INTEGER, text STRING, title STRING, search_time TIMESTAMP, kp_id INTEGER, tmdb_id INTEGER)",
+        "INSERT INTO history_keyed SELECT rowid, chat_id, text, title, search_time, kp_id, tmdb_id FROM history",
+        "DROP TABLE history",
+        "ALTER TABLE history_keyed RENAME TO history",
+        "CREATE INDEX IF NOT EXISTS history_chat_time ON history (chat_id, search_time)",
+        "CREATE INDEX IF NOT EXISTS history_time ON history (search_time)",
+    ],
+]
+
+_pragmas: list[str] = [
+    # Действует только на новую базу; существующую переводит python -m core.maintenance vacuum
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA busy_timeout = 5000",
+]
+
+
+async def apply_pragmas(connection: aiosqlite.Connection) -> None:
+    for pragma in _pragmas:
+        await connection.execute(pragma)
+
+
+async def get_schema_version(connection: aiosqlite.Connection) -> int:
+    cursor = await connection.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def supports_trigram(connection: aiosqlite.Connection) -> bool:
+    try:
+        await connection.execute("CREATE VIRTUAL TABLE temp.trigram_probe USING fts5(names, tokenize='trigram')")
+        await connection.execute("DROP TABLE temp.trigram_probe")
+    except aiosqlite.OperationalError:
+        return False
+    return True
+
+
+async def migrate(connection: aiosqlite.Connection, trigram: bool = True) -> int:
+    version: int = await get_schema_version(connection)
+    for target in range(version + 1, len(_migrations) + 1):
+        logger.info('Migrating database schema to version %s', target)
+        await _apply(connection, [statement for statement in _migrations[target - 1]
+                                  if trigram or statement not in _index_fts], target)
+    if trigram and not await _has_table(connection, 'movie_index_fts'):
+        # База создана на SQLite без триграмм: достраиваем полнотекстовый индекс по уже сохранённым фильмам
+        logger.info('Building movie index full-text search')
+        await _apply(connection, _index_fts + ["INSERT INTO movie_index_fts (movie_index_fts) VALUES ('rebuild')"],
+                     len(_migrations))
+    return len(_migrations)
+
+
+async def _apply(connection: aiosqlite.Connection, statements: list[str], version: int) -> None:
+    await connection.execute("BEGIN")
+    try:
+        for statement in statements:
+            await connection.execute(statement)
+        await connection.execute(f"PRAGMA user_version = {version}")
+        await connection.commit()
+    except Exception:
+        await connection.rollback()
+        raise
+
+
+async def _has_table(connection: aiosqlite.Connection, name: str) -> bool:
+    cursor = await connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return await cursor.fetchone() is not None
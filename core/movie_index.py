@@ -0,0 +1,208 @@
+import csv
+import gzip
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass, replace
+from difflib import SequenceMatcher
+from typing import Optional, Iterator, TextIO, Callable
+
+from config_data.settings import IndexSettings
+
+from .database import BotDatabase
+from .helpers import movie_key, transliterate, clean_title, BackgroundTasks, is_refreshing
+from .search import SearchEngine, SearchEngineDecorator
+from .structs import Movie, IndexedMovie, Candidate
+
+logger = logging.getLogger(__name__)
+
+# Источник для записей из выгрузок: в них только названия и идентификаторы, без описания и постера
+dump_source: str = 'dump'
+
+
+@dataclass
+class IndexStats:
+    hits: int = 0       # Ответили из индекса, не обращаясь к провайдеру
+    rewrites: int = 0   # Нашли запись из выгрузки или устаревшую и искали у провайдера по её точному названию
+    stale: int = 0      # Из них устаревших полных записей
+    misses: int = 0
+
+    def __str__(self) -> str:
+        return f'hits={self.hits} rewrites={self.rewrites} stale={self.stale} misses={self.misses}'
+
+
+def index_names(movie: Movie) -> list[str]:
+    names: list[str] = []
+    for title in (movie.title, movie.original_title):
+        if not title:
+            continue
+        for name in (clean_title(title), transliterate(clean_title(title))):
+            if name and name not in names:
+                names.append(name)
+    return names
+
+
+def _trigrams(text: str) -> list[str]:
+    return [text[i:i + 3] for i in range(len(text) - 2)]
+
+
+class MovieIndex:
+
+    def __init__(self, database: BotDatabase, settings: Optional[IndexSettings] = None):
+        self.database = database
+        self.settings = settings or IndexSettings()
+
+    async def find(self, query: str, sources: list[str]) -> Optional[IndexedMovie]:
+        ranked: list[IndexedMovie] = await self._ranked(query, sources, self._similarity)
+        return ranked[0] if ranked else None
+
+    # Подсказки для недописанного запроса: сравниваем и с названием целиком, и с его началом той же длины
+    async def complete(self, query: str, sources: list[str], limit: int) -> list[IndexedMovie]:
+        result: dict[str, IndexedMovie] = {}
+        for entry in await self._ranked(query, sources, self._prefix_similarity):
+            result.setdefault(movie_key(entry.movie), entry)
+        return list(result.values())[:limit]
+
+    async def _ranked(self, query: str, sources: list[str],
+                      similarity: Callable[[str, str], float]) -> list[IndexedMovie]:
+        variants: list[str] = [name for name in {clean_title(query), transliterate(clean_title(query))} if len(name) >= 3]
+        if not variants:
+            return []
+        trigrams: list[str] = list(dict.fromkeys(trigram for name in variants for trigram in _trigrams(name)))
+        match: str = ' OR '.join('"' + trigram.replace('"', '""') + '"'
+                                 for trigram in trigrams[:self.settings.max_trigrams])
+        candidates: list[IndexedMovie] = await self.database.load_index_candidates(match, sources,
+                                                                                   self.settings.candidates)
+        ranked: list[tuple[tuple[float, bool], IndexedMovie]] = []
+        for candidate in candidates:
+            score: float = max((similarity(variant, name)
+                                for variant in variants for name in candidate.names.split('\n')), default=0.0)
+            if score >= self.settings.min_score:
+                ranked.append(((score, candidate.complete), candidate))
+        # При равной похожести полные записи от движков лучше записей из выгрузок
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return [candidate for _, candidate in ranked]
+
+    # Числа в названии не прощаем: "Брат" и "Брат 2" похожи по буквам, но это разные фильмы
+    @staticmethod
+    def _similarity(query: str, name: str) -> float:
+        if re.findall(r'\d+', query) != re.findall(r'\d+', name):
+            return 0.0
+        return SequenceMatcher(None, query, name).ratio()
+
+    @classmethod
+    def _prefix_similarity(cls, query: str, name: str) -> float:
+        return max(cls._similarity(query, name), SequenceMatcher(None, query, name[:len(query)]).ratio())
+
+    # Полная запись от движка, которой можно ответить без провайдера: рейтинги и описания со временем меняются
+    def is_fresh(self, entry: IndexedMovie) -> bool:
+        return entry.complete and time.time() - entry.updated_at < self.settings.max_age
+
+    async def add(self, source: str, movies: list[Movie], complete: bool) -> None:
+        entries: list[IndexedMovie] = [IndexedMovie(source, movie, complete, '\n'.join(index_names(movie)))
+                                       for movie in movies]
+        await self.database.save_indexed_movies([entry for entry in entries if entry.names])
+
+
+# Отвечает из локального индекса, если движок уже возвращал этот фильм; к провайдеру идёт только на промахе
+# и пополняет индекс его ответом
+class IndexedSearchEngine(SearchEngineDecorator):
+
+    def __init__(self, engine: SearchEngine, name: str, index: MovieIndex):
+        super().__init__(engine)
+        self.name = name
+        self.index = index
+        self.stats = IndexStats()
+        self._background = BackgroundTasks()
+
+    async def search_movie(self, query: str) -> Optional[Movie]:
+        found: Optional[IndexedMovie] = await self._find(query)
+        if found is not None and self.index.is_fresh(found):
+            self.stats.hits += 1
+            return replace(found.movie)
+
+        movie: Optional[Movie] = None
+        if found is not None:
+            # Запись из выгрузки или устаревшая: запрос с опечаткой или транслитом заменяем точным названием
+            self._count_rewrite(found)
+            movie = await self.engine.search_movie(found.movie.original_title or found.movie.title)
+        if movie is None:
+            if found is None:
+                self.stats.misses += 1
+            movie = await self.engine.search_movie(query)
+        if movie is not None:
+            self._remember(movie)
+        return movie
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        found: Optional[IndexedMovie] = await self._find(query)
+        if found is not None and self.index.is_fresh(found):
+            self.stats.hits += 1
+            return [Candidate(replace(found.movie), True)]
+        candidates: list[Candidate] = []
+        if found is not None:
+            self._count_rewrite(found)
+            candidates = await self.engine.search_candidates(found.movie.original_title or found.movie.title)
+        if not candidates:
+            if found is None:
+                self.stats.misses += 1
+            candidates = await self.engine.search_candidates(query)
+        return candidates
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        movie: Optional[Movie] = await self.engine.get_movie(query, candidate)
+        if movie is not None and not candidate.complete:
+            self._remember(movie)
+        return movie
+
+    async def _find(self, query: str) -> Optional[IndexedMovie]:
+        try:
+            # При обновлении в обход кэшей идём к провайдеру и перезаписываем запись индекса
+            if not is_refreshing():
+                return await self.index.find(query, [self.name, dump_source])
+        except Exception as error:
+            logger.warning('Movie index lookup failed: %r', error)
+        return None
+
+    def _count_rewrite(self, found: IndexedMovie) -> None:
+        self.stats.rewrites += 1
+        if found.complete:
+            self.stats.stale += 1
+
+    def _remember(self, movie: Movie) -> None:
+        self._background.spawn(self.index.add(self.name, [replace(movie)], True), f'Indexing {self.name} movie')
+
+
+# Разбор выгрузок для заполнения индекса: IMDb title.basics.tsv(.gz) и ежедневный экспорт TMDB movie_ids_*.json(.gz)
+def _open_dump(path: str) -> TextIO:
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_imdb_basics(path: str) -> Iterator[Movie]:
+    with _open_dump(path) as dump:
+        for row in csv.DictReader(dump, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if row.get('titleType') not in ('movie', 'tvMovie', 'tvSeries', 'tvMiniSeries'):
+                continue
+            original: Optional[str] = row.get('originalTitle') if row.get('originalTitle') != '\\N' else None
+            yield Movie(title=row.get('primaryTitle'), original_title=original, id_imdb=row.get('tconst'))
+
+
+def read_tmdb_export(path: str) -> Iterator[Movie]:
+    with _open_dump(path) as dump:
+        for line in dump:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if item.get('adult'):
+                continue
+            yield Movie(title=item.get('original_title'), original_title=item.get('original_title'),
+                        id_tmdb=item.get('id'))
+
+
+dump_readers = {
+    'imdb': read_imdb_basics,
+    'tmdb': read_tmdb_export,
+}
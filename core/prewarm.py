@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional, Callable
+
+from config_data.settings import PrewarmSettings, ProviderLimits
+
+from .bot_core import BotApiImpl, search_across
+from .cache import CachingSearchEngine, CachingScrapper
+from .database import BotDatabase
+from .helpers import normalize_query, movie_key, refreshing
+from .search import SearchEngine, SearchEngineDecorator
+from .structs import Movie, Candidate, QueryCount
+from .throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PrewarmStats:
+    rounds: int = 0
+    queries: int = 0   # Сколько популярных запросов проверили
+    movies: int = 0    # Сколько раз обновили ответ движка
+    links: int = 0     # Сколько раз обновили ссылку на кинотеатр
+    skipped: int = 0   # Не хватило доли квоты, отложили до следующего круга
+
+    def __str__(self) -> str:
+        return f'rounds={self.rounds} queries={self.queries} movies={self.movies} links={self.links} ' \
+               f'skipped={self.skipped}'
+
+
+# Самые популярные запросы по всем чатам: каждый поиск весит тем меньше, чем он старше.
+# Название найденного фильма тоже считаем запросом: его часто набирают другие пользователи
+def rank_queries(counts: list[QueryCount], now: float, half_life: float, top: int) -> list[str]:
+    scores: dict[str, float] = {}
+    queries: dict[str, str] = {}
+    for item in counts:
+        weight: float = item.count * 0.5 ** (max(now - item.hour, 0.0) / half_life)
+        for text in (item.text, item.title):
+            key: str = normalize_query(text or '')
+            if not key:
+                continue
+            scores[key] = scores.get(key, 0.0) + weight
+            queries.setdefault(key, text)
+    return [queries[key] for key in sorted(scores, key=scores.__getitem__, reverse=True)[:top]]
+
+
+# Движок, который на время вызова обходит все кэши и перезаписывает их свежим ответом
+class _RefreshingSearchEngine(SearchEngineDecorator):
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        with refreshing():
+            return await self.engine.search_candidates(query)
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        with refreshing():
+            return await self.engine.get_movie(query, candidate)
+
+
+# Фоновый прогрев: заранее обновляет ответы движков и ссылки для популярных запросов, пока они не устарели.
+# К каждому провайдеру ходит не чаще quota_share от его квоты и не мешает очереди поисков пользователей
+class Prewarmer:
+    # Обновление ответа движка - поиск и запрос подробностей
+    movie_cost: int = 2
+
+    def __init__(self, database: BotDatabase, engines: dict[str, CachingSearchEngine], scrapper: CachingScrapper,
+                 providers: dict[str, ProviderLimits], settings: Optional[PrewarmSettings] = None,
+                 is_busy: Optional[Callable[[], bool]] = None, scrapper_provider: str = 'serpapi'):
+        self.database = database
+        self.engines = engines
+        self.scrapper = scrapper
+        self.settings = settings or PrewarmSettings()
+        self.is_busy = is_busy
+        self.scrapper_provider = scrapper_provider
+        self.stats = PrewarmStats()
+        self._budgets: dict[str, TokenBucket] = {
+            name: TokenBucket(limits.rate * self.settings.quota_share,
+                              max(int(limits.burst * self.settings.quota_share), self.movie_cost))
+            for name, limits in providers.items()
+        }
+        self._worker: Optional[asyncio.Task] = None
+
+    # warm_up - прогреть сразу при старте, иначе первый круг через interval
+    async def start(self, warm_up: bool = True) -> None:
+        if self.settings.interval > 0 and (self._worker is None or self._worker.done()):
+            self._worker = asyncio.ensure_future(self._run(0.0 if warm_up else self.settings.interval))
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    async def warm(self) -> None:
+        counts: list[QueryCount] = await self.database.load_query_counts(int(time.time() - self.settings.window))
+        for query in rank_queries(counts, time.time(), self.settings.half_life, self.settings.top):
+            await self._wait_until_idle()
+            self.stats.queries += 1
+            try:
+                await self._warm_query(query)
+            except Exception as error:
+                logger.warning('Prewarming %r failed: %r', query, error)
+        self.stats.rounds += 1
+
+    async def _run(self, delay: float) -> None:
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.settings.interval
+            try:
+                await self.warm()
+            except Exception:
+                logger.exception('Prewarm round failed')
+
+    # Фильм выбираем так же, как для пользователя (search_across): устаревшие движки обновляем в обход кэшей,
+    # свежие отвечают из кэша
+    async def _warm_query(self, query: str) -> None:
+        engines: dict[str, SearchEngine] = {}
+        for name, engine in self.engines.items():
+            engines[name] = engine
+            if await engine.freshness(query) <= self.settings.ahead and await self._spend(name, self.movie_cost):
+                engines[name] = _RefreshingSearchEngine(engine)
+                self.stats.movies += 1
+        movie: Optional[Movie] = await search_across(engines, query, None)
+        if movie is None:
+            return
+        for site in BotApiImpl.sites_to_watch_online:
+            if await self.scrapper.freshness(movie.title, site, movie_key(movie)) > self.settings.ahead:
+                continue
+            if await self._spend(self.scrapper_provider, 1):
+                await self.scrapper.refresh(movie.title, site, movie_key(movie))
+                self.stats.links += 1
+
+    async def _spend(self, provider: str, calls: int) -> bool:
+        budget: Optional[TokenBucket] = self._budgets.get(provider)
+        if budget is None:
+            return True
+        for _ in range(calls):
+            if not await budget.acquire(self.settings.interval):
+                self.stats.skipped += 1
+                return False
+        return True
+
+    async def _wait_until_idle(self) -> None:
+        while self.is_busy is not None and self.is_busy():
+            await asyncio.sleep(self.settings.idle_poll)
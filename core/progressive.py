@@ -0,0 +1,50 @@
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+
+# Сообщение с баннером, которое дописывается по мере поступления данных.
+# Правки идут по одной: пока одна отправляется, промежуточные версии схлопываются в последнюю
+class ProgressiveReply:
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int, with_photo: bool, text: str,
+                 parse_mode: Optional[str] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.parse_mode = parse_mode
+        self.edits: int = 0
+        self._with_photo = with_photo
+        self._shown: Optional[str] = text
+        self._wanted: Optional[str] = None
+        self._editor: Optional[asyncio.Task] = None
+
+    def update(self, text: str) -> None:
+        self._wanted = text
+        if self._editor is None or self._editor.done():
+            self._editor = asyncio.ensure_future(self._edit_until_current())
+
+    async def finish(self, text: str) -> None:
+        self._wanted = text
+        if self._editor is not None:
+            await self._editor
+        await self._edit_until_current()
+
+    async def _edit_until_current(self) -> None:
+        while self._wanted is not None and self._wanted != self._shown:
+            text: str = self._wanted
+            try:
+                if self._with_photo:
+                    await self.bot.edit_message_caption(chat_id=self.chat_id, message_id=self.message_id,
+                                                        caption=text, parse_mode=self.parse_mode)
+                else:
+                    await self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id,
+                                                     parse_mode=self.parse_mode)
+                self.edits += 1
+            except Exception as error:
+                logger.warning('Failed to edit message %s in chat %s: %r', self.message_id, self.chat_id, error)
+            self._shown = text
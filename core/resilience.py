@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Optional, Any, Awaitable, Callable
+
+from config_data.settings import BreakerSettings
+
+from .search import SearchEngine, SearchEngineDecorator
+from .structs import Movie, Candidate
+from .throttling import UpstreamError, local_errors, tracking_queue_wait
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    closed: str = 'closed'
+    open: str = 'open'
+    half_open: str = 'half_open'
+
+    def __init__(self, name: str, settings: Optional[BreakerSettings] = None):
+        self.name = name
+        self.settings = settings or BreakerSettings()
+        self.state: str = self.closed
+        self.rejected: int = 0
+        self.trips: int = 0
+        self._calls: deque[tuple[bool, float]] = deque(maxlen=self.settings.window)
+        self._opened_at: float = 0.0
+        self._probe_in_flight: bool = False
+
+    def allow(self) -> bool:
+        if self.state == self.open and time.monotonic() - self._opened_at >= self.settings.open_timeout:
+            self._set_state(self.half_open)
+        if self.state == self.closed:
+            return True
+        if self.state == self.half_open and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record(self, success: bool, latency: float) -> None:
+        success = success and latency < self.settings.slow_call
+        self._calls.append((success, latency))
+        if self.state == self.half_open:
+            self._probe_in_flight = False
+            if success:
+                self._calls.clear()
+                self._set_state(self.closed)
+            else:
+                self._trip()
+        elif self.state == self.closed and self._should_trip():
+            self._trip()
+
+    # Вызов отменили снаружи (хедж, дедлайн): о провайдере это ничего не говорит, только освобождаем пробу
+    def release(self) -> None:
+        self._probe_in_flight = False
+
+    def latency_quantile(self, quantile: float) -> Optional[float]:
+        latencies: list[float] = sorted(latency for success, latency in self._calls if success)
+        if len(latencies) < self.settings.min_calls:
+            return None
+        return latencies[min(int(len(latencies) * quantile), len(latencies) - 1)]
+
+    def error_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(1 for success, _ in self._calls if not success) / len(self._calls)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            'state': self.state,
+            'error_rate': self.error_rate(),
+            'p95': self.latency_quantile(0.95),
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
+
+    def _should_trip(self) -> bool:
+        return len(self._calls) >= self.settings.min_calls and self.error_rate() >= self.settings.error_rate
+
+    def _trip(self) -> None:
+        self.trips += 1
+        self._opened_at = time.monotonic()
+        self._set_state(self.open)
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning('Circuit %s: %s -> %s', self.name, self.state, state)
+            self.state = state
+
+
+class CircuitBreakerSearchEngine(SearchEngineDecorator):
+
+    def __init__(self, engine: SearchEngine, breaker: CircuitBreaker):
+        super().__init__(engine)
+        self.breaker = breaker
+
+    async def search_movie(self, query: str) -> Optional[Movie]:
+        return await self._call(lambda: self.engine.search_movie(query))
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        return await self._call(lambda: self.engine.search_candidates(query))
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        return await self._call(lambda: self.engine.get_movie(query, candidate))
+
+    async def _call(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.breaker.name)
+        started: float = time.monotonic()
+        # Ожидание токена нашей квоты в задержку провайдера не входит
+        with tracking_queue_wait() as waited:
+            try:
+                result: Any = await fn()
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except UpstreamError as error:
+                if error.result.error in local_errors:
+                    # Запрос отклонила наша квота, до провайдера он не дошёл
+                    self.breaker.release()
+                elif error.result.error == 'rejected':
+                    # 4xx: провайдер ответил, просто не на этот запрос
+                    self.breaker.record(True, time.monotonic() - started - waited[0])
+                else:
+                    self.breaker.record(False, time.monotonic() - started - waited[0])
+                raise
+            except Exception:
+                self.breaker.record(False, time.monotonic() - started - waited[0])
+                raise
+        self.breaker.record(True, time.monotonic() - started - waited[0])
+        return result
+
+    def latency_budget(self) -> Optional[float]:
+        return self.breaker.latency_quantile(0.95)
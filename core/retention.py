@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional, Callable
+
+from config_data.settings import RetentionSettings
+
+from .database import BotDatabaseImpl
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RetentionStats:
+    rounds: int = 0
+    archived: int = 0  # Сколько поисков перенесли в архив
+    slices: int = 0    # Сколько транзакций переноса выполнили
+    vacuumed: int = 0  # Сколько страниц вернули файловой системе
+
+    def __str__(self) -> str:
+        return f'rounds={self.rounds} archived={self.archived} slices={self.slices} vacuumed={self.vacuumed}'
+
+
+# Фоновое обслуживание истории: старые поиски небольшими срезами переносятся в компактный архив,
+# освободившиеся страницы понемногу возвращаются файловой системе. Живая таблица остаётся маленькой,
+# и её горячая часть помещается в кэш страниц
+class HistoryRetention:
+
+    def __init__(self, database: BotDatabaseImpl, settings: Optional[RetentionSettings] = None,
+                 is_busy: Optional[Callable[[], bool]] = None):
+        self.database = database
+        self.settings = settings or RetentionSettings()
+        self.is_busy = is_busy
+        self.stats = RetentionStats()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self.settings.age > 0 and (self._worker is None or self._worker.done()):
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    # Переносит в архив всё, что старше age, затем сжимает файл; возвращает, сколько поисков перенесли
+    async def run_once(self) -> int:
+        before: int = int(time.time() - self.settings.age)
+        archived: int = 0
+        while True:
+            await self._wait_until_idle()
+            moved: int = await self.database.archive_history(before, self.settings.batch)
+            archived += moved
+            self.stats.archived += moved
+            self.stats.slices += 1
+            if moved < self.settings.batch:
+                break
+            await asyncio.sleep(self.settings.pause)
+        while True:
+            await self._wait_until_idle()
+            freed: int = await self.database.incremental_vacuum(self.settings.vacuum_pages)
+            self.stats.vacuumed += freed
+            if freed < self.settings.vacuum_pages:
+                break
+            await asyncio.sleep(self.settings.pause)
+        self.stats.rounds += 1
+        if archived:
+            logger.info('Archived %s searches older than %s', archived, before)
+        return archived
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception('History retention round failed')
+            await asyncio.sleep(self.settings.interval)
+
+    async def _wait_until_idle(self) -> None:
+        while self.is_busy is not None and self.is_busy():
+            await asyncio.sleep(self.settings.idle_poll)
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Awaitable, Callable, Hashable
+
+from aiogram import types
+
+from config_data.settings import SchedulerSettings
+
+from .bot_core import BotApi
+from .constants import BUSY_MESSAGE
+from .helpers import get_query, split_titles
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LaneStats:
+    accepted: int = 0
+    shed: int = 0
+    max_waiting: int = 0
+
+    def __str__(self) -> str:
+        return f'accepted={self.accepted} shed={self.shed} max_waiting={self.max_waiting}'
+
+
+@dataclass
+class _ChatQueue:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    size: int = 0
+
+
+# Полоса обработки: обновления одного чата идут строго по очереди, всего одновременно - не больше concurrency.
+# Слот полосы занимаем только когда подошла очередь чата, чтобы ждущий чат не держал чужие слоты
+class Lane:
+
+    def __init__(self, concurrency: int, max_queue: Optional[int] = None, max_chat_queue: Optional[int] = None):
+        self.max_queue = max_queue
+        self.max_chat_queue = max_chat_queue
+        self.stats = LaneStats()
+        self.waiting: int = 0
+        self.active: int = 0   # Принятые и ещё не обработанные обновления, включая ждущие очереди
+        self._slots = asyncio.Semaphore(concurrency)
+        self._chats: dict[Hashable, _ChatQueue] = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    # Возвращает False, если обновление не принято из-за перегрузки
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[None]]) -> bool:
+        chat: _ChatQueue = self._chats.setdefault(key, _ChatQueue())
+        if self.max_queue is not None and self.waiting >= self.max_queue \
+                or self.max_chat_queue is not None and chat.size >= self.max_chat_queue:
+            self.stats.shed += 1
+            if not chat.size:
+                del self._chats[key]
+            return False
+        self.stats.accepted += 1
+        self.active += 1
+        self._idle.clear()
+        chat.size += 1
+        self.waiting += 1
+        self.stats.max_waiting = max(self.stats.max_waiting, self.waiting)
+        waiting: bool = True
+        try:
+            async with chat.lock:
+                async with self._slots:
+                    self.waiting -= 1
+                    waiting = False
+                    await fn()
+        finally:
+            if waiting:
+                self.waiting -= 1
+            chat.size -= 1
+            if not chat.size:
+                del self._chats[key]
+            self.active -= 1
+            if not self.active:
+                self._idle.set()
+        return True
+
+    # Ждём, пока будут обработаны все принятые обновления
+    async def join(self) -> None:
+        await self._idle.wait()
+
+
+# Ставится между диспетчером и BotApiImpl: поиски идут через ограниченную полосу со сбросом нагрузки,
+# лёгкие команды - через отдельную приоритетную полосу и никогда не ждут поисков.
+# Списки названий идут через свою полосу: долгий список не держит слот одиночных /search
+class SchedulingBotApi(BotApi):
+
+    def __init__(self, api: BotApi, settings: Optional[SchedulerSettings] = None, metrics: Optional[Metrics] = None):
+        self.api = api
+        self.settings = settings or SchedulerSettings()
+        self.metrics = metrics
+        self.searches = Lane(self.settings.concurrency, self.settings.max_queue, self.settings.max_chat_queue)
+        self.commands = Lane(self.settings.priority_concurrency)
+        self.batches = Lane(self.settings.batch_concurrency, self.settings.batch_max_queue,
+                            self.settings.max_chat_queue)
+
+    # При остановке дожидаемся уже принятых обновлений, но не дольше timeout; возвращает, сколько не дождались
+    async def drain(self, timeout: float) -> int:
+        try:
+            await asyncio.wait_for(asyncio.gather(self.searches.join(), self.commands.join(), self.batches.join()),
+                                   timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.searches.active + self.commands.active + self.batches.active
+
+    async def process_start_command(self, message: types.Message) -> None:
+        await self._run(self.commands, 'start', message.chat.id, lambda: self.api.process_start_command(message))
+
+    async def process_help_command(self, message: types.Message) -> None:
+        await self._run(self.commands, 'help', message.chat.id, lambda: self.api.process_help_command(message))
+
+    async def process_history_command(self, message: types.Message) -> None:
+        await self._run(self.commands, 'history', message.chat.id, lambda: self.api.process_history_command(message))
+
+    async def process_history_callback(self, callback: types.CallbackQuery) -> None:
+        await self._run(self.commands, 'history_page', callback.message.chat.id,
+                        lambda: self.api.process_history_callback(callback))
+
+    async def process_stats_command(self, message: types.Message) -> None:
+        await self._run(self.commands, 'stats', message.chat.id, lambda: self.api.process_stats_command(message))
+
+    async def process_search_command(self, message: types.Message) -> None:
+        if len(split_titles(get_query(message))) > 1:
+            await self._search(self.batches, message, 'search_batch', lambda: self.api.process_search_command(message))
+            return
+        await self._search(self.searches, message, 'search', lambda: self.api.process_search_command(message))
+
+    async def process_search_file(self, message: types.Message) -> None:
+        await self._search(self.batches, message, 'search_file', lambda: self.api.process_search_file(message))
+
+    # У inline-запросов своя отмена устаревших запросов и свой лимит обращений к провайдерам
+    async def process_inline_query(self, inline_query: types.InlineQuery) -> None:
+        if self.metrics is None:
+            await self.api.process_inline_query(inline_query)
+            return
+        with self.metrics.trace('inline'):
+            async with self.metrics.measure('command', 'inline'):
+                await self.api.process_inline_query(inline_query)
+
+    async def process_unknown_command(self, message: types.Message) -> None:
+        await self._run(self.commands, 'unknown', message.chat.id, lambda: self.api.process_unknown_command(message))
+
+    async def _search(self, lane: Lane, message: types.Message, command: str,
+                      fn: Callable[[], Awaitable[None]]) -> None:
+        if not await self._run(lane, command, message.chat.id, fn):
+            logger.warning('Shedding %s in chat %s: %s waiting', command, message.chat.id, lane.waiting)
+            await message.reply(BUSY_MESSAGE)
+
+    # Ожидание в очереди полосы пишем отдельной стадией queue, выполнение - стадией command
+    async def _run(self, lane: Lane, command: str, key: Hashable, fn: Callable[[], Awaitable[None]]) -> bool:
+        if self.metrics is None:
+            return await lane.run(key, fn)
+        submitted: float = time.monotonic()
+
+        async def measured() -> None:
+            self.metrics.latency.observe(time.monotonic() - submitted, 'queue', command)
+            with self.metrics.trace(command):
+                async with self.metrics.measure('command', command):
+                    await fn()
+
+        accepted: bool = await lane.run(key, measured)
+        if not accepted:
+            self.metrics.shed.inc(command)
+        return accepted
@@ -1,32 +1,45 @@
 from abc import ABC, abstractmethod
 from typing import Optional, Any
 
-import aiohttp
+from .throttling import ProviderScheduler, UpstreamError, UpstreamResult
 
 
 class Scrapper(ABC):
 
     @abstractmethod
-    async def get_top_link(self, query: str, cite: Optional[str]) -> Optional[str]:
+    async def get_top_link(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
         pass
 
 
+class ScrapperDecorator(Scrapper):
+
+    def __init__(self, scrapper: Scrapper):
+        self.scrapper = scrapper
+
+    async def get_top_link(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
+        return await self.scrapper.get_top_link(query, cite, key)
+
+
 class GoogleRestScrapper(Scrapper):
     search_endpoint: str = "https://serpapi.com/search.json"
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, scheduler: ProviderScheduler):
         self.api_key = api_key
+        self.scheduler = scheduler
 
-    async def get_top_link(self, query: str, cite: Optional[str]) -> Optional[str]:
+    async def get_top_link(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
         params = {
             'q': f'site:{cite} {query}' if cite else query,
             'api_key': self.api_key
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.search_endpoint, params=params) as response:
-                response_json = await response.json()
-                return self._get_top_link(response_json)
+        response_json = await self.scheduler.fetch_json(self.search_endpoint, params=params)
+        if response_json.get('error') and 'any results' not in response_json['error']:
+            raise UpstreamError(self.scheduler.name, UpstreamResult(error=response_json['error']))
+        return self._get_top_link(response_json)
 
     @staticmethod
     def _get_top_link(json: dict[str, Any]) -> Optional[str]:
-        return json.get('organic_results')[0].get('link')
+        results: Optional[list[dict[str, Any]]] = json.get('organic_results')
+        if not results:
+            return None
+        return results[0].get('link')
@@ -1,10 +1,10 @@
 from abc import ABC, abstractmethod
 from typing import Optional, Any
 
-import aiohttp
-
-from .structs import Movie
+from .throttling import ProviderScheduler
+from .structs import Movie, Candidate
 from .helpers import first_non_none
+from .matching import pick_best_candidate, parse_year
 
 
 class SearchEngine(ABC):
@@ -13,33 +13,79 @@ class SearchEngine(ABC):
     async def search_movie(self, query: str) -> Optional[Movie]:
         pass
 
+    # Первые кандидаты из поисковой выдачи, без запроса подробностей
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        movie: Optional[Movie] = await self.search_movie(query)
+        return [Candidate(movie, True)] if movie else []
+
+    # Подробности о выбранном кандидате; query - запрос, по которому его нашли
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        return candidate.movie
+
+    def latency_budget(self) -> Optional[float]:
+        return None
+
+
+class SearchEngineDecorator(SearchEngine):
+
+    def __init__(self, engine: SearchEngine):
+        self.engine = engine
+
+    async def search_movie(self, query: str) -> Optional[Movie]:
+        return await self.engine.search_movie(query)
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        return await self.engine.search_candidates(query)
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        return await self.engine.get_movie(query, candidate)
+
+    def latency_budget(self) -> Optional[float]:
+        return self.engine.latency_budget()
+
 
 class TmdbSearchEngine(SearchEngine):
     search_movie_endpoint: str = 'https://api.themoviedb.org/3/search/movie'
     images_endpoint: str = "https://image.tmdb.org/t/p/w500"
     get_movie_endpoint: str = "https://api.themoviedb.org/3/movie"
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, scheduler: ProviderScheduler, candidates: int = 5):
         self.api_key = api_key
+        self.scheduler = scheduler
+        self.candidates = candidates
 
     async def search_movie(self, query: str) -> Optional[Movie]:
+        # Подробности запрашиваем только для лучшего из первых кандидатов, а не для первого в выдаче
+        candidates: list[Candidate] = await self.search_candidates(query)
+        best: Optional[Movie] = pick_best_candidate(query, [candidate.movie for candidate in candidates])
+        return await self.get_movie(query, Candidate(best)) if best else None
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
         search_params = {
             'api_key': self.api_key,
             'query': query,
             'page': 1
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.search_movie_endpoint, params=search_params) as response:
-                json_response = await response.json()
-
-            results: Optional[dict[str, Any]] = json_response.get('results')
-            if not results:
-                return None
-            top: dict[str, Any] = json_response['results'][0]
-            movie_params = {'api_key': self.api_key}
-            async with session.get(self.get_movie_endpoint + f'/{top.get("id")}', params=movie_params) as response:
-                json_response = await response.json()
-                return self._parse_json_movie(json_response)
+        json_response = await self.scheduler.fetch_json(self.search_movie_endpoint, params=search_params)
+        results: list[dict[str, Any]] = json_response.get('results') or []
+        return [Candidate(self._parse_json_candidate(item)) for item in results[:self.candidates] if item.get('id')]
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        if candidate.complete:
+            return candidate.movie
+        movie_params = {'api_key': self.api_key}
+        json_response = await self.scheduler.fetch_json(self.get_movie_endpoint + f'/{candidate.movie.id_tmdb}',
+                                                        params=movie_params)
+        return self._parse_json_movie(json_response)
+
+    @staticmethod
+    def _parse_json_candidate(json: dict[str, Any]) -> Movie:
+        return Movie(
+            title=json.get('title'),
+            original_title=json.get('original_title'),
+            id_tmdb=json.get('id'),
+            year=parse_year(json.get('release_date'))
+        )
 
     def _parse_json_movie(self, json: dict[str, Any]) -> Optional[Movie]:
         poster: Optional[str] = None
@@ -51,7 +97,8 @@ class TmdbSearchEngine(SearchEngine):
             poster=poster,
             id_tmdb=json.get('id'),
             id_imdb=json.get('imdb_id'),
-            original_title=json.get('original_title')
+            original_title=json.get('original_title'),
+            year=parse_year(json.get('release_date'))
         )
 
 
@@ -59,35 +106,44 @@ class KpUnofficialSearchEngine(SearchEngine):
     search_movie_endpoint: str = 'https://kinopoiskapiunofficial.tech/api/v2.1/films/search-by-keyword'
     get_movie_endpoint: str = 'https://kinopoiskapiunofficial.tech/api/v2.2/films'
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, scheduler: ProviderScheduler, candidates: int = 5):
         self.api_key = api_key
+        self.scheduler = scheduler
+        self.candidates = candidates
         self.headers = {
             'X-API-KEY': self.api_key,
             'Content-Type': 'application/json'
         }
 
     async def search_movie(self, query: str) -> Optional[Movie]:
+        candidates: list[Candidate] = await self.search_candidates(query)
+        best: Optional[Movie] = pick_best_candidate(query, [candidate.movie for candidate in candidates])
+        return await self.get_movie(query, Candidate(best)) if best else None
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
         params = {
             'api_key': self.api_key,
             'page': 1,
             'keyword': query
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.search_movie_endpoint, params=params, headers=self.headers) as response:
-                json_search_response = await response.json()
-                kp_id: Optional[int] = self._parse_top_movie_id(json_search_response)
-                if not kp_id:
-                    return None
-            async with session.get(self.get_movie_endpoint + f'/{kp_id}', headers=self.headers) as response:
-                json_response = await response.json()
-                return self._parse_movie_json_obj(json_response)
-
-    @staticmethod
-    def _parse_top_movie_id(json: dict[str, Any]) -> Optional[int]:
-        if not json.get('films'):
-            return None
-        top = json['films'][0]
-        return top.get('filmId')
+        json_search_response = await self.scheduler.fetch_json(self.search_movie_endpoint, params=params,
+                                                               headers=self.headers)
+        return [Candidate(movie) for movie in self._parse_candidates(json_search_response)]
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        if candidate.complete:
+            return candidate.movie
+        json_response = await self.scheduler.fetch_json(self.get_movie_endpoint + f'/{candidate.movie.id_kp}',
+                                                        headers=self.headers)
+        return self._parse_movie_json_obj(json_response)
+
+    def _parse_candidates(self, json: dict[str, Any]) -> list[Movie]:
+        return [Movie(
+            title=first_non_none([film.get('nameRu'), film.get('nameEn')]),
+            original_title=film.get('nameEn'),
+            id_kp=film.get('filmId'),
+            year=parse_year(film.get('year'))
+        ) for film in (json.get('films') or [])[:self.candidates] if film.get('filmId')]
 
     @staticmethod
     def _parse_movie_json_obj(json: dict[str, Any]) -> Optional[Movie]:
@@ -100,5 +156,6 @@ class KpUnofficialSearchEngine(SearchEngine):
             id_imdb=json.get('imdbId'),
             id_kp=json.get('kinopoiskId'),
             rating_kp=json.get('ratingKinopoisk'),
-            rating_imdb=json.get('ratingImdb')
+            rating_imdb=json.get('ratingImdb'),
+            year=parse_year(json.get('year'))
         )
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import logging
+import secrets
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from typing import Optional, Any, Awaitable, Callable, TYPE_CHECKING
+
+from config_data.settings import SharedCacheSettings, CacheSettings
+
+from .cache import LruCache
+from .helpers import normalize_query, movie_key, movie_to_compact, movie_from_compact, is_refreshing
+from .scrapper import Scrapper, ScrapperDecorator
+from .search import SearchEngine, SearchEngineDecorator
+from .structs import Movie, Candidate
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SharedCacheStats:
+    hits: int = 0
+    misses: int = 0
+    waits: int = 0    # Результат получен от другого узла, пока мы ждали блокировку
+    errors: int = 0   # Хранилище недоступно, шли к провайдеру напрямую
+
+    def __str__(self) -> str:
+        return f'hits={self.hits} misses={self.misses} waits={self.waits} errors={self.errors}'
+
+
+class CacheBackend(ABC):
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        pass
+
+    # Возвращает токен владельца, если блокировку удалось взять, иначе None
+    @abstractmethod
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    async def release_lock(self, key: str, token: str) -> None:
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+
+    def __init__(self, max_size: int = 10000):
+        self._values = LruCache(max_size)
+        self._locks: dict[str, tuple[str, float]] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._values.get(key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        self._values.put(key, value, ttl)
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        now: float = time.monotonic()
+        owner: Optional[tuple[str, float]] = self._locks.get(key)
+        if owner is not None and owner[1] > now:
+            return None
+        token: str = secrets.token_hex(8)
+        self._locks[key] = (token, now + ttl)
+        return token
+
+    async def release_lock(self, key: str, token: str) -> None:
+        owner: Optional[tuple[str, float]] = self._locks.get(key)
+        if owner is not None and owner[0] == token:
+            del self._locks[key]
+
+
+class RedisCacheBackend(CacheBackend):
+    # Снимаем блокировку, только если она всё ещё наша: за время запроса она могла истечь и достаться другому узлу
+    _release_script: str = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, redis: 'Redis'):
+        self.redis = redis
+
+    async def get(self, key: str) -> Optional[str]:
+        value: Optional[bytes] = await self.redis.get(key)
+        return value.decode() if value is not None else None
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        await self.redis.set(key, value, px=max(int(ttl * 1000), 1))
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        token: str = secrets.token_hex(8)
+        acquired: Optional[bool] = await self.redis.set(key, token, px=max(int(ttl * 1000), 1), nx=True)
+        return token if acquired else None
+
+    async def release_lock(self, key: str, token: str) -> None:
+        await self.redis.eval(self._release_script, 1, key, token)
+
+
+# Общий для всех узлов кэш: на промахе только один узел кластера идёт к провайдеру,
+# остальные ждут, пока результат появится в хранилище
+class SharedCache:
+
+    def __init__(self, backend: CacheBackend, settings: Optional[SharedCacheSettings] = None):
+        self.backend = backend
+        self.settings = settings or SharedCacheSettings()
+        self.stats = SharedCacheStats()
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]], encode: Callable[[Any], str],
+                           decode: Callable[[str], Any], ttl: Callable[[Any], float]) -> Any:
+        key = f'{self.settings.prefix}:{key}'
+        token: Optional[str] = None
+        # При обновлении в обход кэшей старое значение не берём, но блокировку держим, чтобы не идти к провайдеру
+        # одновременно с другими узлами
+        try:
+            cached: Optional[str] = await self.backend.get(key) if not is_refreshing() else None
+            if cached is not None:
+                self.stats.hits += 1
+                return decode(cached)
+            token = await self._wait_for_lock(key)
+            if token is None:
+                cached = await self.backend.get(key)
+                if cached is not None:
+                    self.stats.waits += 1
+                    return decode(cached)
+        except Exception as error:
+            self.stats.errors += 1
+            logger.warning('Shared cache unavailable: %r', error)
+
+        self.stats.misses += 1
+        try:
+            value: Any = await fetch()
+            await self._store(key, encode(value), ttl(value))
+            return value
+        finally:
+            if token is not None:
+                await self._release(key, token)
+
+    # Ждём, пока либо возьмём блокировку сами, либо результат положит другой узел, либо выйдет время.
+    # None означает, что блокировку не взяли; тогда смотрим в кэш ещё раз и при промахе идём к провайдеру сами
+    async def _wait_for_lock(self, key: str) -> Optional[str]:
+        deadline: float = time.monotonic() + self.settings.lock_wait
+        while True:
+            token: Optional[str] = await self.backend.acquire_lock(f'{key}:lock', self.settings.lock_ttl)
+            if token is not None or time.monotonic() >= deadline:
+                return token
+            await asyncio.sleep(self.settings.poll_interval)
+            if await self.backend.get(key) is not None:
+                return None
+
+    async def _store(self, key: str, value: str, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        try:
+            await self.backend.set(key, value, ttl)
+        except Exception as error:
+            self.stats.errors += 1
+            logger.warning('Failed to store %s in shared cache: %r', key, error)
+
+    async def _release(self, key: str, token: str) -> None:
+        try:
+            await self.backend.release_lock(f'{key}:lock', token)
+        except Exception as error:
+            logger.warning('Failed to release shared lock %s: %r', key, error)
+
+
+def _candidates_to_compact(candidates: list[Candidate]) -> str:
+    return '[' + ','.join(f'[{movie_to_compact(item.movie)},{int(item.complete)}]' for item in candidates) + ']'
+
+
+def _candidates_from_compact(data: str) -> list[Candidate]:
+    return [Candidate(movie_from_compact(json.dumps(movie)), bool(complete)) for movie, complete in json.loads(data)]
+
+
+class SharedCacheSearchEngine(SearchEngineDecorator):
+
+    def __init__(self, engine: SearchEngine, name: str, cache: SharedCache, settings: Optional[CacheSettings] = None):
+        super().__init__(engine)
+        self.name = name
+        self.cache = cache
+        self.settings = settings or CacheSettings()
+
+    async def search_movie(self, query: str) -> Optional[Movie]:
+        movie: Optional[Movie] = await self.cache.get_or_fetch(
+            f'movie:{self.name}:{normalize_query(query)}', lambda: self.engine.search_movie(query),
+            movie_to_compact, movie_from_compact,
+            lambda found: self.settings.ttl if found else self.settings.negative_ttl)
+        return replace(movie) if movie else None
+
+    # Выдача провайдера по запросу: на холодном запросе в поиск ходит один узел, остальные ждут его результата
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        return await self.cache.get_or_fetch(
+            f'candidates:{self.name}:{normalize_query(query)}', lambda: self.engine.search_candidates(query),
+            _candidates_to_compact, _candidates_from_compact,
+            lambda found: self.settings.ttl if found else self.settings.negative_ttl)
+
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        if candidate.complete:
+            return await self.engine.get_movie(query, candidate)
+        movie: Optional[Movie] = await self.cache.get_or_fetch(
+            f'details:{self.name}:{movie_key(candidate.movie)}', lambda: self.engine.get_movie(query, candidate),
+            movie_to_compact, movie_from_compact,
+            lambda found: self.settings.ttl if found else self.settings.negative_ttl)
+        return replace(movie) if movie else None
+
+
+class SharedCacheScrapper(ScrapperDecorator):
+
+    def __init__(self, scrapper: Scrapper, cache: SharedCache, settings: Optional[CacheSettings] = None):
+        super().__init__(scrapper)
+        self.cache = cache
+        self.settings = settings or CacheSettings()
+
+    async def get_top_link(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
+        return await self.cache.get_or_fetch(
+            f'link:{key or "title:" + normalize_query(query)}:{cite or ""}',
+            lambda: self.scrapper.get_top_link(query, cite, key),
+            json.dumps, json.loads,
+            lambda link: self.settings.link_ttl if link else self.settings.negative_ttl)
@@ -0,0 +1,82 @@
+import asyncio
+from dataclasses import replace
+from typing import Optional, Any, Awaitable, Callable, Hashable
+
+from .helpers import normalize_query, movie_key
+from .scrapper import Scrapper, ScrapperDecorator
+from .search import SearchEngine, SearchEngineDecorator
+from .structs import Movie, Candidate
+
+
+class _Call:
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters: int = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.saved_calls: int = 0
+        self._calls: dict[Hashable, _Call] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call: Optional[_Call] = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.saved_calls += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done() and call.waiters == 1:
+                # Убираем запись сразу: иначе пришедший до done-колбэка вызов присоединится к отменённой задаче
+                self._forget(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def _forget(self, key: Hashable, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+class CoalescingSearchEngine(SearchEngineDecorator):
+
+    def __init__(self, engine: SearchEngine):
+        super().__init__(engine)
+        self.flight = SingleFlight()
+
+    async def search_movie(self, query: str) -> Optional[Movie]:
+        movie: Optional[Movie] = await self.flight.do(normalize_query(query), lambda: self.engine.search_movie(query))
+        return replace(movie) if movie else None
+
+    async def search_candidates(self, query: str) -> list[Candidate]:
+        candidates: list[Candidate] = await self.flight.do(('candidates', normalize_query(query)),
+                                                           lambda: self.engine.search_candidates(query))
+        return [replace(candidate, movie=replace(candidate.movie)) for candidate in candidates]
+
+    # Подробности об одном фильме по разным запросам запрашиваем один раз
+    async def get_movie(self, query: str, candidate: Candidate) -> Optional[Movie]:
+        movie: Optional[Movie] = await self.flight.do(('details', movie_key(candidate.movie)),
+                                                      lambda: self.engine.get_movie(query, candidate))
+        return replace(movie) if movie else None
+
+
+class CoalescingScrapper(ScrapperDecorator):
+
+    def __init__(self, scrapper: Scrapper):
+        super().__init__(scrapper)
+        self.flight = SingleFlight()
+
+    async def get_top_link(self, query: str, cite: Optional[str], key: Optional[str] = None) -> Optional[str]:
+        return await self.flight.do((key or normalize_query(query), cite),
+                                    lambda: self.scrapper.get_top_link(query, cite, key))
@@ -3,17 +3,16 @@ from dataclasses import dataclass
 import datetime as datetime
 from typing import Optional
 
-from aiogram import types
-
 
 @dataclass
 class SearchEntity:
-    chat_id: types.base.Integer
+    chat_id: int
     text: str
     title: str
     datetime: datetime.datetime
     kp_id: Optional[int]
     tmdb_id: Optional[int]
+    id: Optional[int] = None
 
 
 @dataclass
@@ -24,6 +23,14 @@ class StatsEntity:
     count: int
 
 
+@dataclass
+class QueryCount:
+    text: str
+    title: str
+    hour: int   # Начало часа поиска, unix-время
+    count: int
+
+
 @dataclass
 class Movie:
     title: Optional[str] = None
@@ -38,9 +45,45 @@ class Movie:
     rating_imdb: Optional[float] = None
     rating_kp: Optional[float] = None
     links_to_watch: Optional[list[str]] = None
+    year: Optional[int] = None
 
 
 @dataclass
 class Banner:
     text: str
     picture: Optional[str]
+
+
+@dataclass
+class CachedMovie:
+    movie: Optional[Movie]
+    cached_at: float
+
+
+@dataclass
+class CachedLink:
+    link: Optional[str]
+    cached_at: float
+
+
+@dataclass
+class CachedPoster:
+    poster: str
+    file_id: str
+    cached_at: float
+
+
+@dataclass
+class IndexedMovie:
+    source: str
+    movie: Movie
+    complete: bool
+    names: str = ''
+    updated_at: float = 0.0
+
+
+# Кандидат из поисковой выдачи провайдера; complete - уже со всеми подробностями (из кэша или индекса)
+@dataclass
+class Candidate:
+    movie: Movie
+    complete: bool = False
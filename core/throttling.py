@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Any, Iterator
+
+import aiohttp
+
+from config_data.settings import ProviderLimits
+
+from .http import HttpClient
+
+logger = logging.getLogger(__name__)
+
+# Исходы, которые провайдер не выдавал: запрос отклонила наша собственная квота
+local_errors: frozenset[str] = frozenset({'rate_limited'})
+
+# Сколько текущий вызов простоял в очереди за токеном, секунды: это наша задержка, а не провайдера
+_queue_wait: ContextVar[Optional[list[float]]] = ContextVar('queue_wait', default=None)
+
+
+@contextlib.contextmanager
+def tracking_queue_wait() -> Iterator[list[float]]:
+    waited: list[float] = [0.0]
+    token = _queue_wait.set(waited)
+    try:
+        yield waited
+    finally:
+        _queue_wait.reset(token)
+
+
+@dataclass
+class UpstreamResult:
+    data: Optional[Any] = None
+    status: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, provider: str, result: UpstreamResult):
+        super().__init__(f'{provider}: {result.error} (status {result.status})')
+        self.provider = provider
+        self.result = result
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens: float = capacity
+        self._updated: float = time.monotonic()
+        self._paused_until: float = 0.0
+
+    async def acquire(self, max_wait: float) -> bool:
+        wait: float = self.reserve(max_wait)
+        if wait < 0:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def reserve(self, max_wait: float) -> float:
+        now: float = time.monotonic()
+        self._refill(now)
+        wait: float = max(self._paused_until - now, 0.0)
+        if self._tokens < 1:
+            wait = max(wait, (1 - self._tokens) / self.rate)
+        if wait > max_wait:
+            return -1
+        self._tokens -= 1
+        return wait
+
+    def pause(self, delay: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def available(self) -> float:
+        self._refill(time.monotonic())
+        return max(self._tokens, 0.0)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class ProviderScheduler:
+
+    def __init__(self, name: str, http: HttpClient, limits: Optional[ProviderLimits] = None):
+        self.name = name
+        self.http = http
+        self.limits = limits or ProviderLimits()
+        self.bucket = TokenBucket(self.limits.rate, self.limits.burst)
+        self.requests: int = 0
+        self.retries: int = 0
+        self.rejected: int = 0
+
+    async def get_json(self, url: str, params: Optional[dict[str, Any]] = None,
+                       headers: Optional[dict[str, str]] = None) -> UpstreamResult:
+        result = UpstreamResult(error='not_attempted')
+        for attempt in range(self.limits.retries + 1):
+            if not await self._acquire():
+                self.rejected += 1
+                return UpstreamResult(status=result.status, error='rate_limited')
+            self.requests += 1
+            result, retry_after = await self._get_json_once(url, params, headers)
+            if result.ok or retry_after is None or attempt == self.limits.retries:
+                break
+            delay: float = retry_after if retry_after > 0 else self._backoff(attempt)
+            if delay > self.limits.max_wait:
+                break
+            logger.info('%s answered %s, retrying in %.2f s', self.name, result.status or result.error, delay)
+            self.retries += 1
+            await asyncio.sleep(delay)
+        return result
+
+    async def fetch_json(self, url: str, params: Optional[dict[str, Any]] = None,
+                         headers: Optional[dict[str, str]] = None) -> Any:
+        result: UpstreamResult = await self.get_json(url, params, headers)
+        if not result.ok:
+            raise UpstreamError(self.name, result)
+        return result.data
+
+    async def _acquire(self) -> bool:
+        started: float = time.monotonic()
+        try:
+            return await self.bucket.acquire(self.limits.max_wait)
+        finally:
+            waited: Optional[list[float]] = _queue_wait.get()
+            if waited is not None:
+                waited[0] += time.monotonic() - started
+
+    async def _get_json_once(self, url: str, params: Optional[dict[str, Any]],
+                             headers: Optional[dict[str, str]]) -> tuple[UpstreamResult, Optional[float]]:
+        try:
+            async with self.http.session.get(url, params=params, headers=headers) as response:
+                if response.status == 429 or response.status >= 500:
+                    retry_after: float = self._parse_retry_after(response.headers.get('Retry-After'))
+                    if response.status == 429:
+                        self.bucket.pause(retry_after or self._backoff(0))
+                    return UpstreamResult(status=response.status, error='unavailable'), retry_after
+                if response.status >= 400:
+                    return UpstreamResult(status=response.status, error='rejected'), None
+                return UpstreamResult(data=await response.json(content_type=None), status=response.status), None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            return UpstreamResult(error=type(error).__name__), 0.0
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.limits.max_backoff, self.limits.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> float:
+        if not value:
+            return 0.0
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return 0.0
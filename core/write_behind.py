@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from typing import Optional
+
+
+from config_data.settings import WriteBehindSettings
+
+from .database import BotDatabase, BotDatabaseDecorator
+from .structs import SearchEntity, StatsEntity
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindDatabase(BotDatabaseDecorator):
+
+    def __init__(self, database: BotDatabase, settings: Optional[WriteBehindSettings] = None):
+        super().__init__(database)
+        self.settings = settings or WriteBehindSettings()
+        self._queue: asyncio.Queue[SearchEntity] = asyncio.Queue(self.settings.max_queue)
+        self._worker: Optional[asyncio.Task] = None
+        self._flush_requested = asyncio.Event()
+        # Номера записей: сколько поставлено в очередь и сколько уже обработано. Очередь одна и пишется по порядку,
+        # поэтому flush ждёт только записи, поставленные до его вызова, а не всё, что успеет прийти следом
+        self._enqueued: int = 0
+        self._written: int = 0
+        self._waiters: list[tuple[int, asyncio.Future]] = []
+
+    async def start(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def close(self, timeout: Optional[float] = None) -> None:
+        timeout = timeout if timeout is not None else self.settings.drain_timeout
+        try:
+            await self.flush(timeout)
+        except asyncio.TimeoutError:
+            logger.error('Dropping %s history entries not written in %s s', self._queue.qsize(), timeout)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def flush(self, timeout: Optional[float] = None) -> None:
+        if self._worker is None or self._written >= self._enqueued:
+            return
+        waiter: tuple[int, asyncio.Future] = (self._enqueued, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._flush_requested.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), timeout)
+        finally:
+            self._waiters.remove(waiter)
+            if not self._waiters:
+                self._flush_requested.clear()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def save_search_entity(self, entity: SearchEntity) -> None:
+        await self.start()
+        await self._queue.put(entity)
+        self._enqueued += 1
+
+    async def save_search_entities(self, entities: list[SearchEntity]) -> None:
+        await self.start()
+        for entity in entities:
+            await self._queue.put(entity)
+            self._enqueued += 1
+
+    async def load_search_entities(self, chat_id: int) -> list[SearchEntity]:
+        await self._flush_before_read()
+        return await self.database.load_search_entities(chat_id)
+
+    async def load_search_page(self, chat_id: int, limit: int,
+                               before: Optional[tuple[int, int]] = None,
+                               after: Optional[tuple[int, int]] = None) -> list[SearchEntity]:
+        await self._flush_before_read()
+        return await self.database.load_search_page(chat_id, limit, before, after)
+
+    async def load_stats_entities(self, chat_id: int) -> list[StatsEntity]:
+        await self._flush_before_read()
+        return await self.database.load_stats_entities(chat_id)
+
+    # Чтение видит свои же недавние поиски, но не ждёт дольше read_wait: при долгой записи отдаём то, что уже в базе
+    async def _flush_before_read(self) -> None:
+        try:
+            await self.flush(self.settings.read_wait)
+        except asyncio.TimeoutError:
+            logger.warning('History read did not wait for %s pending entries', self.pending())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: list[SearchEntity] = [await self._queue.get()]
+            deadline: float = loop.time() + self.settings.flush_interval
+            while len(batch) < self.settings.batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout: float = deadline - loop.time()
+                if timeout <= 0 or self._flush_requested.is_set():
+                    break
+                entity: Optional[SearchEntity] = await self._next_entity(timeout)
+                if entity is None:
+                    break
+                batch.append(entity)
+            try:
+                await self.database.save_search_entities(batch)
+            except Exception:
+                logger.exception('Could not write %s history entries', len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+                self._written += len(batch)
+                for target, waiter in self._waiters:
+                    if target <= self._written and not waiter.done():
+                        waiter.set_result(None)
+
+    async def _next_entity(self, timeout: float) -> Optional[SearchEntity]:
+        get = asyncio.ensure_future(self._queue.get())
+        flush = asyncio.ensure_future(self._flush_requested.wait())
+        try:
+            await asyncio.wait({get, flush}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            get.cancel()
+            raise
+        finally:
+            flush.cancel()
+        if get.done():
+            return get.result()
+        get.cancel()
+        return None